@@ -7,14 +7,11 @@ from tom_targets.forms import TargetVisibilityForm
 from tom_observations import utils, facility
 from tom_dataproducts.models import DataProduct, ReducedDatum, ObservationRecord
 
-from astroplan import Observer, FixedTarget, AtNightConstraint, time_grid_from_range, moon_illumination
-import datetime
+from astroplan import AtNightConstraint, moon_illumination
 import json
-from astropy.time import Time
-from astropy import units as u
-from astropy.coordinates import get_moon, get_sun, SkyCoord, AltAz
-import numpy as np
+from astropy.coordinates import get_moon, AltAz
 import time
+from custom_code.visibility import get_facility_sites, get_site_airmasses, get_24hr_time_range
 
 register = template.Library()
 
@@ -44,66 +41,24 @@ def get_24hr_airmass(target, interval, airmass_limit):
 
     plot_data = []
     
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
+    time_range = get_24hr_time_range(interval)
     time_plot = time_range.datetime
-    
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
-
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
-    )
 
-    for observing_facility in facility.get_service_classes():
+    observing_facility = 'LCO'
+    sites = get_facility_sites(observing_facility)
 
-        if observing_facility != 'LCO':
-            continue
+    ### Same kernel as the custom_code airmass plots: all sites in one transform (between astro twilights)
+    site_airmasses = get_site_airmasses(target.ra, target.dec, sites, time_range, airmass_limit, sun_alt_limit=-18.0)
 
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
+    for site, obj_airmass in site_airmasses.items():
 
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -18*u.deg)  #between astro twilights
-            )
-
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
-
-            label = '({facility}) {site}'.format(
-                facility = observing_facility, site = site
-            )
+        label = '({facility}) {site}'.format(
+            facility = observing_facility, site = site
+        )
 
-            plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, )
-            )
+        plot_data.append(
+            go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, )
+        )
 
     return plot_data
 
@@ -1,3 +1,34 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from unittest import mock
+from astropy import units as u
+from astropy.time import Time
+from astroplan import time_grid_from_range
+from tom_targets.models import Target
+import numpy as np
 
-# Create your tests here.
+from airmass.templatetags.airmass_tags import get_24hr_airmass
+from custom_code.tests import astroplan_airmass
+from custom_code.visibility import get_facility_sites
+
+
+class AirmassPlotTest(SimpleTestCase):
+
+    def setUp(self):
+        self.time_range = time_grid_from_range(
+            time_range=[Time('2023-06-01 00:00:00'), Time('2023-06-02 00:00:00')],
+            time_resolution=15*u.minute)
+        patcher = mock.patch('airmass.templatetags.airmass_tags.get_24hr_time_range', return_value=self.time_range)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_astroplan(self):
+        sites = get_facility_sites('LCO')
+        for ra, dec in [(150.0, -30.0), (10.0, 5.0), (280.0, -60.0)]:
+            plot_data = get_24hr_airmass(Target(name='airmass target', ra=ra, dec=dec), 15, 3.0)
+            expected = astroplan_airmass(ra, dec, sites, self.time_range, 3.0, -18.0)
+
+            self.assertEqual([trace.name for trace in plot_data], ['(LCO) {}'.format(site) for site in sites])
+            for trace, site in zip(plot_data, sites):
+                airmass = np.array(trace.y, dtype=float)
+                np.testing.assert_array_equal(np.isnan(airmass), np.isnan(expected[site]))
+                np.testing.assert_allclose(airmass, expected[site], rtol=1e-6, equal_nan=True)
@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from guardian.shortcuts import assign_perm
+from custom_code.permissions import bulk_assign_perms
 from tom_dataproducts.api_views import DataProductViewSet
 from tom_observations.api_views import ObservationRecordViewSet
 from rest_framework import status
@@ -26,6 +27,7 @@ from rest_framework.exceptions import ValidationError
 from django.db import transaction
 from custom_code.hooks import _return_session
 from urllib.parse import urlencode
+from contextlib import closing
 import requests
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 
@@ -97,11 +99,10 @@ class CustomDataProductViewSet(DataProductViewSet):
                 #run_hook('data_product_post_upload', dp)
                 reduced_data = run_custom_data_processor(dp, extras)
                 if not settings.TARGET_PERMISSIONS_ONLY:
-                    for group_name in settings.DEFAULT_GROUPS:#response.data['group']:
-                        group = Group.objects.get(name=group_name)
-                        assign_perm('tom_dataproducts.view_dataproduct', group, dp)
-                        assign_perm('tom_dataproducts.delete_dataproduct', group, dp)
-                        assign_perm('tom_dataproducts.view_reduceddatum', group, reduced_data)
+                    groups = [Group.objects.get(name=group_name) for group_name in settings.DEFAULT_GROUPS]#response.data['group']
+                    bulk_assign_perms('tom_dataproducts.view_dataproduct', groups, dp)
+                    bulk_assign_perms('tom_dataproducts.delete_dataproduct', groups, dp)
+                    bulk_assign_perms('tom_dataproducts.view_reduceddatum', groups, reduced_data)
                 # Make the ReducedDatumExtra row corresponding to this dp
                 upload_extras['data_product_id'] = dp.id
                 reduced_datum_extra = ReducedDatumExtra(
@@ -130,8 +131,7 @@ class CustomObservationRecordViewSet(ObservationRecordViewSet):
         """
         Endpoint for submitting a new observation with syncing with SNEx1.
         """
-        with transaction.atomic():
-            db_session = _return_session()
+        with transaction.atomic(), closing(_return_session()) as db_session:
             # Initialize the observation form, validate the form data, and submit to the observatory
             observation_ids = []
             try:
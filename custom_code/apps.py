@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class CustomPlotsConfig(AppConfig):
     name = 'custom_code'
+
+    def ready(self):
+        ### Connect the light curve cache, spectrum array and target pixel receivers
+        import custom_code.lightcurves
+        import custom_code.spectra
+        import custom_code.target_search
@@ -0,0 +1,194 @@
+"""
+Shared HTTP layer for the broker queries and alert stream ingestion.
+
+Requests are made with asyncio so many candidates can be looked up at
+once, while each service is held to its own request rate and number of
+requests in flight. Failed requests are retried with jittered
+exponential backoff, and successful responses are cached for a while so
+repeated lookups of the same candidate don't hit the service again.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+### Limits for each service we talk to:
+###   rate: sustained requests per second, burst: requests allowed back to back,
+###   concurrency: requests in flight at once, cache_ttl: seconds to reuse a response
+SERVICES = {
+    'alerce': {'rate': 5.0, 'burst': 5, 'concurrency': 8, 'cache_ttl': 600},
+    'lasair': {'rate': 2.0, 'burst': 2, 'concurrency': 4, 'cache_ttl': 600},
+    'ned': {'rate': 2.0, 'burst': 2, 'concurrency': 4, 'cache_ttl': 24*60*60},
+    'tns': {'rate': 0.5, 'burst': 1, 'concurrency': 2, 'cache_ttl': 300},
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+### Most responses kept at once, least recently used are dropped first
+RESPONSE_CACHE_SIZE = 2048
+### Most coroutines gather_limited runs at once
+GATHER_LIMIT = 32
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=sum(s['concurrency'] for s in SERVICES.values()))
+
+
+class CachedResponse:
+    """
+    The parts of a requests.Response the broker code uses, safe to keep around
+    """
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RetryableError(Exception):
+    pass
+
+
+def _cache_get(key):
+    """
+    Returns the cached response for key, or None if there isn't a live one
+    """
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached is None:
+            return None
+        if cached[0] <= time.monotonic():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return cached[1]
+
+
+def _cache_set(key, response, ttl):
+    with _response_cache_lock:
+        now = time.monotonic()
+        _response_cache[key] = (now + ttl, response)
+        _response_cache.move_to_end(key)
+        ### Drop expired responses, then the least recently used ones over the limit
+        for expired in [k for k, (expires, _) in _response_cache.items() if expires <= now]:
+            del _response_cache[expired]
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, and up to burst at once
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ServiceClient:
+    """
+    Rate-limited, retrying client for one service.
+    Must be created inside the running event loop
+    """
+
+    def __init__(self, service, retries=3, backoff=2.0):
+        limits = SERVICES[service]
+        self.service = service
+        self.bucket = TokenBucket(limits['rate'], limits['burst'])
+        self.semaphore = asyncio.Semaphore(limits['concurrency'])
+        self.cache_ttl = limits['cache_ttl']
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Runs a blocking call to this service (e.g. a client library method)
+        within the service limits, retrying it if it fails
+        """
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                await self.bucket.acquire()
+                try:
+                    return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
+                except (requests.RequestException, RetryableError) as e:
+                    if attempt == self.retries:
+                        raise
+                    delay = getattr(e, 'retry_after', None) or self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+                    logger.info('{} request failed ({}), retrying in {:.1f} s'.format(self.service, e, delay))
+            await asyncio.sleep(delay)
+
+    def _request(self, method, url, **kwargs):
+        response = self.session.request(method, url, timeout=kwargs.pop('timeout', 60), **kwargs)
+        if response.status_code in RETRY_STATUSES:
+            error = RetryableError('HTTP {} from {}'.format(response.status_code, url))
+            try:
+                error.retry_after = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                error.retry_after = None
+            raise error
+        return CachedResponse(response.status_code, response.text)
+
+    async def request(self, method, url, **kwargs):
+        key = (self.service, method, url, json.dumps({k: v for k, v in kwargs.items() if k != 'headers'}, sort_keys=True, default=str))
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+
+        response = await self.call(self._request, method, url, **kwargs)
+        if response.status_code == 200 and self.cache_ttl:
+            _cache_set(key, response, self.cache_ttl)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+async def gather_limited(coros, limit=GATHER_LIMIT):
+    """
+    Runs the coroutines together, at most limit at a time, and returns their
+    results in order, with the exception in place of the result for any that failed
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[limited(coro) for coro in coros], return_exceptions=True)
+
+
+def run(coro):
+    """
+    Runs a coroutine to completion from synchronous code
+    """
+    return asyncio.run(coro)
@@ -6,6 +6,7 @@ import requests
 import time
 import copy
 import logging
+from custom_code.brokers.async_http import ServiceClient, gather_limited, run
 
 logger = logging.getLogger(__name__)
 
@@ -42,11 +43,23 @@ class AlerceQuery:
         return ztfnames, coords
 
 
+    async def fetch_lightcurves(self):
+        client = ServiceClient('alerce')
+        return await gather_limited([
+            client.get('https://api.alerce.online/ztf/v1/objects/{}/lightcurve'.format(name), headers={'accept': 'application/json'})
+            for name in self.candidates
+        ])
+
+
     def get_photometry(self, *args, **kwargs):
         phot = {}
         nondets = {}
-        for name in self.candidates:
-            alerce_url = 'https://api.alerce.online/ztf/v1/objects/{}/lightcurve'.format(name)
+        ### Query Alerce for all the candidates at once
+        lightcurves = run(self.fetch_lightcurves())
+        for name, lc in zip(self.candidates, lightcurves):
+            if isinstance(lc, Exception):
+                logger.warning('Getting photometry for {} failed: {}'.format(name, lc))
+                continue
             
             g_dets = {}
             r_dets = {}
@@ -54,8 +67,6 @@ class AlerceQuery:
             g_nondets = {}
             r_nondets = {}
 
-            ### Query Alerce
-            lc = requests.get(alerce_url, headers={'accept': 'application/json'})
             try:
                 detections = json.loads(lc.text)['detections']
             except:
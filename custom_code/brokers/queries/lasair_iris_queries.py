@@ -4,6 +4,7 @@ import json
 from astropy.time import Time
 from datetime import datetime, timedelta
 import logging
+from custom_code.brokers.async_http import ServiceClient, gather_limited, run
 
 logger = logging.getLogger(__name__)
 
@@ -60,12 +61,21 @@ class LasairIrisQuery:
         return ztfnames, coords, redshifts, tnsnames, classes
 
 
+    async def fetch_lightcurves(self, L):
+        client = ServiceClient('lasair')
+        return await gather_limited([client.call(L.lightcurves, [name]) for name in self.candidates])
+
+
     def get_photometry(self, *args, **kwargs):
         phot = {}
         nondets = {}
         L = lasair(self.token)
-        for name in self.candidates:
-            lc = L.lightcurves([name])
+        ### Fetch the light curves for all the candidates at once
+        lightcurves = run(self.fetch_lightcurves(L))
+        for name, lc in zip(self.candidates, lightcurves):
+            if isinstance(lc, Exception):
+                logger.warning('Getting photometry for {} failed: {}'.format(name, lc))
+                continue
             g_dets = {}
             r_dets = {}
 
@@ -0,0 +1,147 @@
+"""
+Shared machinery for bulk-loading the galaxy catalogs.
+Catalogs are parsed a chunk at a time, and each chunk is inserted with
+bulk_create in its own transaction, after which a checkpoint records how
+far the ingestion got so an interrupted run can pick up where it stopped.
+"""
+import json
+import os
+import time
+import logging
+import numpy as np
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class IngestCheckpoint:
+    """
+    Records the position in a catalog file up to which rows have been committed
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, source):
+        """
+        Returns the committed position for source, or 0 if there is none
+        """
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('source') != os.path.abspath(source):
+            logger.warning('Ignoring checkpoint {}, which is for {}'.format(self.path, state.get('source')))
+            return 0
+        return int(state.get('position', 0))
+
+    def save(self, source, position):
+        if not self.path:
+            return
+        tmpfile = self.path + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'source': os.path.abspath(source), 'position': position}, f)
+        os.replace(tmpfile, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def null_to_nan(column, null='null'):
+    """
+    Converts a column of strings to floats, with NaN for null entries
+    """
+    column = np.asarray(column)
+    return np.where(column == null, 'nan', column).astype(float)
+
+
+def nan_to_none(values, cast=float):
+    """
+    Returns values as a list of Python numbers, with None for NaN or masked entries
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    return [None if v != v else cast(v) for v in values.tolist()]
+
+
+def masked_to_none(column):
+    """
+    Returns a (possibly masked) column of strings or bytes as a list of
+    stripped strings, with None for masked entries
+    """
+    column = np.ma.asarray(column)
+    mask = np.ma.getmaskarray(column).tolist()
+    values = []
+    for value, masked in zip(column.filled().tolist(), mask):
+        if masked:
+            values.append(None)
+        elif isinstance(value, bytes):
+            values.append(value.decode('utf-8', 'replace').strip())
+        else:
+            values.append(str(value).strip())
+    return values
+
+
+def write_chunk(model, objects, batch_size=5000, key=None):
+    """
+    Inserts objects with bulk_create. With key, rows whose key is already
+    in the table are updated in place instead, so loading the same catalog
+    again doesn't duplicate them
+    """
+    if key is None:
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        return
+
+    ### Later rows in the chunk win over earlier ones with the same key
+    unique = {}
+    unkeyed = []
+    for obj in objects:
+        value = getattr(obj, key)
+        if value is None:
+            unkeyed.append(obj)
+        else:
+            unique[value] = obj
+
+    existing = dict(model.objects.filter(**{'{}__in'.format(key): list(unique.keys())}).values_list(key, 'pk'))
+    to_update = []
+    to_create = unkeyed
+    for value, obj in unique.items():
+        if value in existing:
+            obj.pk = existing[value]
+            to_update.append(obj)
+        else:
+            to_create.append(obj)
+
+    fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+    model.objects.bulk_update(to_update, fields, batch_size=batch_size)
+    model.objects.bulk_create(to_create, batch_size=batch_size)
+
+
+def bulk_ingest(model, chunks, source, checkpoint=None, batch_size=5000, dry_run=False, stdout=None, key=None):
+    """
+    Inserts the rows from chunks, an iterable of (position, objects) where
+    position is how far into source the chunk reaches.
+
+    Each chunk is committed in its own transaction before the checkpoint
+    moves past it. With key, existing rows are upserted (see write_chunk).
+    With dry_run nothing is written, which measures the parsing
+    throughput on its own. Returns the number of rows handled
+    """
+    total = 0
+    start = time.perf_counter()
+    for position, objects in chunks:
+        if not dry_run:
+            with transaction.atomic():
+                write_chunk(model, objects, batch_size=batch_size, key=key)
+            if checkpoint:
+                checkpoint.save(source, position)
+        total += len(objects)
+
+        message = '{} {} rows ({:.0f} rows/s)'.format('Parsed' if dry_run else 'Ingested', total, total / max(time.perf_counter() - start, 1e-9))
+        logger.info(message)
+        if stdout:
+            stdout.write(message)
+
+    if checkpoint and not dry_run:
+        checkpoint.clear()
+    return total
@@ -13,7 +13,6 @@ from custom_code.models import ReducedDatumExtra, Papers
 import logging
 from django.templatetags.static import static
 from datetime import datetime, timedelta, timezone
-from astropy.time import Time
 from dash import no_update
 
 logger = logging.getLogger(__name__)
@@ -32,6 +31,9 @@ app.layout = html.Div([
         type='hidden',
         value=0
     ),
+    dcc.Store(
+        id='photometry-store'
+    ),
     dcc.Input(
         id='plot-width',
         type='hidden',
@@ -251,6 +253,113 @@ def update_algorithm_value(selected_subtraction):
 def update_template_value(selected_subtraction):
     return ['LCO', 'SDSS', 'PS1']
 
+FILTER_TRANSLATE = {'U': 'U', 'B': 'B', 'V': 'V',
+    'up': 'u', 'u': 'u', 'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
+    'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2',
+    'UVW1': 'UVW1'}
+
+
+def get_color(filter_name, filter_translate):
+    colors = {'U': 'rgb(59,0,113)',
+        'u': 'rgb(59,0,113)',
+        'B': 'rgb(0,87,255)',
+        'V': 'rgb(120,255,0)',
+        'g': 'rgb(0,204,255)',
+        'r': 'rgb(255,124,0)',
+        'i': 'rgb(144,0,43)',
+        'g_ZTF': 'rgb(0,204,255)',
+        'r_ZTF': 'rgb(255,124,0)',
+        'i_ZTF': 'rgb(144,0,43)',
+        'UVW2': '#FE0683',
+        'UVM2': '#BF01BC',
+        'UVW1': '#8B06FF',
+        'other': 'rgb(0,0,0)'}
+    try: color = colors[filter_translate[filter_name]]
+    except: color = colors['other']
+    return color
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_photometry(target_id):
+    """
+    Reads everything the plot needs for a target into columns, which are
+    kept in the photometry-store for the rest of the page's session
+    """
+    target = Target.objects.get(id=target_id)
+
+    columns = {'data_product_id': [], 'unix': [], 'magnitude': [], 'error': [], 'filter': [],
+               'subtracted': [], 'algorithm': [], 'template': [], 'reduction_type': []}
+    datums = ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', value__has_key='filter')
+    for data_product_id, timestamp, value in datums.values_list('data_product_id', 'timestamp', 'value'):
+        if not value:
+            continue
+        if isinstance(value, str):
+            value = json.loads(value)
+
+        ### Check if the value contains a magnitude (may not if the entry is 9999 in snex1)
+        if not value.get('magnitude', ''):
+            continue
+
+        columns['data_product_id'].append(data_product_id)
+        columns['unix'].append(timestamp.replace(tzinfo=timezone.utc).timestamp())
+        columns['magnitude'].append(_to_float(value.get('magnitude')))
+        columns['error'].append(_to_float(value.get('error', None)))
+        columns['filter'].append(FILTER_TRANSLATE.get(value.get('filter', ''), ''))
+        columns['subtracted'].append(value.get('background_subtracted', '') == True)
+        columns['algorithm'].append(str(value.get('subtraction_algorithm', '')))
+        columns['template'].append(str(value.get('template_source', '')))
+        columns['reduction_type'].append(str(value.get('reduction_type', '')))
+
+    ### Hover labels, built for all points at once (UTC MJD straight from the unix time)
+    unix = np.asarray(columns['unix'], dtype=float)
+    dates = np.asarray([datetime.fromtimestamp(t, timezone.utc).strftime('%m/%d/%Y') for t in unix.tolist()], dtype=str)
+    mjds = np.round(unix/86400.0 + 40587.0, 2).astype(str)
+    columns['text'] = np.char.add(np.char.add(np.char.add(dates, ' (MJD '), mjds), ')').tolist()
+
+    extras = []
+    for de_value in ReducedDatumExtra.objects.filter(target_id=target_id, key='upload_extras', data_type='photometry').values_list('value', flat=True):
+        de_value = json.loads(de_value)
+        extras.append({'instrument': de_value.get('instrument', ''),
+                       'photometry_type': de_value.get('photometry_type', ''),
+                       'final_reduction': de_value.get('final_reduction', ''),
+                       'reducer_group': de_value.get('reducer_group', ''),
+                       'used_in': de_value.get('used_in', ''),
+                       'data_product_id': _to_id(de_value.get('data_product_id', ''))})
+
+    spectra = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy').values_list('timestamp', flat=True)
+    redshift = target_extra_field(target, 'redshift')
+
+    return {
+        'datums': columns,
+        'extras': extras,
+        'papers': list(Papers.objects.filter(target_id=target_id).values_list('id', flat=True)),
+        'spectra': [t.replace(tzinfo=timezone.utc).timestamp() for t in spectra],
+        'redshift': _to_float(redshift) if redshift is not None else None
+    }
+
+
+#Load the photometry once, so toggling the options only has to slice it
+@app.callback(
+        Output('photometry-store', 'data'),
+        [Input('target_id', 'value')])
+def update_photometry_store(value):
+    logger.info('Loading dash lightcurve photometry for target %s', value)
+    return load_photometry(value)
+
+
 @app.callback(
         Output('lightcurve-plot', 'figure'),
         [Input('telescopes-checklist', 'value'),
@@ -262,41 +371,16 @@ def update_template_value(selected_subtraction):
          Input('final-reduction-checklist', 'value'),
          Input('papers-dropdown', 'value'),
          Input('reducer-group-checklist', 'value'),
-         Input('target_id', 'value'),
+         Input('photometry-store', 'data'),
          Input('plot-width', 'value'),
          Input('plot-height', 'value')])
-def update_graph(selected_telescope, subtracted_value, selected_algorithm, selected_template, selected_photometry_type, reduction_type, final_reduction_value, selected_paper, selected_groups, value, width, height):
-    def get_color(filter_name, filter_translate):
-        colors = {'U': 'rgb(59,0,113)',
-            'u': 'rgb(59,0,113)',
-            'B': 'rgb(0,87,255)',
-            'V': 'rgb(120,255,0)',
-            'g': 'rgb(0,204,255)',
-            'r': 'rgb(255,124,0)',
-            'i': 'rgb(144,0,43)',
-            'g_ZTF': 'rgb(0,204,255)',
-            'r_ZTF': 'rgb(255,124,0)',
-            'i_ZTF': 'rgb(144,0,43)',
-            'UVW2': '#FE0683',
-            'UVM2': '#BF01BC',
-            'UVW1': '#8B06FF',
-            'other': 'rgb(0,0,0)'}
-        try: color = colors[filter_translate[filter_name]]
-        except: color = colors['other']
-        return color
-
-    logger.info('Plotting dash lightcurve for target %s', value)
-    target_id = value
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'up': 'u', 'u': 'u', 'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2',
-        'UVW1': 'UVW1'}
-    photometry_data = {}
-    subtracted_photometry_data = {}
-    target = Target.objects.get(id=target_id)
-    datumextras = ReducedDatumExtra.objects.filter(target_id=target_id, key='upload_extras', data_type='photometry')
-    
-    datums = []
+def update_graph(selected_telescope, subtracted_value, selected_algorithm, selected_template, selected_photometry_type, reduction_type, final_reduction_value, selected_paper, selected_groups, photometry, width, height):
+    if not photometry:
+        return no_update
+
+    filter_translate = FILTER_TRANSLATE
+    columns = photometry['datums']
+    data_product_ids = np.asarray(columns['data_product_id'], dtype=float)
     
     ### Check if this is a final reduction or not
     if 'Final' in final_reduction_value:
@@ -305,79 +389,70 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
         final_reduction = False
 
     ### Get papers for this target
-    papers_for_target = [p.id for p in Papers.objects.filter(target_id=target_id)]
+    papers_for_target = photometry['papers']
 
     ### If both 'Aperture' and 'PSF' are selected photometry types,
     ### add 'Mixed' and 'Unsure' as well
     if len(selected_photometry_type) > 1:
-        selected_photometry_type += ['Mixed', 'Unsure']
+        selected_photometry_type = selected_photometry_type + ['Mixed', 'Unsure']
     
     ### Get the data for the selected telescope
     if not selected_telescope:
-        datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', value__has_key='filter'))
+        selected = np.ones(len(data_product_ids), dtype=bool)
+        have_datums = True
     
     else:
-        for de in datumextras:
-            de_value = json.loads(de.value)
+        dp_ids = []
+        for de_value in photometry['extras']:
 
             ### Test that this dataproduct meets the chosen criteria:
-            if all([de_value.get('instrument', '') in selected_telescope,
-                    de_value.get('photometry_type', '') in selected_photometry_type,
-                    (not final_reduction or de_value.get('final_reduction', '')==final_reduction),
-                    de_value.get('reducer_group', '') in selected_groups,
-                    (not selected_paper or de_value.get('used_in', '')==selected_paper or de_value.get('used_in', '') in papers_for_target)]):
-                dp_id = de_value.get('data_product_id', '')
-                datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id=dp_id, value__has_key='filter'))
+            if all([de_value['instrument'] in selected_telescope,
+                    de_value['photometry_type'] in selected_photometry_type,
+                    (not final_reduction or de_value['final_reduction']==final_reduction),
+                    de_value['reducer_group'] in selected_groups,
+                    (not selected_paper or de_value['used_in']==selected_paper or de_value['used_in'] in papers_for_target)]):
+                dp_ids.append(de_value['data_product_id'])
+        selected = np.isin(data_product_ids, [dp_id for dp_id in dp_ids if dp_id is not None])
+        have_datums = bool(dp_ids)
         
         ### Finally, get the data that was automatically uploaded from snex1 db
         if 'LCO' in selected_telescope and not final_reduction:
-            datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id__isnull=True, value__has_key='filter'))
+            selected |= np.isnan(data_product_ids)
+            have_datums = True
     
     ### Plot the data
-    if not datums:
+    if not have_datums:
         return 'No photometry yet'
-    
-    spec = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy')
-
-    for data in datums:
-        for rd in data:
-            value = rd.value
-            if not value:
-                continue
-            if isinstance(value, str):
-                value = json.loads(value)
-
-            ### Check if the value contains a magnitude (may not if the entry is 9999 in snex1)
-            if not value.get('magnitude', ''):
-                continue
-
-            ### Get subtracted or unsubtracted data
-            if value.get('background_subtracted', '') == True:
-                if value.get('subtraction_algorithm', '') in selected_algorithm and value.get('template_source', '') in selected_template and reduction_type == 'manual':
-                    
-                    subtracted_filt = filter_translate.get(value.get('filter', ''), '')
-
-                    subtracted_photometry_data.setdefault(subtracted_filt, {})
-                    subtracted_photometry_data[subtracted_filt].setdefault('time', []).append(rd.timestamp)
-                    subtracted_photometry_data[subtracted_filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-                    subtracted_photometry_data[subtracted_filt].setdefault('error', []).append(value.get('error', None))
-            elif value.get('reduction_type', '') == reduction_type or reduction_type == 'all':
-
-                filt = filter_translate.get(value.get('filter', ''), '')
-
-                photometry_data.setdefault(filt, {})
-                photometry_data[filt].setdefault('time', []).append(rd.timestamp)
-                photometry_data[filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-                photometry_data[filt].setdefault('error', []).append(value.get('error', None))
-
-    if subtracted_value == 'Unsubtracted':
-        selected_photometry = photometry_data
-    elif subtracted_value == 'Subtracted':
-        selected_photometry = subtracted_photometry_data
+
+    ### Get subtracted or unsubtracted data
+    subtracted = np.asarray(columns['subtracted'], dtype=bool)
+    if subtracted_value == 'Subtracted':
+        selected &= subtracted & np.isin(np.asarray(columns['algorithm'], dtype=str), selected_algorithm) \
+            & np.isin(np.asarray(columns['template'], dtype=str), selected_template) & (reduction_type == 'manual')
+    else:
+        selected &= ~subtracted
+        if reduction_type != 'all':
+            selected &= np.asarray(columns['reduction_type'], dtype=str) == reduction_type
+
+    now = datetime.now(timezone.utc).timestamp()
+    days_ago = (now - np.asarray(columns['unix'], dtype=float))/(24*3600)
+    magnitude = np.asarray(columns['magnitude'], dtype=float)
+    error = np.asarray(columns['error'], dtype=float)
+    text = np.asarray(columns['text'], dtype=str)
+    filters = np.asarray(columns['filter'], dtype=str)
+
+    ### One trace per filter, in the order the filters first appear
+    selected_index = np.flatnonzero(selected)
+    filter_names, first = np.unique(filters[selected_index], return_index=True)
+    selected_photometry = {}
+    for filter_name in filter_names[np.argsort(first)].tolist():
+        index = selected_index[filters[selected_index] == filter_name]
+        selected_photometry[filter_name] = {'days_ago': days_ago[index], 'magnitude': magnitude[index],
+                                            'error': error[index], 'text': text[index]}
 
     plot_data = [
         go.Scatter(
-            x=[(datetime.now(timezone.utc) - t.replace(tzinfo=timezone.utc)).total_seconds()/(24*3600) for t in filter_values['time']],
+            x=filter_values['days_ago'],
             y=filter_values['magnitude'], 
             mode='markers',
             marker=dict(color=get_color(filter_name, filter_translate),
@@ -390,17 +465,14 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
                 visible=True,
                 color=get_color(filter_name, filter_translate)
             ),
-            text=['{} (MJD {})'.format(t.strftime('%m/%d/%Y'), str(round(Time(t).mjd, 2))) for t in filter_values['time']],
+            text=filter_values['text'],
         ) for filter_name, filter_values in selected_photometry.items()]
 
-    if target_extra_field(target, 'redshift') is not None and float(target_extra_field(target, 'redshift')) > 0.01:
-        ydata = []
-        for filter_name, filter_values in selected_photometry.items():
-            if filter_name is not None:
-                ydata.append(np.asarray(filter_values['magnitude']) + np.asarray(filter_values['error']))
-                ydata.append(np.asarray(filter_values['magnitude']) - np.asarray(filter_values['error']))
-        if ydata:
-            ydata = np.concatenate(ydata)
+    redshift = photometry['redshift']
+    if redshift is not None and redshift > 0.01:
+        if selected_index.size:
+            ydata = np.concatenate([magnitude[selected_index] + error[selected_index],
+                                    magnitude[selected_index] - error[selected_index]])
             ymin = np.min(ydata)
             ymax = np.max(ydata)
             ymin_view = ymin - 0.05 * (ymax-ymin)
@@ -409,7 +481,7 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
             ymin_view = 0
             ymax_view = 0
 
-        dm = 5*np.log10(float(target_extra_field(target, 'redshift'))*3e5/70.0*1e6) - 5
+        dm = 5*np.log10(redshift*3e5/70.0*1e6) - 5
         yaxis2 = {'range': (ymax_view-dm, ymin_view-dm),
                   'showgrid': False,
                   'overlaying': 'y',
@@ -422,6 +494,7 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
 
     graph_data = {'data': plot_data}
 
+    spec_days_ago = ((now - np.asarray(photometry['spectra'], dtype=float))/(24*3600)).tolist()
     layout = go.Layout(
         xaxis=dict(autorange='reversed',gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
         yaxis=dict(autorange='reversed',gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
@@ -439,21 +512,19 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
                 y0=0,
                 y1=1,
                 xref='x',
-                x0=(datetime.now(timezone.utc) - s.timestamp.replace(tzinfo=timezone.utc)).total_seconds()/(24*3600),
-                x1=(datetime.now(timezone.utc) - s.timestamp.replace(tzinfo=timezone.utc)).total_seconds()/(24*3600),
+                x0=s,
+                x1=s,
                 opacity=0.2,
                 line=dict(color='black', dash='dash'),
-            ) for s in spec] + [{'type': 'line', 'yref': 'paper', 'y0': 0, 'y1': 1, 'xref': 'x',
+            ) for s in spec_days_ago] + [{'type': 'line', 'yref': 'paper', 'y0': 0, 'y1': 1, 'xref': 'x',
                                  'x0': 0.0, 'x1': 0.0, 'opacity': 0.001,
                                  'line': {'color': 'black', 'dash': 'dash'}
                             }] #Have to put this in so plotly doesn't autofit the axes after zoom
     )
 
     ### Set the minimum x-axis range to one day
-    min_xs = [min(filter_values['time']) for filter_values in selected_photometry.values()]
-
-    if len(min_xs) > 0:# and len(max_xs) > 0:
-        layout['xaxis']['range'] = [(datetime.now(timezone.utc) - min(min_xs).replace(tzinfo=timezone.utc)).total_seconds()/(24*3600)*1.06, 0]
+    if selected_index.size:
+        layout['xaxis']['range'] = [float(days_ago[selected_index].max())*1.06, 0]
         layout['xaxis']['autorange'] = False
         layout['xaxis']['title'] = 'Days Ago'
 
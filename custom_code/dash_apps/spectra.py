@@ -14,6 +14,7 @@ import json
 from django_plotly_dash import DjangoDash
 from tom_dataproducts.models import ReducedDatum
 from custom_code.templatetags.custom_code_tags import bin_spectra
+from custom_code.spectra import load_spectrum, spectra_queryset
 from django.templatetags.static import static
 import matplotlib.pyplot as plt
 
@@ -332,7 +333,7 @@ def display_output(selected_rows,
 
     # If the page just loaded, plot all the spectra
     if not fig_data['data']:
-        spectral_dataproducts = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy').order_by('timestamp')
+        spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy')).order_by('timestamp')
         if not spectral_dataproducts:
             return 'No spectra yet'
         colormap = plt.cm.gist_rainbow
@@ -345,20 +346,8 @@ def display_output(selected_rows,
         all_data = []
         for i in range(len(spectral_dataproducts)):
             spectrum = spectral_dataproducts[i]
-            datum = spectrum.value
-            wavelength = []
-            flux = []
             name = str(spectrum.timestamp).split(' ')[0]
-            if datum.get('photon_flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('photon_flux')
-            elif datum.get('flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('flux')
-            else:
-                for key, value in datum.items():
-                    wavelength.append(float(value['wavelength']))
-                    flux.append(float(value['flux']))
+            wavelength, flux = load_spectrum(spectrum)
             
             binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
             scatter_obj = go.Scatter(
@@ -7,7 +7,6 @@ import dash_html_components as html
 import plotly.graph_objs as go
 import numpy as np
 import json
-from statistics import median
 
 ### Jamie's Dash spectra plotting, currently a WIP
 ### Jamie: "lots of help from https://community.plot.ly/t/django-and-dash-eads-method/7717"
@@ -16,6 +15,7 @@ from django_plotly_dash import DjangoDash
 from tom_dataproducts.models import ReducedDatum
 from tom_targets.models import Target, TargetExtra
 from custom_code.templatetags.custom_code_tags import bin_spectra
+from custom_code.spectra import load_spectrum, spectra_queryset
 from django.db.models import Q
 from django.templatetags.static import static
 import matplotlib.pyplot as plt
@@ -453,7 +453,7 @@ def display_output(selected_rows,
             min_flux = 0
             max_flux = 0
 
-            spectrum = ReducedDatum.objects.get(id=spectrum_id)
+            spectrum = spectra_queryset(ReducedDatum.objects).get(id=spectrum_id)
        
             object_z_query = TargetExtra.objects.filter(target_id=spectrum.target_id,key='redshift').first()
             if not object_z_query:
@@ -464,23 +464,11 @@ def display_output(selected_rows,
             if not spectrum:
                 return 'No spectra yet'
                 
-            datum = spectrum.value
-            wavelength = []
-            flux = []
             name = str(spectrum.timestamp).split(' ')[0]
-            if datum.get('photon_flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('photon_flux')
-            elif datum.get('flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('flux')
-            else:
-                for key, value in datum.items():
-                    wavelength.append(float(value['wavelength']))
-                    flux.append(float(value['flux']))
+            wavelength, flux = load_spectrum(spectrum)
                     
-            median_flux = [f / median(flux) for f in flux]
-            if max(median_flux) > max_flux: max_flux = max(median_flux)
+            median_flux = flux / np.median(flux)
+            if median_flux.max() > max_flux: max_flux = median_flux.max()
 
             if not bin_factor:
                 bin_factor = 1
@@ -502,25 +490,13 @@ def display_output(selected_rows,
             else:
                 compare_z = float(compare_z_query.value)
 
-            spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
+            spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target=target, data_type='spectroscopy')).order_by('-timestamp')
             for spectrum in spectral_dataproducts:
-                datum = spectrum.value
-                wavelength = []
-                flux = []
                 name = target.name + ' --- ' +  str(spectrum.timestamp).split(' ')[0]
-                if datum.get('photon_flux'):
-                    wavelength = datum.get('wavelength')
-                    flux = datum.get('photon_flux')
-                elif datum.get('flux'):
-                    wavelength = datum.get('wavelength')
-                    flux = datum.get('flux')
-                else:
-                    for key, value in datum.items():
-                        wavelength.append(float(value['wavelength']))
-                        flux.append(float(value['flux']))
-                shifted_wavelength = [w * (1+object_z) / (1+compare_z) for w in wavelength]
-                median_flux = [f / median(flux) for f in flux]
-                if max(median_flux) > max_flux: max_flux = max(median_flux)
+                wavelength, flux = load_spectrum(spectrum)
+                shifted_wavelength = wavelength * (1+object_z) / (1+compare_z)
+                median_flux = flux / np.median(flux)
+                if median_flux.max() > max_flux: max_flux = median_flux.max()
                 
                 if not bin_factor:
                     bin_factor = 1
@@ -542,25 +518,13 @@ def display_output(selected_rows,
     # If the page just loaded, plot all the spectra
     if not graph_data['data']:
         logger.info('Plotting dash spectrum for dataproduct %s', spectrum_id)
-        spectrum = ReducedDatum.objects.get(id=spectrum_id)
+        spectrum = spectra_queryset(ReducedDatum.objects).get(id=spectrum_id)
  
         if not spectrum:
             return 'No spectra yet'
             
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = load_spectrum(spectrum)
         
         if not bin_factor:
             bin_factor = 1
@@ -580,25 +544,13 @@ def display_output(selected_rows,
             if d['name'] not in elements.keys():
                 graph_data['data'].remove(d)
 
-        spectrum = ReducedDatum.objects.get(id=spectrum_id)
+        spectrum = spectra_queryset(ReducedDatum.objects).get(id=spectrum_id)
 
         if not spectrum:
             return 'No spectra yet'
 
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = load_spectrum(spectrum)
 
         if 'mask' in mask_value:
             object_z_query = TargetExtra.objects.filter(target_id=spectrum.target_id,key='redshift').first()
@@ -609,7 +561,7 @@ def display_output(selected_rows,
 
             pfit = np.poly1d(np.polyfit(wavelength, flux, 4))
             for galaxy_wave in elements['Galaxy']['waves']:
-                mask = [abs(l-galaxy_wave*(1+object_z)) < 10 for l in wavelength]
+                mask = np.abs(wavelength - galaxy_wave*(1+object_z)) < 10
                 flux = np.ma.masked_array(flux, mask)
                 median_flux = np.ma.median(np.ma.masked_array(pfit(wavelength), np.logical_not(mask)))
                 flux = flux.filled(fill_value=median_flux)
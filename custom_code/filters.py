@@ -1,4 +1,5 @@
 from custom_code.models import TNSTarget, ScienceTags, TargetTags, BrokerTarget
+from custom_code.target_search import target_cone_search
 from tom_targets.models import Target, TargetList
 from tom_targets.filters import filter_for_field, TargetFilter
 from django.conf import settings
@@ -88,6 +89,28 @@ class CustomTargetFilter(TargetFilter):
     def filter_sciencetags(self, queryset, name, value):
         return queryset.filter(targettags__tag=value).distinct()
 
+    def filter_cone_search(self, queryset, name, value):
+        """
+        Same as the TOM Toolkit cone search, but picks candidates
+        with the indexed target HEALPix pixels
+        """
+        if name == 'cone_search':
+            ra, dec, radius = value.split(',')
+        elif name == 'target_cone_search':
+            target_name, radius = value.split(',')
+            targets = Target.objects.filter(
+                Q(name__icontains=target_name) | Q(aliases__name__icontains=target_name)
+            ).distinct()
+            if len(targets) == 1:
+                ra = targets[0].ra
+                dec = targets[0].dec
+            else:
+                return queryset.filter(name=None)
+        else:
+            return queryset
+
+        return target_cone_search(queryset, float(ra), float(dec), float(radius))
+
     class Meta:
         model = Target
         fields = ['name', 'cone_search', 'targetlist__name', 'sciencetags']
@@ -3,7 +3,8 @@ from tom_targets.models import Target, TargetExtra
 from tom_dataproducts.forms import DataProductUploadForm
 from tom_observations.widgets import FilterField
 from tom_dataproducts.models import DataProduct
-from guardian.shortcuts import assign_perm, get_groups_with_perms, remove_perm
+from guardian.shortcuts import get_groups_with_perms, remove_perm
+from custom_code.permissions import bulk_assign_perms
 from django import forms
 from custom_code.models import ScienceTags, TargetTags, Papers
 from django.conf import settings
@@ -41,10 +42,9 @@ class CustomTargetCreateForm(SiderealTargetCreateForm):
             #                defaults={'value': self.cleaned_data[field['name']]}
             #        )
             # Save groups for this target
-            for group in self.cleaned_data['groups']:
-                assign_perm('tom_targets.view_target', group, instance)
-                assign_perm('tom_targets.change_target', group, instance)
-                assign_perm('tom_targets.delete_target', group, instance)
+            bulk_assign_perms('tom_targets.view_target', self.cleaned_data['groups'], instance)
+            bulk_assign_perms('tom_targets.change_target', self.cleaned_data['groups'], instance)
+            bulk_assign_perms('tom_targets.delete_target', self.cleaned_data['groups'], instance)
             for group in get_groups_with_perms(instance):
                 if group not in self.cleaned_data['groups']:
                     remove_perm('tom_targets.view_target', group, instance)
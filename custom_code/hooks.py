@@ -15,19 +15,119 @@ import numpy as np
 from django.contrib.auth.models import User
 from django.conf import settings
 
-from sqlalchemy import create_engine, pool, and_, or_, not_
+from sqlalchemy import create_engine, pool, and_, or_, not_, text, MetaData
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.automap import automap_base
 from contextlib import contextmanager
 from collections import OrderedDict
+import hashlib
+import pickle
+import threading
 
 logger = logging.getLogger(__name__)
 
+### Engines and reflected tables are shared by every hook in the process,
+### so a hook call no longer pays for a new engine and a full automap reflection
+_engines = {}
+_automap_bases = {}
+_registry_lock = threading.Lock()
+### Held while reflecting, so threads that need the same schema wait for it instead of repeating it
+_reflection_lock = threading.Lock()
+
+
+def _get_engine(db_address):
+    """
+    Returns the pooled engine for db_address, creating it on first use
+    """
+    with _registry_lock:
+        engine = _engines.get(db_address)
+        if engine is None:
+            if db_address.startswith('sqlite'):
+                engine = create_engine(db_address, pool_pre_ping=True)
+            else:
+                engine = create_engine(db_address, poolclass=pool.QueuePool,
+                                       pool_size=getattr(settings, 'SNEX1_DB_POOL_SIZE', 5),
+                                       max_overflow=getattr(settings, 'SNEX1_DB_MAX_OVERFLOW', 5),
+                                       pool_recycle=3600, pool_pre_ping=True)
+            _engines[db_address] = engine
+    return engine
+
+
+def _schema_hash(engine):
+    """
+    Hashes the table and column definitions of the database,
+    used to key the on-disk reflection cache
+    """
+    if engine.dialect.name != 'mysql':
+        return None
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT table_name, column_name, column_type, column_key FROM information_schema.columns '
+            'WHERE table_schema = DATABASE() ORDER BY table_name, ordinal_position'
+        )).fetchall()
+    return hashlib.sha1(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()
+
+
+def _reflect_metadata(engine):
+    """
+    Reflects the database schema, going through a pickled copy
+    in SNEX1_SCHEMA_CACHE_DIR if that setting is configured
+    """
+    cache_dir = getattr(settings, 'SNEX1_SCHEMA_CACHE_DIR', None)
+    schema_hash = _schema_hash(engine) if cache_dir else None
+    if schema_hash:
+        cache_file = os.path.join(cache_dir, 'snex1_schema_{}.pickle'.format(schema_hash))
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    metadata = MetaData()
+    metadata.reflect(bind=engine)
+
+    if schema_hash:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(metadata, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            logger.warning('Could not write SNEx1 schema cache to {}'.format(cache_dir))
+
+    return metadata
+
+
+def _get_automap_base(db_address):
+    """
+    Returns the automapped classes for db_address, reflecting
+    the schema only the first time it is needed in this process
+    """
+    with _registry_lock:
+        Base = _automap_bases.get(db_address)
+    if Base is not None:
+        return Base
+
+    with _reflection_lock:
+        with _registry_lock:
+            Base = _automap_bases.get(db_address)
+        if Base is not None:
+            return Base
+
+        engine = _get_engine(db_address)
+        metadata = _reflect_metadata(engine)
+        Base = automap_base(metadata=metadata)
+        Base.prepare()
+
+        with _registry_lock:
+            _automap_bases[db_address] = Base
+    return Base
+
+
 @contextmanager
 def _get_session(db_address):
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.metadata.bind = engine
+    engine = _get_engine(db_address)
 
     db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
     session = db_session()
@@ -44,9 +144,7 @@ def _get_session(db_address):
 
 def _return_session(db_address='mysql://{}:{}@supernova.science.lco.global:3306/supernova?charset=utf8&use_unicode=1'.format(os.environ['SNEX1_DB_USER'], os.environ['SNEX1_DB_PASSWORD'])):
     ### This one is not run within a with loop, must be closed manually
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.metadata.bind = engine
+    engine = _get_engine(db_address)
 
     db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
     session = db_session()
@@ -55,9 +153,7 @@ def _return_session(db_address='mysql://{}:{}@supernova.science.lco.global:3306/
 
 
 def _load_table(tablename, db_address):
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.prepare(engine, reflect=True)
+    Base = _get_automap_base(db_address)
 
     table = getattr(Base.classes, tablename)
     return(table)
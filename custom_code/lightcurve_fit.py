@@ -0,0 +1,103 @@
+"""
+Quadratic fits to the peak of a light curve.
+Fits work on the per-filter MJD arrays from custom_code.lightcurves,
+select the fit window with a boolean mask, and are cached per target
+keyed on a fingerprint of the photometry being fit.
+"""
+import hashlib
+import logging
+import numpy as np
+from astropy.time import Time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LIGHTCURVE_FIT_CACHE_TIMEOUT = getattr(settings, 'LIGHTCURVE_CACHE_TIMEOUT', 60*60*24)
+FIT_POINTS = 100
+MJD_TO_JD = 2400000.5
+
+
+def choose_fit_filter(photometry_data, filt=None):
+    """
+    Returns the filter to fit: filt if given (None if there is no
+    photometry in it), otherwise the filter with the most points
+    """
+    if filt:
+        return filt if filt in photometry_data else None
+    if not photometry_data:
+        return None
+    return max(photometry_data, key=lambda f: len(photometry_data[f]['magnitude']))
+
+
+def fit_peak(mjd, magnitude, error, days=20):
+    """
+    Fits a weighted parabola to the points within days of the first one.
+    Returns a dict with the fitted curve ('fit_jd', 'fit_mag'), the vertex
+    of the parabola ('max_jd') and the brightest point on the fitted curve
+    ('peak_jd', 'peak_mag'). Raises if the fit can't be done
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    magnitude = np.asarray(magnitude, dtype=float)
+    error = np.asarray(error, dtype=float)
+
+    in_window = mjd < mjd.min() + days
+    x0 = mjd[in_window].min()
+    ### Fit in days since the first point, which is much better conditioned than raw JDs
+    x = mjd[in_window] - x0
+    A, B, C = np.polyfit(x, magnitude[in_window], 2, w=1/error[in_window])
+
+    fit_x = np.linspace(x.min(), x.max(), FIT_POINTS)
+    fit_mag = A*fit_x**2 + B*fit_x + C
+    peak = np.argmin(fit_mag)
+
+    return {
+        'fit_jd': fit_x + x0 + MJD_TO_JD,
+        'fit_mag': fit_mag,
+        'max_jd': float(abs(x0 + MJD_TO_JD - B/(2*A))),
+        'peak_jd': float(fit_x[peak] + x0 + MJD_TO_JD),
+        'peak_mag': float(fit_mag[peak])
+    }
+
+
+def _fit_cache_key(target_id, filt, days, column):
+    """
+    Cache key for a fit, changing whenever the points that would be fit do
+    """
+    digest = hashlib.sha1('{}|{}'.format(filt, days).encode())
+    for name in ('mjd', 'magnitude', 'error'):
+        digest.update(np.ascontiguousarray(column[name], dtype=float).tobytes())
+    return 'lightcurve_fit_{}_{}'.format(target_id, digest.hexdigest())
+
+
+def get_lightcurve_fit(target, photometry_data, filt, days=20):
+    """
+    Returns the fit_peak result for filt in photometry_data, as returned
+    by custom_code.lightcurves.get_lightcurve, or None if the fit failed
+    """
+    column = photometry_data[filt]
+    key = _fit_cache_key(target.id, filt, days, column)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached['fit']
+
+    try:
+        fit = fit_peak(column['mjd'], column['magnitude'], column['error'], days=days)
+    except Exception as e:
+        logger.info(e)
+        logger.info('Quadratic light curve fit failed for target {}'.format(target.id))
+        fit = None
+    else:
+        ### Fits through bad points (e.g. missing errors) come out NaN
+        if not np.isfinite(fit['max_jd']) or not np.isfinite(fit['peak_mag']):
+            logger.info('Quadratic light curve fit failed for target {}'.format(target.id))
+            fit = None
+    cache.set(key, {'fit': fit}, LIGHTCURVE_FIT_CACHE_TIMEOUT)
+    return fit
+
+
+def fit_isot(jds):
+    """
+    ISO times for an array of JDs, in one conversion
+    """
+    return Time(jds, format='jd', scale='utc').isot
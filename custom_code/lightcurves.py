@@ -0,0 +1,199 @@
+"""
+Per-target cache of the photometry shown by the light curve template tags.
+The decoded points are stored once per target as per-filter arrays,
+along with which groups and users may view each point, and are
+filtered per request instead of re-querying and re-parsing every datum.
+"""
+import json
+import hashlib
+import numpy as np
+from astropy.time import Time
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Count, Max, CharField, TextField, Value, Func
+from django.db.models.functions import Cast, Concat
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from tom_dataproducts.models import ReducedDatum
+
+LIGHTCURVE_CACHE_TIMEOUT = getattr(settings, 'LIGHTCURVE_CACHE_TIMEOUT', 60*60*24)
+
+FILTER_TRANSLATE = {'U': 'U', 'B': 'B', 'V': 'V',
+    'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
+    'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2',
+    'UVW1': 'UVW1'}
+
+
+def get_lightcurve_cache_key(target_id):
+    return 'lightcurve_{}'.format(target_id)
+
+
+def _photometry_queryset(target_id):
+    return ReducedDatum.objects.filter(target_id=target_id, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
+
+
+def _photometry_digest(queryset):
+    """
+    Hash of the timestamps and values of the datums in queryset, computed
+    in the database on PostgreSQL so the values don't have to be fetched
+    """
+    row = Concat(Cast('pk', TextField()), Value('|'), Cast('timestamp', TextField()), Value('|'), Cast('value', TextField()),
+                 output_field=TextField())
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.aggregates import StringAgg
+        return queryset.aggregate(
+            digest=Func(StringAgg(row, delimiter='\n', ordering='pk'), function='MD5', output_field=CharField())
+        )['digest']
+    digest = hashlib.md5()
+    for text in queryset.order_by('pk').annotate(row=row).values_list('row', flat=True):
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def _permission_summary(model, content_type, datum_pks):
+    summary = model.objects.filter(
+        content_type=content_type,
+        permission__codename='view_reduceddatum',
+        object_pk__in=datum_pks
+    ).aggregate(count=Count('pk'), max_pk=Max('pk'))
+    return (summary['count'], summary['max_pk'])
+
+
+def _photometry_fingerprint(target_id):
+    """
+    Summary of the photometry for a target and of who may view it.
+    It covers the datum values and the view permissions on them, so rows
+    written or rewritten outside the ORM (e.g. by sync_databases), which
+    fire no signals, also invalidate the cache, whichever process wrote them
+    """
+    queryset = _photometry_queryset(target_id)
+    summary = queryset.aggregate(count=Count('pk'), max_pk=Max('pk'))
+    content_type = ContentType.objects.get_for_model(ReducedDatum)
+    datum_pks = queryset.annotate(object_pk=Cast('pk', CharField())).values('object_pk')
+    return (summary['count'], summary['max_pk'], _photometry_digest(queryset),
+            _permission_summary(GroupObjectPermission, content_type, datum_pks),
+            _permission_summary(UserObjectPermission, content_type, datum_pks))
+
+
+def _permission_index(model, owner_field, content_type, pk_positions):
+    """
+    Returns {group or user id: array of positions} for the view permissions on the datums
+    """
+    index = {}
+    perms = model.objects.filter(
+        content_type=content_type,
+        permission__codename='view_reduceddatum',
+        object_pk__in=[str(pk) for pk in pk_positions]
+    ).values_list('object_pk', owner_field)
+    for object_pk, owner_id in perms:
+        index.setdefault(owner_id, []).append(pk_positions[int(object_pk)])
+    return {owner_id: np.asarray(positions, dtype=np.int64) for owner_id, positions in index.items()}
+
+
+def build_lightcurve(target_id):
+    """
+    Decodes all the photometry for a target into per-filter columns
+    """
+    columns = {}
+    for pk, timestamp, value in _photometry_queryset(target_id).order_by('pk').values_list('pk', 'timestamp', 'value'):
+        if not value:  # empty
+            continue
+        if isinstance(value, str):
+            value = json.loads(value)
+
+        filt = FILTER_TRANSLATE.get(value.get('filter', ''), '')
+        column = columns.setdefault(filt, {'pk': [], 'time': [], 'magnitude': [], 'error': [], 'limit': [], 'telescope': []})
+        column['pk'].append(pk)
+        column['time'].append(timestamp)
+        column['magnitude'].append(value.get('magnitude', None))
+        column['error'].append(value.get('error', None))
+        column['limit'].append('limit' in value)
+        column['telescope'].append(value.get('telescope', ''))
+
+    content_type = ContentType.objects.get_for_model(ReducedDatum)
+    lightcurve = {}
+    for filt, column in columns.items():
+        pk_positions = {pk: i for i, pk in enumerate(column['pk'])}
+        lightcurve[filt] = {
+            'pk': np.asarray(column['pk'], dtype=np.int64),
+            'time': np.asarray(column['time'], dtype=object),
+            'mjd': np.asarray(Time(column['time'], scale='utc').mjd, dtype=float),
+            'magnitude': np.asarray(column['magnitude'], dtype=float),
+            'error': np.asarray(column['error'], dtype=float),
+            'limit': np.asarray(column['limit'], dtype=bool),
+            'telescope': np.asarray(column['telescope'], dtype=object),
+            'groups': _permission_index(GroupObjectPermission, 'group_id', content_type, pk_positions),
+            'users': _permission_index(UserObjectPermission, 'user_id', content_type, pk_positions)
+        }
+    return lightcurve
+
+
+def _visible_mask(column, user, group_ids):
+    mask = np.zeros(len(column['pk']), dtype=bool)
+    for group_id in group_ids:
+        positions = column['groups'].get(group_id)
+        if positions is not None:
+            mask[positions] = True
+    positions = column['users'].get(getattr(user, 'id', None))
+    if positions is not None:
+        mask[positions] = True
+    return mask
+
+
+def get_lightcurve(target, user):
+    """
+    Returns {filter: {'time', 'mjd', 'magnitude', 'error', 'limit', 'telescope'}}
+    for the photometry of target that user is allowed to view
+    """
+    key = get_lightcurve_cache_key(target.id)
+    fingerprint = _photometry_fingerprint(target.id)
+    cached = cache.get(key)
+    if cached is None or cached['fingerprint'] != fingerprint:
+        cached = {'fingerprint': fingerprint, 'lightcurve': build_lightcurve(target.id)}
+        cache.set(key, cached, LIGHTCURVE_CACHE_TIMEOUT)
+
+    see_all = settings.TARGET_PERMISSIONS_ONLY or user.is_superuser or user.has_perm('tom_dataproducts.view_reduceddatum')
+    if not see_all:
+        group_ids = set(user.groups.values_list('id', flat=True)) if user.is_authenticated else set()
+
+    photometry_data = {}
+    for filt, column in cached['lightcurve'].items():
+        if see_all:
+            mask = np.ones(len(column['pk']), dtype=bool)
+        else:
+            mask = _visible_mask(column, user, group_ids)
+        if not mask.any():
+            continue
+        photometry_data[filt] = {
+            'time': column['time'][mask].tolist(),
+            'mjd': column['mjd'][mask],
+            'magnitude': column['magnitude'][mask],
+            'error': column['error'][mask],
+            'limit': column['limit'][mask],
+            'telescope': column['telescope'][mask]
+        }
+    return photometry_data
+
+
+def invalidate_lightcurves(target_ids):
+    cache.delete_many([get_lightcurve_cache_key(target_id) for target_id in target_ids])
+
+
+@receiver([post_save, post_delete], sender=ReducedDatum)
+def invalidate_lightcurve_cache(sender, instance, **kwargs):
+    if instance.data_type == settings.DATA_PRODUCT_TYPES['photometry'][0]:
+        cache.delete(get_lightcurve_cache_key(instance.target_id))
+
+
+@receiver([post_save, post_delete], sender=GroupObjectPermission)
+@receiver([post_save, post_delete], sender=UserObjectPermission)
+def invalidate_lightcurve_permissions(sender, instance, **kwargs):
+    if instance.content_type_id != ContentType.objects.get_for_model(ReducedDatum).id:
+        return
+    target_id = ReducedDatum.objects.filter(pk=instance.object_pk).values_list('target_id', flat=True).first()
+    if target_id is not None:
+        cache.delete(get_lightcurve_cache_key(target_id))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import PhotometrySnexId
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Fills the PhotometrySnexId table from the snex_id stored in photometry ReducedDatum values'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of ReducedDatums to read per batch')
+
+
+    def handle(self, *args, **options):
+
+        batch_size = options['batch_size']
+        existing_ids = set(PhotometrySnexId.objects.values_list('reduced_datum_id', flat=True))
+
+        last_pk = 0
+        count = 0
+        while True:
+            batch = list(ReducedDatum.objects.filter(
+                data_type='photometry', pk__gt=last_pk
+            ).order_by('pk').values_list('pk', 'value')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            new_rows = []
+            for pk, value in batch:
+                if pk in existing_ids or not value:
+                    continue
+                if isinstance(value, str):
+                    value = json.loads(value)
+                snex_id = value.get('snex_id', '')
+                if snex_id == '' or snex_id is None:
+                    continue
+                new_rows.append(PhotometrySnexId(snex_id=int(snex_id), reduced_datum_id=pk))
+
+            with transaction.atomic():
+                PhotometrySnexId.objects.bulk_create(new_rows, batch_size=batch_size)
+            count += len(new_rows)
+
+        logger.info('Added {} photometry SNEx1 ids'.format(count))
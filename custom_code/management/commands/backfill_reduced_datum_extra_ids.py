@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import ReducedDatumExtra
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Fills the indexed reduced_datum and snex_id columns of ReducedDatumExtra from their JSON values'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of ReducedDatumExtras to read per batch')
+
+
+    def handle(self, *args, **options):
+
+        batch_size = options['batch_size']
+
+        last_pk = 0
+        count = 0
+        while True:
+            batch = list(ReducedDatumExtra.objects.filter(
+                pk__gt=last_pk, value__contains='snex', reduced_datum__isnull=True, snex_id__isnull=True
+            ).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            for extra in batch:
+                extra.set_indexed_ids(check_datum=False)
+
+            ### Don't point at datums that have since been deleted
+            datum_ids = set(ReducedDatum.objects.filter(
+                pk__in=[extra.reduced_datum_id for extra in batch if extra.reduced_datum_id]
+            ).values_list('pk', flat=True))
+            for extra in batch:
+                if extra.reduced_datum_id not in datum_ids:
+                    extra.reduced_datum_id = None
+
+            updated = [extra for extra in batch if extra.reduced_datum_id or extra.snex_id is not None]
+            with transaction.atomic():
+                ReducedDatumExtra.objects.bulk_update(updated, ['reduced_datum', 'snex_id'], batch_size=batch_size)
+            count += len(updated)
+
+        logger.info('Filled indexed ids for {} ReducedDatumExtras'.format(count))
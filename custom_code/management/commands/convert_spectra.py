@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import SpectrumArrays
+from custom_code.spectra import spectrum_from_value, encode_array
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Stores binary wavelength and flux arrays for spectra that only have JSON values'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Number of spectra to convert per batch')
+        parser.add_argument('--all', action='store_true', help='Rewrite the arrays for spectra that already have them')
+
+
+    def handle(self, *args, **options):
+
+        batch_size = options['batch_size']
+        spectra = ReducedDatum.objects.filter(data_type='spectroscopy')
+        if not options['all']:
+            spectra = spectra.filter(spectrum_arrays__isnull=True)
+
+        last_pk = 0
+        count = 0
+        failed = 0
+        while True:
+            batch = list(spectra.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'value')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            rows = []
+            for pk, value in batch:
+                try:
+                    wavelength, flux = spectrum_from_value(value)
+                except Exception as e:
+                    logger.warning('Could not convert spectrum {}: {}'.format(pk, e))
+                    failed += 1
+                    continue
+                rows.append(SpectrumArrays(reduced_datum_id=pk, wavelength=encode_array(wavelength), flux=encode_array(flux), npoints=len(flux)))
+
+            with transaction.atomic():
+                SpectrumArrays.objects.filter(reduced_datum_id__in=[row.reduced_datum_id for row in rows]).delete()
+                SpectrumArrays.objects.bulk_create(rows, batch_size=batch_size)
+            count += len(rows)
+
+        logger.info('Converted {} spectra ({} failed)'.format(count, failed))
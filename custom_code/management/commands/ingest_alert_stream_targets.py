@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand
 import logging
-import requests
-import time
+import asyncio
 import json
 from django.db.models import Q
 from tom_targets.models import Target
@@ -9,7 +8,7 @@ from custom_code.models import TNSTarget, BrokerTarget
 from custom_code.brokers.queries.alerce_queries import BasicAlerceQuery
 from custom_code.brokers.queries.lasair_iris_queries import LasairIrisQuery
 from custom_code.brokers.queries.tns_target_queries import TNSTargetQuery
-import urllib.request
+from custom_code.brokers.async_http import ServiceClient, gather_limited, run
 import os
 from django.conf import settings
 
@@ -21,22 +20,26 @@ with open(os.path.join(BASE_DIR, 'custom_code/brokers/queries/queries.json'), 'r
     QUERIES = json.load(f)
 
 
-def ned_conesearch(ra, dec, rad):
+def tns_headers():
+    tns_id = os.environ['TNS_APIID']
+    return {'User-Agent': 'tns_marker{"tns_id":'+str(tns_id)+', "type":"bot", "name":"SNEx_Bot1"}'}
+
+
+async def ned_conesearch(client, ra, dec, rad):
     ### Conesearch of NED given RA and Dec, in degrees, and radius, in arcmin
 
     ned_url = 'http://ned.ipac.caltech.edu/cgi-bin/objsearch?search_type=Near+Position+Search&in_csys=Equatorial&in_equinox=J2000.0&lon={}d&lat={}d&radius={}&out_csys=Equatorial&out_equinox=J2000.0&of=ascii_bar'.format(ra, dec, rad)
     
-    with urllib.request.urlopen(ned_url) as u:
-        output = u.read().decode('utf-8')
+    response = await client.get(ned_url)
 
-    return output
+    return response.text
 
 
-def ned_get_first_redshift(ra, dec, rad):
+async def ned_get_first_redshift(client, ra, dec, rad):
     ### Return the first redshift for a NED source with the given
     ### cone search parameters
 
-    results = ned_conesearch(ra, dec, rad)
+    results = await ned_conesearch(client, ra, dec, rad)
     lines = results.split('\n')
 
     for line in lines:
@@ -52,64 +55,85 @@ def ned_get_first_redshift(ra, dec, rad):
     return False
 
 
-def ingest_targets(q, stream_name):
-    targets_to_ingest = q.candidates
-    for name in targets_to_ingest:
-        ### First, see if target is already in the database
-        brokertargetquery = BrokerTarget.objects.filter(name=name)
-        if brokertargetquery.first(): # Target exists
-            continue
-        coords = q.coords[name]
-        ra = coords[0]
-        dec = coords[1]
+async def tns_search(client, ra, dec, name, photometry=0, classification=0):
+    ### Find the TNS object at these coordinates with this internal name,
+    ### and return its name and TNS object data (or None if not found)
 
-        try:
-            z = q.redshifts[name]['z']
-            z_source = q.redshifts[name]['source']
-            if not z_source:
-                z_source = ''
-        except:
-            logger.info('Looking up redshift from NED')
-            z = False
+    search_url = "https://www.wis-tns.org/api/get/search"
+    obj_url = "https://www.wis-tns.org/api/get/object"
+    api_key = os.environ['TNS_APIKEY']
 
-        if not z:
-            z = ned_get_first_redshift(ra, dec, 1.0)
-            if z:
-                z_source = 'NED'
-            else:
-                z_source = ''
+    json_list = {'ra': str(ra), 'dec': str(dec), 'radius': '5', 'units': 'arcsec', 'internal_name': name}
+    obj_list = await client.post(search_url, headers=tns_headers(), data={'api_key': api_key, 'data': json.dumps(json_list)})
+    obj_list = obj_list.json()['data']['reply']
+    if not obj_list:
+        return None, None
 
-        try:
-            tns_name = q.tnsnames['name']
-        except:
-            tns_name = False
+    tns_name = obj_list[0]['objname']
+    class_json_list = {'objname': tns_name, 'photometry': photometry, 'spectra': 0, 'classification': classification}
+    obj_data = await client.post(obj_url, headers=tns_headers(), data={'api_key': api_key, 'data': json.dumps(class_json_list)})
+    return tns_name, obj_data.json()['data']['reply']
 
-        try:
-            sn_class = q.classes['name']
-        except:
-            search_url = "https://www.wis-tns.org/api/get/search"
-            obj_url = "https://www.wis-tns.org/api/get/object"
-            api_key = os.environ['TNS_APIKEY']
-            tns_id = os.environ['TNS_APIID']
-
-            json_list = {'ra': str(ra), 'dec': str(dec), 'radius': '5', 'units': 'arcsec', 'internal_name': name}
-            obj_list = requests.post(search_url, headers={'User-Agent': 'tns_marker{"tns_id":'+str(tns_id)+', "type":"bot", "name":"SNEx_Bot1"}'}, data={'api_key': api_key, 'data': json.dumps(json_list)})
-            obj_list = json.loads(obj_list.text)['data']['reply']
-            if obj_list:
-                tns_name = obj_list[0]['objname']
-
-                class_json_list = {'objname': tns_name, 'photometry': 0, 'spectra': 0, 'classification': 1}
-                obj_data = requests.post(obj_url, headers={'User-Agent': 'tns_marker{"tns_id":'+str(tns_id)+', "type":"bot", "name":"SNEx_Bot1"}'}, data={'api_key': api_key, 'data': json.dumps(class_json_list)})
-                obj_data = json.loads(obj_data.text)['data']['reply']
-                if obj_data:
-                    sn_class = obj_data['object_type']['name']
-                else:
-                    sn_class = ''
-            else:
-                sn_class = ''
-        
+
+async def lookup_candidate(clients, q, name):
+    ### Look up the redshift and classification of a new candidate,
+    ### if the broker query didn't already give them
+
+    ra, dec = q.coords[name]
+    info = {}
+
+    try:
+        info['z'] = q.redshifts[name]['z']
+        info['z_source'] = q.redshifts[name]['source']
+        if not info['z_source']:
+            info['z_source'] = ''
+    except:
+        logger.info('Looking up redshift from NED')
+        info['z'] = False
+
+    if not info['z']:
+        info['z'] = await ned_get_first_redshift(clients['ned'], ra, dec, 1.0)
+        if info['z']:
+            info['z_source'] = 'NED'
+        else:
+            info['z_source'] = ''
+
+    info['tns_name'] = getattr(q, 'tnsnames', {}).get(name, False)
+    info['sn_class'] = getattr(q, 'classes', {}).get(name)
+
+    if info['sn_class'] is None:
+        tns_name, obj_data = await tns_search(clients['tns'], ra, dec, name, classification=1)
         if tns_name:
-            tns_target = TNSTarget.objects.filter(name=tns_name).first()
+            info['tns_name'] = tns_name
+        if obj_data:
+            info['sn_class'] = obj_data['object_type']['name']
+        else:
+            info['sn_class'] = ''
+
+    return info
+
+
+async def lookup_candidates(q, names):
+    clients = {'ned': ServiceClient('ned'), 'tns': ServiceClient('tns')}
+    return await gather_limited([lookup_candidate(clients, q, name) for name in names])
+
+
+def ingest_targets(q, stream_name):
+    ### First, see which targets are already in the database
+    existing_names = set(BrokerTarget.objects.filter(name__in=q.candidates).values_list('name', flat=True))
+    targets_to_ingest = [name for name in q.candidates if name not in existing_names]
+
+    ### Then look them all up at once
+    lookups = run(lookup_candidates(q, targets_to_ingest))
+
+    for name, info in zip(targets_to_ingest, lookups):
+        if isinstance(info, Exception):
+            logger.warning('Looking up candidate {} failed: {}'.format(name, info))
+            continue
+        ra, dec = q.coords[name]
+
+        if info['tns_name']:
+            tns_target = TNSTarget.objects.filter(name=info['tns_name']).first()
             if not tns_target:
                 tns_target = None
         else:
@@ -122,9 +146,9 @@ def ingest_targets(q, stream_name):
                 name=name,
                 ra=ra,
                 dec=dec,
-                redshift=z,
-                redshift_source=z_source,
-                classification=sn_class,
+                redshift=info['z'],
+                redshift_source=info['z_source'],
+                classification=info['sn_class'],
                 tns_target=tns_target,
                 stream_name=stream_name,
                 detections=det,
@@ -133,7 +157,24 @@ def ingest_targets(q, stream_name):
         )
         newbrokertarget.save()
 
-        time.sleep(6) # To avoid spamming the TNS API endpoint
+
+async def fetch_new_data(objs):
+    ### Get the ALeRCE light curves and TNS photometry for existing broker targets
+
+    alerce = ServiceClient('alerce')
+    tns = ServiceClient('tns')
+
+    async def fetch_ztf(obj):
+        if 'ZTF' not in obj.name and 'ztf' not in obj.name:
+            return None
+        url = 'http://api.alerce.online/ztf/v1/objects/{}/lightcurve'.format(obj.name)
+        r = await alerce.get(url, headers={'accept': 'application/json'})
+        return r.json()['detections']
+
+    return await asyncio.gather(
+        gather_limited([fetch_ztf(obj) for obj in objs]),
+        gather_limited([tns_search(tns, obj.ra, obj.dec, obj.name, photometry=1) for obj in objs])
+    )
 
 
 class Command(BaseCommand):
@@ -141,8 +182,10 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         ### Search for new data for existing targets that are new or interesting
-        brokertargetlist = BrokerTarget.objects.filter(status__in=['New', 'Interesting'])
-        for obj in brokertargetlist:
+        brokertargetlist = list(BrokerTarget.objects.filter(status__in=['New', 'Interesting']).select_related('tns_target'))
+        ztf_results, tns_results = run(fetch_new_data(brokertargetlist))
+
+        for obj, ztf_result, tns_result in zip(brokertargetlist, ztf_results, tns_results):
 
             ### Check if target exists in SNEx2, and update status if it does
             targetname_matchlist = Target.objects.filter(Q(name__icontains=obj.name) | Q(aliases__name__icontains=obj.name)).distinct().first()
@@ -153,44 +196,29 @@ class Command(BaseCommand):
                 obj.save()
             
             ### First ingest the ZTF data
-            if 'ZTF' in obj.name or 'ztf' in obj.name:
+            if isinstance(ztf_result, Exception):
+                logger.info('Getting MARS ZTF photometry failed for {}'.format(obj.name))
+            elif ztf_result is not None:
                 filters = {1: 'g', 2: 'r', 3: 'i'}
-                url = 'http://api.alerce.online/ztf/v1/objects/{}/lightcurve'.format(obj.name)
-                try:
-                    r = requests.get(url, headers={'accept': 'application/json'})
-                    results = json.loads(r.text)['detections']
-                    det = json.loads(obj.detections)
-                    
-                    for alert in results:
-                        if all([key in alert for key in ['mjd', 'magpsf', 'fid', 'sigmapsf']]):
-                            mjd = str(alert['mjd'])
-                            filt = filters[alert['fid']]
-                            det.setdefault(filt, {})
-                            if mjd not in det[filt].keys():
-                                det[filt][mjd] = [float(alert['magpsf']), float(['sigmapsf'])]
-                    
-                    obj.detections = json.dumps(det)
-                    obj.save()
-
-                except:
-                    logger.info('Getting MARS ZTF photometry failed for {}'.format(obj.name))
+                det = json.loads(obj.detections)
+                
+                for alert in ztf_result:
+                    if all([key in alert for key in ['mjd', 'magpsf', 'fid', 'sigmapsf']]):
+                        mjd = str(alert['mjd'])
+                        filt = filters[alert['fid']]
+                        det.setdefault(filt, {})
+                        if mjd not in det[filt].keys():
+                            det[filt][mjd] = [float(alert['magpsf']), float(alert['sigmapsf'])]
+                
+                obj.detections = json.dumps(det)
+                obj.save()
 
             ### Now the TNS data
-            search_url = "https://www.wis-tns.org/api/get/search"
-            obj_url = "https://www.wis-tns.org/api/get/object"
-            api_key = os.environ['TNS_APIKEY']
-            tns_id = os.environ['TNS_APIID']
-
-            json_list = {'ra': str(obj.ra), 'dec': str(obj.dec), 'radius': '5', 'units': 'arcsec', 'internal_name': obj.name}
-            obj_list = requests.post(search_url, headers={'User-Agent': 'tns_marker{"tns_id":'+str(tns_id)+', "type":"bot", "name":"SNEx_Bot1"}'}, data={'api_key': api_key, 'data': json.dumps(json_list)})
-            obj_list = json.loads(obj_list.text)['data']['reply']
-            if obj_list:
-                tns_name = obj_list[0]['objname']
-
-                class_json_list = {'objname': tns_name, 'photometry': 1, 'spectra': 0, 'classification': 0}
-                obj_data = requests.post(obj_url, headers={'User-Agent': 'tns_marker{"tns_id":'+str(tns_id)+', "type":"bot", "name":"SNEx_Bot1"}'}, data={'api_key': api_key, 'data': json.dumps(class_json_list)})
-                obj_data = json.loads(obj_data.text)['data']['reply']
-                
+            if isinstance(tns_result, Exception):
+                logger.info('Getting TNS photometry failed for {}'.format(obj.name))
+                continue
+            tns_name, obj_data = tns_result
+            if tns_name:
                 det = json.loads(obj.detections)
                 nondet = json.loads(obj.nondetections)
                 for phot in obj_data['photometry']:
@@ -218,8 +246,6 @@ class Command(BaseCommand):
                         obj.tns_target = tns_target
                         obj.save()
 
-            time.sleep(6)
-
         logger.info('Finished ingesting new data for existing targets')
         
         ### Get the targets from the queries
@@ -79,12 +79,10 @@ def get_comments(targetid, tablename, notes, users, days_ago):
 
             elif tablename == 'spec':
                 # Need to get reduceddatum id from the reduceddatumextra table
-                rdes = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', target_id=int(comment.targetid))
+                rde = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', target_id=int(comment.targetid), snex_id=int(comment.tableid)).first()
                 snex2_id = False
-                for rde in rdes:
-                    if int(comment.tableid) == json.loads(rde.value)['snex_id']:
-                        snex2_id = json.loads(rde.value)['snex2_id']
-                        break
+                if rde and rde.reduced_datum_id:
+                    snex2_id = rde.reduced_datum_id
                 if snex2_id:
                     # Check if it already exists in SNEx2
                     old_comment = Comment.objects.filter(object_pk=snex2_id, comment=comment.note, content_type_id=content_dict[tablename]).first()
@@ -1,5 +1,100 @@
 from custom_code.models import GladeCatalog
-from django.core.management.base import BaseCommand
+from custom_code.spatial import radec_to_healpix
+from custom_code.catalog_ingest import IngestCheckpoint, bulk_ingest, null_to_nan, nan_to_none
+from django.core.management.base import BaseCommand, CommandError
+from itertools import islice
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+### Columns of the GLADE+ text file after the GLADE number, in order
+COLUMNS = [('pgc_no', 'int'), ('gwgc_name', 'str'), ('hyperleda_name', 'str'), ('twomass_name', 'str'),
+           ('wisexscos_name', 'str'), ('sdss_dr16q_name', 'str'), ('object_type_flag', 'str'),
+           ('ra', 'float'), ('dec', 'float')]
+
+### These go in the mag JSONField
+MAG_COLUMNS = [('B', 'float'), ('B_err', 'float'), ('B_flag', 'int'), ('B_abs', 'float'), ('J', 'float'),
+               ('J_err', 'float'), ('H', 'float'), ('H_err', 'float'), ('K', 'float'), ('K_err', 'float'),
+               ('W1', 'float'), ('W1_err', 'float'), ('W2', 'float'), ('W2_err', 'float'), ('W1_flag', 'int'),
+               ('B_J', 'float'), ('B_J_err', 'float')]
+
+COLUMNS_TWO = [('z_helio', 'float'), ('z_cmb', 'float'), ('z_flag', 'int'), ('v_err', 'float'), ('z_err', 'float'),
+               ('d_l', 'float'), ('d_l_err', 'float'), ('dist_flag', 'int'), ('m_star', 'float'),
+               ('m_star_err', 'float'), ('m_star_flag', 'int'), ('merger_rate', 'float'), ('merger_rate_err', 'float')]
+
+NCOLUMNS = 1 + len(COLUMNS) + len(MAG_COLUMNS) + len(COLUMNS_TWO)
+
+
+def convert_column(column, column_type):
+    """
+    Converts a column of strings from the file, with None (or '' for names) for nulls
+    """
+    if column_type == 'str':
+        return ['' if value == 'null' else value for value in column.tolist()]
+    return nan_to_none(null_to_nan(column), cast=int if column_type == 'int' else float)
+
+
+def parse_chunk(lines):
+    """
+    Returns GladeCatalog objects for a chunk of lines from the file
+    """
+    rows = [line.split() for line in lines]
+    table = np.array([row[:NCOLUMNS] for row in rows if len(row) >= NCOLUMNS])
+    if len(table) < len(rows):
+        logger.warning('Skipping {} malformed lines'.format(len(rows) - len(table)))
+    if not len(table):
+        return []
+
+    columns = {}
+    offset = 1
+    for name, column_type in COLUMNS:
+        columns[name] = table[:, offset]
+        offset += 1
+    mag_columns = {}
+    for name, column_type in MAG_COLUMNS:
+        mag_columns[name] = convert_column(table[:, offset], column_type)
+        offset += 1
+    for name, column_type in COLUMNS_TWO:
+        columns[name] = table[:, offset]
+        offset += 1
+
+    ### Galaxies without a position can't be stored
+    ra = null_to_nan(columns.pop('ra'))
+    dec = null_to_nan(columns.pop('dec'))
+    good = np.isfinite(ra) & np.isfinite(dec)
+    if not good.all():
+        logger.warning('Skipping {} galaxies without a position'.format(np.count_nonzero(~good)))
+    ra, dec = ra[good], dec[good]
+    healpix = radec_to_healpix(ra, dec)
+
+    values = {name: convert_column(columns[name][good], column_type)
+              for name, column_type in COLUMNS + COLUMNS_TWO if name in columns}
+    good_index = np.flatnonzero(good).tolist()
+    mags = [{name: mag_columns[name][i] for name, _ in MAG_COLUMNS if mag_columns[name][i] is not None} for i in good_index]
+
+    names = list(values.keys())
+    return [
+        GladeCatalog(ra=float(ra[i]), dec=float(dec[i]), healpix=int(healpix[i]), mag=mags[i],
+                     **{name: values[name][i] for name in names})
+        for i in range(len(ra))
+    ]
+
+
+def read_chunks(f, chunk_size, start=0):
+    """
+    Yields (lines read so far, GladeCatalog objects) for each chunk of lines after the first start
+    """
+    for _ in islice(f, start):
+        pass
+    position = start
+    while True:
+        lines = list(islice(f, chunk_size))
+        if not lines:
+            break
+        position += len(lines)
+        yield position, parse_chunk(lines)
 
 
 class Command(BaseCommand):
@@ -8,73 +103,31 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--filename', help='Ingest catalog information from this file')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Number of lines parsed and committed at a time')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of rows per INSERT')
+        parser.add_argument('--checkpoint', help='Checkpoint file used to resume an interrupted ingestion (default: <filename>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore any checkpoint and start from the top of the file')
+        parser.add_argument('--dry-run', action='store_true', help='Parse the file and report the throughput without writing anything')
 
 
     def handle(self, *args, **options):
 
         filename = options['filename']
+        if not filename:
+            raise CommandError('--filename is required')
+
+        checkpoint = IngestCheckpoint(options['checkpoint'] or filename + '.checkpoint')
+        start = 0
+        if options['restart']:
+            checkpoint.clear()
+        elif not options['dry_run']:
+            start = checkpoint.load(filename)
+            if start:
+                self.stdout.write('Resuming {} after line {}'.format(filename, start))
 
         with open(filename, 'r') as f:
+            total = bulk_ingest(GladeCatalog, read_chunks(f, options['chunk_size'], start=start), filename,
+                                checkpoint=checkpoint, batch_size=options['batch_size'],
+                                dry_run=options['dry_run'], stdout=self.stdout)
 
-            lines = f.readlines()
-            column_names = ['pgc_no', 'gwgc_name', 'hyperleda_name', 'twomass_name', 
-                            'wisexscos_name', 'sdss_dr16q_name', 'object_type_flag',
-                            'ra', 'dec']
-
-            column_types = ['int', 'str', 'str', 'str', 'str', 'str', 'str', 'float', 'float']
-
-            mag_dict_keys = ['B', 'B_err', 'B_flag', 'B_abs', 'J', 'J_err', 'H', 'H_err',
-                             'K', 'K_err', 'W1', 'W1_err', 'W2', 'W2_err', 'W1_flag', 'B_J',
-                             'B_J_err']
-
-            column_names_two = ['z_helio', 'z_cmb', 'z_flag', 'v_err', 'z_err', 'd_l', 'd_l_err',
-                                'dist_flag', 'm_star', 'm_star_err', 'm_star_flag', 'merger_rate',
-                                'merger_rate_err']
-
-            column_types_two = ['float', 'float', 'int', 'float', 'float', 'float', 'float', 'int',
-                                'float', 'float', 'int', 'float', 'float']
-            
-            for line in lines:
-                ### Insert into database
-                x = line.split()
-                param_dict = {}
-
-                for i in range(len(column_names)):
-                    if x[i+1] != 'null':
-
-                        if column_types[i] == 'int':
-                            param_dict[column_names[i]] = int(x[i+1])
-
-                        elif column_types[i] == 'float':
-                            param_dict[column_names[i]] = float(x[i+1])
-
-                        else:
-                            param_dict[column_names[i]] = x[i+1]
-
-                mag_dict = {}
-
-                for i in range(len(mag_dict_keys)):
-                    if x[i+len(column_names)+1] != 'null' and 'flag' not in mag_dict_keys[i]:
-                        
-                        mag_dict[mag_dict_keys[i]] = float(x[i+len(column_names)+1])
-                    
-                    elif x[i+len(column_names)+1] != 'null':
-
-                        mag_dict[mag_dict_keys[i]] = int(x[i+len(column_names)+1])
-
-                param_dict['mag'] = mag_dict
-
-                for i in range(len(column_names_two)):
-                    if x[i+len(column_names)+len(mag_dict_keys)+1] != 'null':
-
-                        if column_types_two[i] == 'int':
-                            param_dict[column_names_two[i]] = int(x[i+len(column_names)+len(mag_dict_keys)+1])
-
-                        elif column_types_two[i] == 'float':
-                            param_dict[column_names_two[i]] = float(x[i+len(column_names)+len(mag_dict_keys)+1])
-
-                        else:
-                            param_dict[column_names_two[i]] = x[i+len(column_names)+len(mag_dict_keys)+1]
-
-                g = GladeCatalog(**param_dict)
-                g.save()
+        self.stdout.write('Done: {} galaxies {}'.format(total, 'parsed' if options['dry_run'] else 'ingested'))
@@ -1,8 +1,99 @@
 from custom_code.models import NEDLVSCatalog
-from django.core.management.base import BaseCommand
-from astropy.io import fits
-from astropy.table import Table, Column
+from custom_code.spatial import radec_to_healpix
+from custom_code.catalog_ingest import IngestCheckpoint, bulk_ingest, nan_to_none, masked_to_none
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from astropy.table import Table
 import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+### Model fields for the catalog columns that aren't stored in dicts, in file order
+TABLE_COLUMN_NAMES = ['name', 'ra', 'dec', 'object_type', 'z', 'z_err', 'z_tech', 'z_qual',
+                      'z_qual_flag', 'z_refcode', 'z_dist', 'z_dist_err', 'z_dist_method',
+                      'z_dist_indicator', 'z_dist_refcode', 'd_l', 'd_l_err', 'dist_method',
+                      'ebv', 'galex_phot', 'tmass_phot', 'wise_phot', 'et_flag', 'm_star',
+                      'm_star_err', 'ml_ratio']
+
+
+def split_columns(colnames):
+    """
+    Sorts the catalog columns into the plain ones and those saved in each JSONField
+    """
+    dict_columns = {'extinction': [], 'mag': [], 'lum': [], 'sfr': []}
+    plain = []
+    for name in colnames:
+        if 'A_' in name:
+            dict_columns['extinction'].append(name)
+        elif 'Lum_' in name: # This one has to come before the next because 'm_' is in 'Lum_'
+            dict_columns['lum'].append(name)
+        elif 'm_' in name:
+            dict_columns['mag'].append(name)
+        elif 'SFR_' in name:
+            dict_columns['sfr'].append(name)
+        else:
+            plain.append(name)
+    return plain, dict_columns
+
+
+def convert_column(column, field):
+    """
+    Converts a table column to a list of values for a model field, with None for masked or NaN entries
+    """
+    if isinstance(field, models.BooleanField):
+        return nan_to_none(column, cast=bool)
+    if isinstance(field, models.FloatField):
+        return nan_to_none(column)
+    return masked_to_none(column)
+
+
+def parse_chunk(chunk, plain, dict_columns):
+    """
+    Returns NEDLVSCatalog objects for a slice of the catalog table
+    """
+    values = {}
+    for model_name, column_name in zip(TABLE_COLUMN_NAMES, plain):
+        if model_name in ('ra', 'dec'):
+            continue
+        values[model_name] = convert_column(chunk[column_name], NEDLVSCatalog._meta.get_field(model_name))
+
+    dicts = {}
+    for model_name, column_names in dict_columns.items():
+        dict_values = {name: nan_to_none(chunk[name]) for name in column_names}
+        dicts[model_name] = [dict(zip(column_names, row)) for row in zip(*dict_values.values())] if column_names else [{} for _ in range(len(chunk))]
+
+    ### Galaxies without a position can't be stored
+    positions = dict(zip(TABLE_COLUMN_NAMES, plain))
+    ra = np.ma.filled(np.ma.asarray(chunk[positions['ra']], dtype=float), np.nan)
+    dec = np.ma.filled(np.ma.asarray(chunk[positions['dec']], dtype=float), np.nan)
+    good = np.isfinite(ra) & np.isfinite(dec)
+    if not good.all():
+        logger.warning('Skipping {} galaxies without a position'.format(np.count_nonzero(~good)))
+    healpix = np.zeros(len(ra), dtype=np.int64)
+    healpix[good] = radec_to_healpix(ra[good], dec[good])
+
+    fields = list(values.keys()) + list(dicts.keys())
+    columns = [values[name] for name in values] + [dicts[name] for name in dicts]
+    return [
+        NEDLVSCatalog(ra=float(ra[i]), dec=float(dec[i]), healpix=int(healpix[i]),
+                      **dict(zip(fields, (column[i] for column in columns))))
+        for i in np.flatnonzero(good).tolist()
+    ]
+
+
+def read_chunks(table, chunk_size, start=0):
+    """
+    Yields (rows read so far, NEDLVSCatalog objects) for each slice of the table after the first start rows
+    """
+    plain, dict_columns = split_columns(table.colnames)
+    if len(plain) != len(TABLE_COLUMN_NAMES):
+        raise CommandError('Expected {} catalog columns outside the dicts, found {}'.format(len(TABLE_COLUMN_NAMES), len(plain)))
+
+    for position in range(start, len(table), chunk_size):
+        chunk = table[position:position+chunk_size]
+        yield position + len(chunk), parse_chunk(chunk, plain, dict_columns)
 
 
 class Command(BaseCommand):
@@ -11,64 +102,33 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--filename', help='Ingest catalog information from this file')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Number of rows converted and committed at a time')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of rows per INSERT')
+        parser.add_argument('--upsert', action='store_true', help='Update galaxies already in the database (matched by name) instead of adding them again')
+        parser.add_argument('--checkpoint', help='Checkpoint file used to resume an interrupted ingestion (default: <filename>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore any checkpoint and start from the first row')
+        parser.add_argument('--dry-run', action='store_true', help='Convert the catalog and report the throughput without writing anything')
 
 
     def handle(self, *args, **options):
 
         filename = options['filename']
+        if not filename:
+            raise CommandError('--filename is required')
+
+        checkpoint = IngestCheckpoint(options['checkpoint'] or filename + '.checkpoint')
+        start = 0
+        if options['restart']:
+            checkpoint.clear()
+        elif not options['dry_run']:
+            start = checkpoint.load(filename)
+            if start:
+                self.stdout.write('Resuming {} after row {}'.format(filename, start))
+
+        t = Table.read(filename, hdu=1, memmap=True) #Catalog in a fits file
+
+        total = bulk_ingest(NEDLVSCatalog, read_chunks(t, options['chunk_size'], start=start), filename,
+                            checkpoint=checkpoint, batch_size=options['batch_size'], dry_run=options['dry_run'],
+                            stdout=self.stdout, key='name' if options['upsert'] else None)
 
-        h = fits.open(filename) #Catalog in a fits file
-
-        t = Table(h[1].data) #Load as astropy Table
-        colnames = t.colnames
-
-        # We're saving some values in JSONFields, so we want to get those colnames
-        extinctionnames = []
-        magnames = []
-        lumnames = []
-        sfrnames = []
-        for name in colnames[:]:
-            if 'A_' in name:
-                extinctionnames.append(name)
-                colnames.remove(name)
-            elif 'Lum_' in name: # This one has to come before the next because 'm_' is in 'Lum_'
-                lumnames.append(name)
-                colnames.remove(name)
-            elif 'm_' in name:
-                magnames.append(name)
-                colnames.remove(name)
-            elif 'SFR_' in name:
-                sfrnames.append(name)
-                colnames.remove(name)
-        
-        newt = t[colnames] # Make a copy of the table without the columns that are going into dicts
-        extt = t[extinctionnames] # Make separate tables for each set of dict values
-        magt = t[magnames]
-        lumt = t[lumnames]
-        sfrt = t[sfrnames]
-
-        # Make the dicts
-        extdict = [dict(zip(extinctionnames, row)) for row in extt]
-        magdict = [dict(zip(magnames, row)) for row in magt]
-        lumdict = [dict(zip(lumnames, row)) for row in lumt]
-        sfrdict = [dict(zip(sfrnames, row)) for row in sfrt]
-
-        # Add these dicts back as columns in the new table
-        extcol = Column(extdict, name='extinction')
-        magcol = Column(magdict, name='mag')
-        lumcol = Column(lumdict, name='lum')
-        sfrcol = Column(sfrdict, name='sfr')
-        newt.add_columns([extcol, magcol, lumcol, sfrcol])
-
-        tablecolnames = ['name', 'ra', 'dec', 'object_type', 'z', 'z_err', 'z_tech', 'z_qual',
-                         'z_qual_flag', 'z_refcode', 'z_dist', 'z_dist_err', 'z_dist_method',
-                         'z_dist_indicator', 'z_dist_refcode', 'd_l', 'd_l_err', 'dist_method', 
-                         'ebv', 'galex_phot', 'tmass_phot', 'wise_phot', 'et_flag', 'm_star', 
-                         'm_star_err', 'ml_ratio', 'extinction', 'mag', 'lum', 'sfr']
-
-        # Make dictionaries using the model column names and the rows of the new table
-        rows_to_add = [dict(zip(tablecolnames, row)) for row in newt]
-
-        for row in rows_to_add:
-            o = NEDLVSCatalog(**row) # Add rows to the db
-            o.save()
+        self.stdout.write('Done: {} galaxies {}'.format(total, 'converted' if options['dry_run'] else 'ingested'))
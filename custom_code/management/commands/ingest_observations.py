@@ -16,7 +16,7 @@ from django.core.management.base import BaseCommand
 from tom_observations.models import ObservationRecord, ObservationGroup, DynamicCadence
 from tom_targets.models import Target
 from django.contrib.auth.models import Group
-from guardian.shortcuts import assign_perm
+from custom_code.permissions import bulk_assign_perms
 
 
 _SNEX1_DB = 'mysql://{}:{}@supernova.science.lco.global:3306/supernova?charset=utf8&use_unicode=1'.format(os.environ.get('SNEX1_DB_USER'), os.environ.get('SNEX1_DB_PASSWORD'))
@@ -98,10 +98,8 @@ def update_permissions(groupid, obs, snex1_groups):
     
     target_groups = powers_of_two(groupid)
 
-    for g_name, g_id in snex1_groups.items():
-        if g_id in target_groups:
-            snex2_group = Group.objects.filter(name=g_name).first()
-            assign_perm('view_observationrecord', snex2_group, obs)
+    group_names = [g_name for g_name, g_id in snex1_groups.items() if g_id in target_groups]
+    bulk_assign_perms('tom_observations.view_observationrecord', Group.objects.filter(name__in=group_names), obs)
 
 
 def get_snex2_params(obs, repeating=True):
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from tom_common.hooks import run_hook
+from tom_targets.models import Target
+from custom_code.thumbnails import make_thumbs, default_thumb_request, THUMB_WORKERS
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Renders the default image thumbnails for targets so pages never have to wait on them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target_id', type=int, nargs='*', help='Only pre-warm these targets (default: all)')
+        parser.add_argument('--allimages', action='store_true', help='Render every image, not just the latest 8')
+        parser.add_argument('--workers', type=int, default=THUMB_WORKERS, help='Number of rendering processes')
+
+
+    def handle(self, *args, **options):
+
+        if options['target_id']:
+            target_ids = options['target_id']
+        else:
+            target_ids = Target.objects.order_by('-modified').values_list('id', flat=True)
+
+        count = 0
+        failed = 0
+        for target_id in target_ids:
+            try:
+                filepaths, filenames, dates, teles, filters, exptimes, psfxs, psfys = run_hook('find_images_from_snex1', target_id, allimages=options['allimages'])
+            except Exception as e:
+                logger.warning('Finding images in snex1 failed for target {}: {}'.format(target_id, e))
+                continue
+
+            batch = [default_thumb_request(filepaths[i], filenames[i], psfxs[i], psfys[i]) for i in range(len(filenames))]
+            if not batch:
+                continue
+
+            outfiles = make_thumbs(batch, max_workers=options['workers'])
+            count += sum(1 for f in outfiles if f)
+            failed += sum(1 for f in outfiles if not f)
+
+        logger.info('Pre-warmed {} thumbnails ({} failed)'.format(count, failed))
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models, transaction
+from custom_code.spatial import radec_to_healpix
+
+
+BATCH_SIZE = 10000
+
+
+def backfill_healpix(apps, schema_editor):
+    ### Each batch is committed on its own (the migration isn't atomic), so the
+    ### catalogs aren't rewritten in one huge transaction and an interrupted
+    ### backfill picks up the rows still missing a pixel when migrate is rerun
+    for model_name in ['GladeCatalog', 'NEDLVSCatalog']:
+        model = apps.get_model('custom_code', model_name)
+        last_pk = 0
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_pk, healpix__isnull=True).order_by('pk')[:BATCH_SIZE])
+            if not batch:
+                break
+            ipix = radec_to_healpix([row.ra for row in batch], [row.dec for row in batch])
+            for row, pixel in zip(batch, ipix):
+                row.healpix = int(pixel)
+            with transaction.atomic():
+                model.objects.bulk_update(batch, ['healpix'], batch_size=BATCH_SIZE)
+            last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('custom_code', '0010_timeused'),
+        ('custom_code', '0011_nedlvscatalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gladecatalog',
+            name='healpix',
+            field=models.IntegerField(blank=True, db_index=True, help_text='NESTED HEALPix pixel (nside=1024) containing this galaxy, used for cone searches', null=True, verbose_name='HEALPix index'),
+        ),
+        migrations.AddField(
+            model_name='nedlvscatalog',
+            name='healpix',
+            field=models.IntegerField(blank=True, db_index=True, help_text='NESTED HEALPix pixel (nside=1024) containing this galaxy, used for cone searches', null=True, verbose_name='HEALPix index'),
+        ),
+        migrations.RunPython(backfill_healpix, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0001_initial'),
+        ('custom_code', '0012_catalog_healpix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotometrySnexId',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snex_id', models.IntegerField(db_index=True, help_text='ID of the row in the SNEx1 photlco table', verbose_name='SNEx1 ID')),
+                ('reduced_datum', models.ForeignKey(help_text='The photometry ReducedDatum synced from this row', on_delete=django.db.models.deletion.CASCADE, to='tom_dataproducts.reduceddatum')),
+            ],
+        ),
+    ]
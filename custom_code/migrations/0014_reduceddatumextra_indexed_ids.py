@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0001_initial'),
+        ('custom_code', '0013_photometrysnexid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reduceddatumextra',
+            name='reduced_datum',
+            field=models.ForeignKey(blank=True, help_text='The ReducedDatum this information is about (the snex2_id in the value), if applicable', null=True, on_delete=django.db.models.deletion.CASCADE, to='tom_dataproducts.reduceddatum'),
+        ),
+        migrations.AddField(
+            model_name='reduceddatumextra',
+            name='snex_id',
+            field=models.IntegerField(blank=True, db_index=True, help_text='ID of the corresponding row in SNEx1 (the snex_id in the value), if applicable', null=True, verbose_name='SNEx1 ID'),
+        ),
+    ]
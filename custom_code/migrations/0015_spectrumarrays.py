@@ -0,0 +1,24 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0001_initial'),
+        ('custom_code', '0014_reduceddatumextra_indexed_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpectrumArrays',
+            fields=[
+                ('reduced_datum', models.OneToOneField(help_text='The spectroscopy ReducedDatum these arrays hold', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='spectrum_arrays', serialize=False, to='tom_dataproducts.reduceddatum')),
+                ('wavelength', models.BinaryField(help_text='Wavelengths, as a NumPy .npy blob', verbose_name='Wavelength')),
+                ('flux', models.BinaryField(help_text='Fluxes, as a NumPy .npy blob', verbose_name='Flux')),
+                ('npoints', models.IntegerField(default=0, help_text='Number of points in the spectrum', verbose_name='Number of Points')),
+            ],
+        ),
+    ]
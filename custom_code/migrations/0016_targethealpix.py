@@ -0,0 +1,45 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+from custom_code.spatial import radec_to_healpix
+
+
+BATCH_SIZE = 10000
+
+
+def backfill_target_healpix(apps, schema_editor):
+    Target = apps.get_model('tom_targets', 'Target')
+    TargetHealpix = apps.get_model('custom_code', 'TargetHealpix')
+    last_pk = 0
+    while True:
+        batch = list(Target.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'ra', 'dec')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        batch = [row for row in batch if row[1] is not None and row[2] is not None]
+        if not batch:
+            continue
+        ipix = radec_to_healpix([row[1] for row in batch], [row[2] for row in batch])
+        TargetHealpix.objects.bulk_create([
+            TargetHealpix(target_id=row[0], healpix=int(pixel)) for row, pixel in zip(batch, ipix)
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('custom_code', '0015_spectrumarrays'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetHealpix',
+            fields=[
+                ('target', models.OneToOneField(help_text='The target this pixel locates', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='healpix_index', serialize=False, to='tom_targets.target')),
+                ('healpix', models.IntegerField(db_index=True, help_text='NESTED HEALPix pixel (nside=1024) containing this target, used for cone searches', verbose_name='HEALPix index')),
+            ],
+        ),
+        migrations.RunPython(backfill_target_healpix, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_code', '0016_targethealpix'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nedlvscatalog',
+            name='name',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Preferred object name in NED', max_length=100, null=True, verbose_name='Preferred NED name'),
+        ),
+    ]
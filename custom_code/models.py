@@ -1,7 +1,9 @@
 from django.db import models
+import json
 from tom_dataproducts.models import ReducedDatum
 from tom_targets.models import Target
 from django.contrib.auth.models import User
+from custom_code.spatial import radec_to_healpix, cone_search_queryset
 
 # Create your models here.
 
@@ -105,6 +107,14 @@ class ReducedDatumExtra(models.Model):
         null=True, blank=True, verbose_name='Boolean Value',
         help_text='Boolean value of the information being stored, if applicable'
     )
+    reduced_datum = models.ForeignKey(
+        ReducedDatum, null=True, blank=True, on_delete=models.CASCADE,
+        help_text='The ReducedDatum this information is about (the snex2_id in the value), if applicable'
+    )
+    snex_id = models.IntegerField(
+        null=True, blank=True, db_index=True, verbose_name='SNEx1 ID',
+        help_text='ID of the corresponding row in SNEx1 (the snex_id in the value), if applicable'
+    )
 
     class Meta:
         get_latest_by = ('id,')
@@ -113,6 +123,31 @@ class ReducedDatumExtra(models.Model):
     def __str__(self):
         return f'{self.key}: {self.value}'
 
+    def set_indexed_ids(self, check_datum=True):
+        """
+        Copy the snex_id and snex2_id out of a JSON value into their indexed columns.
+        The snex2_id is only copied if that ReducedDatum exists, unless
+        check_datum is False and the caller checks them in bulk
+        """
+        try:
+            value = json.loads(self.value)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(value, dict):
+            return
+        if self.reduced_datum_id is None and value.get('snex2_id') not in (None, ''):
+            try:
+                datum_id = int(value['snex2_id'])
+            except (TypeError, ValueError):
+                datum_id = None
+            if datum_id is not None and (not check_datum or ReducedDatum.objects.filter(pk=datum_id).exists()):
+                self.reduced_datum_id = datum_id
+        if self.snex_id is None and value.get('snex_id') not in (None, ''):
+            try:
+                self.snex_id = int(value['snex_id'])
+            except (TypeError, ValueError):
+                pass
+
     def save(self, *args, **kwargs):
         try:
             self.float_value = float(self.value)
@@ -122,10 +157,59 @@ class ReducedDatumExtra(models.Model):
             self.bool_value = bool(self.value)
         except (TypeError, ValueError, OverflowError):
             self.bool_value = None
+        self.set_indexed_ids()
 
         super().save(*args, **kwargs)
 
 
+class PhotometrySnexId(models.Model):
+
+    snex_id = models.IntegerField(
+        db_index=True, verbose_name='SNEx1 ID', help_text='ID of the row in the SNEx1 photlco table'
+    )
+    reduced_datum = models.ForeignKey(
+        ReducedDatum, on_delete=models.CASCADE, help_text='The photometry ReducedDatum synced from this row'
+    )
+
+    def __str__(self):
+        return f'{self.snex_id}: {self.reduced_datum_id}'
+
+
+class SpectrumArrays(models.Model):
+
+    reduced_datum = models.OneToOneField(
+        ReducedDatum, on_delete=models.CASCADE, primary_key=True, related_name='spectrum_arrays',
+        help_text='The spectroscopy ReducedDatum these arrays hold'
+    )
+    wavelength = models.BinaryField(
+        verbose_name='Wavelength', help_text='Wavelengths, as a NumPy .npy blob'
+    )
+    flux = models.BinaryField(
+        verbose_name='Flux', help_text='Fluxes, as a NumPy .npy blob'
+    )
+    npoints = models.IntegerField(
+        default=0, verbose_name='Number of Points', help_text='Number of points in the spectrum'
+    )
+
+    def __str__(self):
+        return f'Spectrum {self.reduced_datum_id} ({self.npoints} points)'
+
+
+class TargetHealpix(models.Model):
+
+    target = models.OneToOneField(
+        Target, on_delete=models.CASCADE, primary_key=True, related_name='healpix_index',
+        help_text='The target this pixel locates'
+    )
+    healpix = models.IntegerField(
+        db_index=True, verbose_name='HEALPix index',
+        help_text='NESTED HEALPix pixel (nside=1024) containing this target, used for cone searches'
+    )
+
+    def __str__(self):
+        return f'{self.target_id}: {self.healpix}'
+
+
 class ScienceTags(models.Model):
 
     tag = models.TextField(
@@ -255,6 +339,16 @@ class BrokerTarget(models.Model):
     )
 
 
+class CatalogQuerySet(models.QuerySet):
+
+    def cone_search(self, ra, dec, radius):
+        """
+        Returns the rows within radius degrees of ra, dec,
+        using the indexed healpix column to pick candidates
+        """
+        return cone_search_queryset(self, ra, dec, radius)
+
+
 class GladeCatalog(models.Model):
 
     pgc_no = models.IntegerField(
@@ -357,11 +451,23 @@ class GladeCatalog(models.Model):
         blank=True, null=True, help_text='Absolute error of estimated BNS merger rate in galaxy'
     )
 
+    healpix = models.IntegerField(
+        blank=True, null=True, db_index=True, verbose_name='HEALPix index',
+        help_text='NESTED HEALPix pixel (nside=1024) containing this galaxy, used for cone searches'
+    )
+
+    objects = CatalogQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self.healpix is None:
+            self.healpix = radec_to_healpix(self.ra, self.dec)
+        super().save(*args, **kwargs)
+
 
 class NEDLVSCatalog(models.Model):
 
     name = models.CharField(
-        max_length=100, default='', blank=True, null=True, verbose_name='Preferred NED name',
+        max_length=100, default='', blank=True, null=True, db_index=True, verbose_name='Preferred NED name',
         help_text='Preferred object name in NED'
     )
 
@@ -499,6 +605,18 @@ class NEDLVSCatalog(models.Model):
         help_text='The mass-to-light ratio used to calculate m_star (Section 2.4 of Cook et al.)'
     )
 
+    healpix = models.IntegerField(
+        blank=True, null=True, db_index=True, verbose_name='HEALPix index',
+        help_text='NESTED HEALPix pixel (nside=1024) containing this galaxy, used for cone searches'
+    )
+
+    objects = CatalogQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self.healpix is None:
+            self.healpix = radec_to_healpix(self.ra, self.dec)
+        super().save(*args, **kwargs)
+
 
 class TimeUsed(models.Model):
     semester_name = models.TextField(
@@ -0,0 +1,73 @@
+"""
+Shared moon ephemeris for the moon visibility plots.
+The moon's position and illumination are computed once per UTC day
+over a rolling window at hourly resolution, and kept both in this
+process and in Django's cache. Each target then only needs one
+vectorized separation from the cached positions.
+"""
+import datetime
+import numpy as np
+from astropy import units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, get_moon
+from astroplan import moon_illumination
+from django.core.cache import cache
+
+MOON_EPHEMERIS_STEP = 1.0/24  # days
+MOON_EPHEMERIS_TIMEOUT = 2*24*60*60
+
+_moon_ephemerides = {}
+
+
+def _build_moon_ephemeris(start, days):
+    """
+    Moon unit vectors (geocentric) and illumination every hour
+    from start, a UTC date, for days + 1 days
+    """
+    times = Time(start.isoformat(), scale='utc') + np.arange(0, days + 1 + MOON_EPHEMERIS_STEP, MOON_EPHEMERIS_STEP)*u.day
+    moon_pos = get_moon(times)
+    ra = moon_pos.ra.radian
+    dec = moon_pos.dec.radian
+    return {
+        'mjd': times.mjd,
+        'xyz': np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec))),
+        'illumination': np.asarray(moon_illumination(times), dtype=float)
+    }
+
+
+def get_moon_ephemeris(days=30):
+    """
+    Returns the cached moon ephemeris covering at least the next days days
+    """
+    start = datetime.datetime.utcnow().date()
+    key = 'moon_ephemeris_{}_{}'.format(start.isoformat(), days)
+
+    ephemeris = _moon_ephemerides.get(key)
+    if ephemeris is None:
+        ephemeris = cache.get(key)
+        if ephemeris is None:
+            ephemeris = _build_moon_ephemeris(start, days)
+            cache.set(key, ephemeris, MOON_EPHEMERIS_TIMEOUT)
+        ### Only keep today's tables in this process
+        _moon_ephemerides.clear()
+        _moon_ephemerides[key] = ephemeris
+    return ephemeris
+
+
+def moon_separation_and_illumination(ra, dec, times, days=30):
+    """
+    Returns the moon's separation (degrees) from ra, dec and its
+    illumination fraction at each of times, an astropy Time array
+    within the next days days
+    """
+    ephemeris = get_moon_ephemeris(days=days)
+
+    ### Interpolate the unit vectors between the hourly samples, so RA wrap-around is not an issue
+    mjd = np.atleast_1d(times.mjd)
+    xyz = np.column_stack([np.interp(mjd, ephemeris['mjd'], ephemeris['xyz'][:, i]) for i in range(3)])
+    xyz /= np.linalg.norm(xyz, axis=1)[:, np.newaxis]
+    moon_pos = SkyCoord(x=xyz[:, 0], y=xyz[:, 1], z=xyz[:, 2], representation_type='cartesian')
+
+    separations = moon_pos.separation(SkyCoord(ra, dec, unit=u.deg)).deg
+    illumination = np.interp(mjd, ephemeris['mjd'], ephemeris['illumination'])
+    return separations, illumination
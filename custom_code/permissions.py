@@ -0,0 +1,49 @@
+"""
+Bulk version of guardian's assign_perm for group object permissions.
+All the GroupObjectPermission rows for a set of groups and objects are
+inserted at once, skipping any that already exist, instead of with one
+query per group per object.
+"""
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Model
+from guardian.models import GroupObjectPermission
+from tom_dataproducts.models import ReducedDatum
+from custom_code.lightcurves import invalidate_lightcurves
+
+
+def bulk_assign_perms(perm_codename, groups, objects, batch_size=1000):
+    """
+    Gives every group in groups the permission perm_codename
+    (e.g. 'tom_dataproducts.view_reduceddatum' or 'view_reduceddatum')
+    on every object in objects, which must all be of the same model.
+
+    groups and objects may each be a single instance, a list or a queryset.
+    Returns the permission rows that were asked for
+    """
+    if isinstance(groups, Group):
+        groups = [groups]
+    if isinstance(objects, Model):
+        objects = [objects]
+    groups = [group for group in groups if group is not None]
+    objects = list(objects)
+    if not groups or not objects:
+        return []
+
+    content_type = ContentType.objects.get_for_model(objects[0])
+    if '.' in perm_codename:
+        app_label, codename = perm_codename.split('.', 1)
+        if app_label != content_type.app_label:
+            raise ValueError('Permission {} does not apply to {} objects'.format(perm_codename, content_type.model))
+    else:
+        codename = perm_codename
+    permission = Permission.objects.get(content_type=content_type, codename=codename)
+
+    rows = [GroupObjectPermission(group=group, permission=permission, content_type=content_type, object_pk=str(obj.pk))
+            for group in groups for obj in objects]
+    GroupObjectPermission.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+
+    ### bulk_create doesn't send post_save, so drop the cached light curves these points belong to
+    if content_type.model_class() is ReducedDatum:
+        invalidate_lightcurves({obj.target_id for obj in objects})
+    return rows
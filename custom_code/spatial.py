@@ -0,0 +1,100 @@
+"""
+HEALPix helpers for indexed positional searches.
+Rows store the NESTED pixel they fall in at HEALPIX_NSIDE,
+so a cone search is a handful of indexed range queries
+followed by an exact angular distance cut in NumPy.
+"""
+import healpy as hp
+import numpy as np
+from django.db.models import Q
+
+HEALPIX_NSIDE = 1024
+MAX_PIXEL_RANGES = 64
+
+
+def radec_to_healpix(ra, dec, nside=HEALPIX_NSIDE):
+    """
+    Returns the NESTED pixel index (or array of indices) for ra, dec in degrees
+    """
+    ipix = hp.ang2pix(nside, np.asarray(ra, dtype=float), np.asarray(dec, dtype=float), nest=True, lonlat=True)
+    if np.ndim(ipix) == 0:
+        return int(ipix)
+    return ipix
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Haversine angular separation, in degrees, between points given in degrees
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2))
+    sin_ddec = np.sin((dec2 - dec1) / 2)
+    sin_dra = np.sin((ra2 - ra1) / 2)
+    a = sin_ddec**2 + np.cos(dec1) * np.cos(dec2) * sin_dra**2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def _pixels_to_ranges(ipix):
+    """
+    Collapses sorted pixel indices into inclusive (start, end) runs
+    """
+    if len(ipix) == 0:
+        return []
+    ipix = np.sort(ipix)
+    breaks = np.where(np.diff(ipix) != 1)[0]
+    starts = np.concatenate(([ipix[0]], ipix[breaks + 1]))
+    ends = np.concatenate((ipix[breaks], [ipix[-1]]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def cone_pixel_ranges(ra, dec, radius, nside=HEALPIX_NSIDE):
+    """
+    Returns inclusive (start, end) ranges of NESTED pixels at nside
+    covering a cone of radius degrees around ra, dec.
+
+    Large cones are queried at a coarser resolution, whose pixels map
+    onto contiguous blocks of fine pixels, to keep the number of ranges small
+    """
+    vec = hp.ang2vec(float(ra), float(dec), lonlat=True)
+    query_nside = nside
+    while True:
+        ipix = hp.query_disc(query_nside, vec, np.radians(radius), inclusive=True, nest=True)
+        ranges = _pixels_to_ranges(ipix)
+        if len(ranges) <= MAX_PIXEL_RANGES or query_nside == 1:
+            break
+        query_nside //= 2
+
+    factor = (nside // query_nside)**2
+    return [(start*factor, (end + 1)*factor - 1) for start, end in ranges]
+
+
+def cone_pixel_filter(ra, dec, radius, field='healpix', nside=HEALPIX_NSIDE):
+    """
+    Builds a Q object selecting rows whose pixel field can lie within the cone
+    """
+    q = Q()
+    for start, end in cone_pixel_ranges(ra, dec, radius, nside=nside):
+        if start == end:
+            q |= Q(**{field: start})
+        else:
+            q |= Q(**{'{}__range'.format(field): (start, end)})
+    return q
+
+
+def cone_search_queryset(queryset, ra, dec, radius, field='healpix', ra_field='ra', dec_field='dec', unindexed=False):
+    """
+    Pre-filters queryset on the pixel index, then applies the
+    exact angular distance cut and returns the matching rows.
+
+    With unindexed, rows without a pixel are kept as candidates too,
+    for indexes that may lag behind rows written outside the ORM
+    """
+    pixels = cone_pixel_filter(ra, dec, radius, field=field)
+    if unindexed:
+        pixels |= Q(**{'{}__isnull'.format(field): True})
+    candidates = queryset.filter(pixels)
+    rows = list(candidates.values_list('pk', ra_field, dec_field))
+    if not rows:
+        return queryset.none()
+    pks, ras, decs = (np.asarray(col) for col in zip(*rows))
+    inside = angular_separation(ra, dec, ras.astype(float), decs.astype(float)) <= radius
+    return queryset.filter(pk__in=pks[inside].tolist())
@@ -0,0 +1,96 @@
+"""
+Compact binary storage for spectra.
+Each spectroscopy ReducedDatum can have its wavelengths and fluxes
+stored as NumPy .npy blobs in SpectrumArrays, so readers get arrays
+straight away instead of walking the JSON value point by point.
+"""
+import io
+import json
+import logging
+import numpy as np
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Case, When, F, JSONField
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from tom_dataproducts.models import ReducedDatum
+from custom_code.models import SpectrumArrays
+
+logger = logging.getLogger(__name__)
+
+SPECTRUM_DTYPE = np.float64
+
+
+def encode_array(array, dtype=SPECTRUM_DTYPE):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(array, dtype=dtype), allow_pickle=False)
+    return buf.getvalue()
+
+
+def decode_array(blob):
+    return np.load(io.BytesIO(bytes(blob)), allow_pickle=False)
+
+
+def spectrum_from_value(value):
+    """
+    Returns wavelength and flux arrays from either JSON form of a spectrum:
+    arrays under wavelength and (photon_)flux, or a dict keyed "0", "1", ...
+    of {wavelength, flux}
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    if value.get('photon_flux'):
+        return np.asarray(value['wavelength'], dtype=float), np.asarray(value['photon_flux'], dtype=float)
+    if value.get('flux'):
+        return np.asarray(value['wavelength'], dtype=float), np.asarray(value['flux'], dtype=float)
+    points = list(value.values())
+    wavelength = np.fromiter((point['wavelength'] for point in points), dtype=float, count=len(points))
+    flux = np.fromiter((point['flux'] for point in points), dtype=float, count=len(points))
+    return wavelength, flux
+
+
+def load_spectrum(datum):
+    """
+    Returns the wavelength and flux arrays of a spectroscopy ReducedDatum,
+    from its binary arrays if it has them and its JSON value otherwise
+    """
+    try:
+        arrays = datum.spectrum_arrays
+    except ObjectDoesNotExist:
+        ### From spectra_queryset, the value is only fetched for spectra without arrays
+        value = getattr(datum, 'spectrum_value', None)
+        return spectrum_from_value(value if value is not None else datum.value)
+    return decode_array(arrays.wavelength), decode_array(arrays.flux)
+
+
+def spectra_queryset(queryset):
+    """
+    Fetches the binary arrays along with the spectra, and only loads
+    the JSON values (as spectrum_value) of spectra that don't have them yet,
+    all in one query. Reading .value off the results costs a query each
+    """
+    return queryset.select_related('spectrum_arrays').defer('value').annotate(
+        spectrum_value=Case(When(spectrum_arrays__isnull=True, then=F('value')), default=None, output_field=JSONField())
+    )
+
+
+def store_spectrum(datum):
+    """
+    Writes (or rewrites) the binary arrays for a spectroscopy ReducedDatum
+    """
+    wavelength, flux = spectrum_from_value(datum.value)
+    SpectrumArrays.objects.update_or_create(
+        reduced_datum_id=datum.id,
+        defaults={'wavelength': encode_array(wavelength), 'flux': encode_array(flux), 'npoints': len(flux)}
+    )
+
+
+@receiver(post_save, sender=ReducedDatum)
+def store_spectrum_on_save(sender, instance, **kwargs):
+    if instance.data_type != 'spectroscopy':
+        return
+    ### A spectrum that can't be converted is still saved, and read from its JSON value
+    try:
+        store_spectrum(instance)
+    except Exception as e:
+        logger.warning('Could not store arrays for spectrum {}: {}'.format(instance.id, e))
+        SpectrumArrays.objects.filter(reduced_datum_id=instance.id).delete()
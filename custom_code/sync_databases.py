@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 
-from sqlalchemy import create_engine, and_, update, insert, pool
+from sqlalchemy import create_engine, and_, update, insert, case, cast, func, literal_column, Text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.automap import automap_base
 
 import json
 from contextlib import contextmanager
 import os
+import io
 import datetime
+import numpy as np
+import healpy as hp
+import logging
+
+logger = logging.getLogger(__name__)
 
 _SNEX1_DB = 'mysql://{}:{}@supernova.science.lco.global:3306/supernova?charset=utf8&use_unicode=1'.format(os.environ.get('SNEX1_DB_USER'), os.environ.get('SNEX1_DB_PASSWORD'))
 _SNEX2_DB = 'postgresql://{}:{}@supernova.science.lco.global:5435/snex2'.format(os.environ.get('SNEX2_DB_USER'), os.environ.get('SNEX2_DB_PASSWORD'))
 
-engine1 = create_engine(_SNEX1_DB)
-engine2 = create_engine(_SNEX2_DB)
+### The engines, reflected tables and group ids are set by load_databases,
+### so importing this module doesn't connect to either database
+engine1 = None
+engine2 = None
+
+Db_Changes = Photlco = Spec = Targets = Target_Names = Classifications = Groups = None
+Datum = Target = Target_Extra = Targetname = Auth_Group = Group_Perm = None
+Datum_Extra = Phot_Snex_Id = Spectrum_Arrays = Target_Healpix = None
+
+snex1_groups = {}
+snex2_groups = {}
+
 
 @contextmanager
 def get_session(db_address=_SNEX1_DB):
@@ -24,12 +41,10 @@ def get_session(db_address=_SNEX1_DB):
     ----------
     session: SQLAlchemy database session
     """
-    Base = automap_base()
+    load_databases()
     if db_address==_SNEX1_DB:
-        Base.metadata.bind = engine1
         db_session = sessionmaker(bind=engine1, autoflush=False, expire_on_commit=False)
     else:
-        Base.metadata.bind = engine2
         db_session = sessionmaker(bind=engine2, autoflush=False, expire_on_commit=False)
 
     session = db_session()
@@ -46,101 +61,167 @@ def get_session(db_address=_SNEX1_DB):
         session.close()
 
 
-def load_table(tablename, db_address=_SNEX1_DB):
+def load_tables(engine, tablenames):
     """
-    Load a table with its data from a database
+    Load tables from a database, reflecting its schema once
 
     Parameters
     ----------
-    tablename: str, the name of the table to load
-    db_address: str, sqlalchemy address to the table being loaded
+    engine: sqlalchemy engine for the database
+    tablenames: list, the names of the tables to load
 
     Returns
     ----------
-    table: sqlalchemy table object
+    tables: list of sqlalchemy table objects, in the same order
     """
     Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.prepare(engine, reflect=True)
-
-    table = getattr(Base.classes, tablename)
-    return table
-
-
-### Define our SNex1 db tables as Classes
-Db_Changes = load_table('db_changes', db_address=_SNEX1_DB)
-Photlco = load_table('photlco', db_address=_SNEX1_DB)
-Spec = load_table('spec', db_address=_SNEX1_DB)
-Targets = load_table('targets', db_address=_SNEX1_DB)
-Target_Names = load_table('targetnames', db_address=_SNEX1_DB)
-Classifications = load_table('classifications', db_address=_SNEX1_DB)
-Groups = load_table('groups', db_address=_SNEX1_DB)
-
-### And our SNex2 tables
-Datum = load_table('tom_dataproducts_reduceddatum', db_address=_SNEX2_DB)
-Target = load_table('tom_targets_target', db_address=_SNEX2_DB)
-Target_Extra = load_table('tom_targets_targetextra', db_address=_SNEX2_DB)
-Targetname = load_table('tom_targets_targetname', db_address=_SNEX2_DB)
-Auth_Group = load_table('auth_group', db_address=_SNEX2_DB)
-Group_Perm = load_table('guardian_groupobjectpermission', db_address=_SNEX2_DB)
-Datum_Extra = load_table('custom_code_reduceddatumextra', db_address=_SNEX2_DB)
-
-### Make a dictionary of the groups in the SNex1 db
-with get_session(db_address=_SNEX1_DB) as db_session:
-    snex1_groups = {}
-    for x in db_session.query(Groups):
-        snex1_groups[x.name] = x.idcode
-    
+    Base.prepare(autoload_with=engine)
+    return [getattr(Base.classes, tablename) for tablename in tablenames]
+
 
-def query_db_changes(table, action, db_address=_SNEX1_DB):
+def load_databases(snex1_engine=None, snex2_engine=None, reload=False):
     """
-    Query the db_changes table
+    Connects to the SNex1 and SNex2 dbs and loads the tables and groups
+    used by the sync, the first time it is called (or every time, with reload)
+
+    Parameters
+    ----------
+    snex1_engine, snex2_engine: sqlalchemy engines to use instead of
+        ones for _SNEX1_DB and _SNEX2_DB (e.g. stand-ins in tests)
+    reload: bool, load them again even if they already are
+    """
+    global engine1, engine2, snex1_groups, snex2_groups
+    global Db_Changes, Photlco, Spec, Targets, Target_Names, Classifications, Groups
+    global Datum, Target, Target_Extra, Targetname, Auth_Group, Group_Perm
+    global Datum_Extra, Phot_Snex_Id, Spectrum_Arrays, Target_Healpix
+
+    if engine1 is not None and not reload:
+        return
+    snex1_engine = snex1_engine or create_engine(_SNEX1_DB)
+    snex2_engine = snex2_engine or create_engine(_SNEX2_DB)
+
+    ### Define our SNex1 db tables as Classes
+    Db_Changes, Photlco, Spec, Targets, Target_Names, Classifications, Groups = load_tables(
+        snex1_engine, ['db_changes', 'photlco', 'spec', 'targets', 'targetnames', 'classifications', 'groups'])
+
+    ### And our SNex2 tables
+    (Datum, Target, Target_Extra, Targetname, Auth_Group, Group_Perm,
+     Datum_Extra, Phot_Snex_Id, Spectrum_Arrays, Target_Healpix) = load_tables(
+        snex2_engine, ['tom_dataproducts_reduceddatum', 'tom_targets_target', 'tom_targets_targetextra',
+                       'tom_targets_targetname', 'auth_group', 'guardian_groupobjectpermission',
+                       'custom_code_reduceddatumextra', 'custom_code_photometrysnexid',
+                       'custom_code_spectrumarrays', 'custom_code_targethealpix'])
+
+    ### Make a dictionary of the groups in the SNex1 db
+    db_session = sessionmaker(bind=snex1_engine)()
+    try:
+        snex1_groups = {x.name: x.idcode for x in db_session.query(Groups)}
+    finally:
+        db_session.close()
+
+    ### And the groups in the SNex2 db, so permissions don't need a lookup per object
+    db_session = sessionmaker(bind=snex2_engine)()
+    try:
+        snex2_groups = {x.name: x.id for x in db_session.query(Auth_Group)}
+    finally:
+        db_session.close()
+
+    engine1, engine2 = snex1_engine, snex2_engine
+
+
+### Number of db_changes rows handled per batch (and per SNex2 transaction)
+BATCH_SIZE = 500
+
+
+def fetch_db_changes(table, action, last_id=0, batch_size=BATCH_SIZE, db_address=_SNEX1_DB):
+    """
+    Fetch the next batch of rows in the db_changes table
 
     Parameters
     ----------
     table: str, table that was modified
     action: str, one of 'update', 'insert', or 'delete'
+    last_id: int, only rows with a db_changes id above this are returned
+    batch_size: int, maximum number of rows to return
     db_address: str, sqlalchemy address to the database containing table
     """
-    #table_dict = {'photlco': Photlco, 'spec': Spec, 'targets': Targets, 'targetnames': Target_Names}
     with get_session(db_address=db_address) as db_session:
-        criteria = and_(Db_Changes.tablename==table, Db_Changes.action==action)
-        record = db_session.query(Db_Changes).filter(criteria)#.order_by(Db_Changes.id.desc()).all()
-    return record
+        criteria = and_(Db_Changes.tablename==table, Db_Changes.action==action, Db_Changes.id>last_id)
+        records = db_session.query(Db_Changes).filter(criteria).order_by(Db_Changes.id).limit(batch_size).all()
+    return records
+
+
+def iter_db_changes(table, action, batch_size=BATCH_SIZE, db_address=_SNEX1_DB):
+    """
+    Yield the pending db_changes rows for table and action in batches,
+    paging on the db_changes id so rows that are left in place
+    (e.g. targets rows, which update_target_extra clears) are only seen once
 
+    Parameters
+    ----------
+    table: str, table that was modified
+    action: str, one of 'update', 'insert', or 'delete'
+    batch_size: int, number of rows in each batch
+    db_address: str, sqlalchemy address to the database containing table
+    """
+    last_id = 0
+    while True:
+        batch = fetch_db_changes(table, action, last_id=last_id, batch_size=batch_size, db_address=db_address)
+        if not batch:
+            break
+        yield batch
+        last_id = batch[-1].id
 
-def get_current_row(table, id_, db_address=_SNEX1_DB):
+
+def get_current_rows(table, ids, db_address=_SNEX1_DB):
     """ 
-    Get the row that was modified, as recorded in the db_changes table
+    Get the rows that were modified, as recorded in the db_changes table
     
     Parameters
     ----------
     table: Table, the table in the SNex1 db that was modified, i.e. Photlco
-    id_: int, the id of the modified row
+    ids: list, the ids of the modified rows
     db_address: str, sqlalchemy address to the database containing table
+
+    Returns
+    ----------
+    records: dict, the rows that still exist keyed by id
     """
+    if not ids:
+        return {}
     with get_session(db_address=db_address) as db_session:
-        criteria = getattr(table, 'id') == id_
-        record = db_session.query(table).filter(criteria).first()
-    return record
+        records = db_session.query(table).filter(getattr(table, 'id').in_(list(ids))).all()
+    return {record.id: record for record in records}
 
 
-def delete_row(table, id_, db_address=_SNEX1_DB):
+def delete_rows(table, ids, db_address=_SNEX1_DB):
     """
-    Deletes a given row in table
+    Deletes the given rows in table with a single DELETE ... WHERE id IN
     
     Parameters
     ----------
     table: Table, the table to clear
-    id_: int, id of row to delete
+    ids: list, ids of rows to delete
     db_address: str, sqlalchemy address to the db_changes table
     """
+    if not ids:
+        return
     with get_session(db_address=db_address) as db_session:
-        criteria = getattr(table, 'id') == id_
-        db_session.query(table).filter(criteria).delete()
+        db_session.query(table).filter(getattr(table, 'id').in_(list(ids))).delete(synchronize_session=False)
         db_session.commit()
 
-def update_permissions(groupid, permissionid, objectid, contentid):
+
+def get_standard_ids(db_address=_SNEX1_DB):
+    """
+    Get the ids of the standard star targets in the SNex1 db, which aren't synced
+    """
+    with get_session(db_address=db_address) as db_session:
+        standard_list = db_session.query(Targets).filter(Targets.classificationid==1)
+        standard_ids = set(x.id for x in standard_list)
+    return standard_ids
+
+
+def update_permissions(groupid, permissionid, objectid, contentid, db_session):
     """
     Updates permissions of a specific group for a certain target
     or reduceddatum
@@ -151,6 +232,7 @@ def update_permissions(groupid, permissionid, objectid, contentid):
     permissionid: int, the permission id in the SNex2 db for this permission
     objectid: int, the row id of the object
     contentid: int, the content id in the SNex2 db for this object
+    db_session: SQLAlchemy session for the SNex2 db, committed by the caller
     """
     def powers_of_two(num):
         powers = []
@@ -162,15 +244,71 @@ def update_permissions(groupid, permissionid, objectid, contentid):
         return powers
     target_groups = powers_of_two(groupid)
     
-    with get_session(db_address=_SNEX2_DB) as db_session:
-        for g_name, g_id in snex1_groups.items():
-            if g_id in target_groups:
-                snex2_groupid = db_session.query(Auth_Group).filter(Auth_Group.name==g_name).first().id
-                update_permission = db_session.add(Group_Perm(object_pk=str(objectid), content_type_id=contentid, group_id = snex2_groupid, permission_id = permissionid))
-    db_session.commit()
+    for g_name, g_id in snex1_groups.items():
+        if g_id in target_groups and g_name in snex2_groups:
+            db_session.add(Group_Perm(object_pk=str(objectid), content_type_id=contentid, group_id=snex2_groups[g_name], permission_id=permissionid))
+
+
+def get_phot_value(id_, phot_row):
+    """
+    Build the ReducedDatum value for a row of the photlco table
+    """
+    if int(phot_row.mag) != 9999:
+        if int(phot_row.filetype) == 1:
+            phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': False, 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
+        elif int(phot_row.filetype) == 3 and phot_row.difftype is not None:
+            if int(phot_row.difftype) == 0:
+                subtraction_algorithm = 'Hotpants'
+            elif int(phot_row.difftype) == 1:
+                subtraction_algorithm = 'PyZOGY'
+            filename = phot_row.filename
+            if 'SDSS' in filename:
+                template_source = 'SDSS'
+            else:
+                template_source = 'LCO'
+            phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': True, 'subtraction_algorithm': subtraction_algorithm, 'template_source': template_source, 'reduction_type': 'manual', 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
+        
+        else:
+            phot = {'snex_id': int(id_)}
+    else:
+        phot = {'snex_id': int(id_)}
+    return phot
+
 
+def get_phot_datum_ids(snex_ids, db_session):
+    """
+    Returns {photlco id: ReducedDatum id} for the photometry synced from snex_ids.
+    Rows missing from the indexed snex_id table (e.g. not backfilled yet) are
+    looked up by the snex_id in the ReducedDatum value, as before the table
+    existed, and are added to it
 
-def update_phot(action, db_address=_SNEX2_DB):
+    Parameters
+    ----------
+    snex_ids: list, ids of rows in the photlco table
+    db_session: SQLAlchemy session for the SNex2 db, committed by the caller
+    """
+    snex2_ids = {}
+    for x in db_session.query(Phot_Snex_Id).filter(Phot_Snex_Id.snex_id.in_(snex_ids)).order_by(Phot_Snex_Id.id):
+        snex2_ids.setdefault(x.snex_id, x.reduced_datum_id)
+
+    unindexed = [int(id_) for id_ in snex_ids if int(id_) not in snex2_ids]
+    if unindexed:
+        #Some rows are still JSON strings rather than objects, so those are parsed first
+        value_snex_id = case(
+            (func.jsonb_typeof(Datum.value)=='string', cast(Datum.value.op('#>>', return_type=Text)(literal_column("'{}'")), JSONB)['snex_id'].astext),
+            else_=Datum.value['snex_id'].astext
+        )
+        criteria = and_(Datum.data_type=='photometry', value_snex_id.in_([str(id_) for id_ in unindexed]))
+        for x in db_session.query(Datum.id, value_snex_id).filter(criteria).order_by(Datum.id.desc()):
+            snex_id = int(x[1])
+            if snex_id not in snex2_ids:
+                snex2_ids[snex_id] = x[0]
+                db_session.add(Phot_Snex_Id(snex_id=snex_id, reduced_datum_id=x[0]))
+
+    return snex2_ids
+
+
+def update_phot(action, db_address=_SNEX2_DB, batch_size=BATCH_SIZE):
     """
     Queries the ReducedDatum table in the SNex2 db with any changes made to the Photlco table in the SNex1 db
 
@@ -178,113 +316,83 @@ def update_phot(action, db_address=_SNEX2_DB):
     ----------
     action: str, one of 'update', 'insert', or 'delete'
     db_address: str, sqlalchemy address to the SNex2 db
+    batch_size: int, number of db_changes rows handled per transaction
     """
-    phot_result = query_db_changes('photlco', action, db_address=_SNEX1_DB)
-    for result in phot_result:
-        try:
-            id_ = result.rowid # The ID of the row in the photlco table
-            phot_row = get_current_row(Photlco, id_, db_address=_SNEX1_DB) # The row corresponding to id_ in the photlco table    
-            #targetid = phot_row.targetid
-            
-            if action=='delete':
-                #Look up the dataproductid from the datum_extra table
-                with get_session(db_address=db_address) as db_session:
-                    
-                    #snex2_id_query = db_session.query(Datum).filter(and_(Datum.target_id==targetid, Datum.data_type=='photometry')).all()
-                    snex2_id_query = db_session.query(Datum).filter(Datum.data_type=='photometry').order_by(Datum.id.desc()).all()
-                    for snex2_row in snex2_id_query:
-                        value = snex2_row.value
-                        if type(value) == str:
-                            value = json.loads(snex2_row.value)
-                        if id_ == value.get('snex_id', ''):
-                            db_session.delete(snex2_row)
-                            break
-                    db_session.commit()
-
-                    #snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.snex_id==id_, Datum_Extra.data_type=='photometry')).first()
-                    #if snex2_id_query is not None: #Is none if row gets inserted and deleted in same 5 min block
-                        #snex2_id = snex2_id_query.reduced_datum_id
-                        #datum = db_session.query(Datum).filter(Datum.id==snex2_id).first()
-                        #db_session.delete(datum)
-                    #db_session.commit()
-
-                #Delete all other rows corresponding to this dataproduct in the db_changes table
-                with get_session(db_address=_SNEX1_DB) as db_session:
-                    all_other_rows = db_session.query(Db_Changes).filter(and_(Db_Changes.tablename=='photlco', Db_Changes.rowid==id_))
-                    for row in all_other_rows:
-                        db_session.delete(row)
-                    db_session.commit()
-                    
-            else:
+    standard_ids = get_standard_ids()
 
-                targetid = phot_row.targetid
-                dobs = phot_row.dateobs
-                tobs = phot_row.ut
-                if tobs is None:
-                    tobs = '00:00:00'
-                if dobs is None:
-                    dobs = datetime.datetime.today().strftime('%Y-%m-%d')
-                time = '{} {}'.format(dobs, tobs) 
+    for phot_result in iter_db_changes('photlco', action, batch_size=batch_size):
+        change_ids = [result.id for result in phot_result]
+        row_ids = list(dict.fromkeys(result.rowid for result in phot_result)) # The IDs of the rows in the photlco table
+        
+        if action=='delete':
+            #Look up the dataproductids for the whole batch in the indexed snex_id table
+            with get_session(db_address=db_address) as db_session:
+                
+                snex2_ids = get_phot_datum_ids(row_ids, db_session)
+                missing = [id_ for id_ in row_ids if int(id_) not in snex2_ids]
+                if missing: #Rows inserted and deleted between syncs, or never synced
+                    logger.info('No photometry in SNex2 to delete for photlco rows {}'.format(missing))
                 
-                if int(phot_row.mag) != 9999:
-                    if int(phot_row.filetype) == 1:
-                        phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': False, 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
-                    elif int(phot_row.filetype) == 3 and phot_row.difftype is not None:
-                        if int(phot_row.difftype) == 0:
-                            subtraction_algorithm = 'Hotpants'
-                        elif int(phot_row.difftype) == 1:
-                            subtraction_algorithm = 'PyZOGY'
-                        filename = phot_row.filename
-                        if 'SDSS' in filename:
-                            template_source = 'SDSS'
+                if snex2_ids:
+                    db_session.flush()
+                    db_session.query(Phot_Snex_Id).filter(Phot_Snex_Id.snex_id.in_(row_ids)).delete(synchronize_session=False)
+                    db_session.query(Datum).filter(and_(Datum.data_type=='photometry', Datum.id.in_(list(snex2_ids.values())))).delete(synchronize_session=False)
+                db_session.commit()
+
+            #Delete all other rows corresponding to these dataproducts in the db_changes table
+            with get_session(db_address=_SNEX1_DB) as db_session:
+                db_session.query(Db_Changes).filter(and_(Db_Changes.tablename=='photlco', Db_Changes.rowid.in_(row_ids))).delete(synchronize_session=False)
+                db_session.commit()
+            continue
+
+        phot_rows = get_current_rows(Photlco, row_ids, db_address=_SNEX1_DB)
+
+        to_sync = {}
+        for id_ in row_ids:
+            phot_row = phot_rows.get(id_)
+            if phot_row is None or phot_row.targetid in standard_ids or int(phot_row.filetype) not in (1,3):
+                continue
+            
+            dobs = phot_row.dateobs
+            tobs = phot_row.ut
+            if tobs is None:
+                tobs = '00:00:00'
+            if dobs is None:
+                dobs = datetime.datetime.today().strftime('%Y-%m-%d')
+            time = '{} {}'.format(dobs, tobs)
+            to_sync[id_] = (phot_row, time, get_phot_value(id_, phot_row))
+
+        if to_sync:
+            with get_session(db_address=db_address) as db_session:
+                if action=='update':
+                    # Match every row in the batch to its ReducedDatum with one indexed lookup
+                    snex2_ids = get_phot_datum_ids(list(to_sync.keys()), db_session)
+
+                    mappings = []
+                    missing = []
+                    for id_, (phot_row, time, phot) in to_sync.items():
+                        snex2_id = snex2_ids.get(int(id_))
+                        if snex2_id is not None:
+                            mappings.append({'id': snex2_id, 'target_id': phot_row.targetid, 'timestamp': time, 'value': phot, 'data_type': 'photometry', 'source_name': '', 'source_location': ''})
                         else:
-                            template_source = 'LCO'
-                        phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': True, 'subtraction_algorithm': subtraction_algorithm, 'template_source': template_source, 'reduction_type': 'manual', 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
-                    
-                    else:
-                        phot = {'snex_id': int(id_)}
-                else:
-                    phot = {'snex_id': int(id_)}
-    
-                phot_groupid = phot_row.groupidcode
-    
-                with get_session(db_address=_SNEX1_DB) as db_session:
-                    standard_list = db_session.query(Targets).filter(Targets.classificationid==1)
-                    standard_ids = [x.id for x in standard_list]
-                if targetid not in standard_ids and int(phot_row.filetype) in (1,3):
-                    with get_session(db_address=db_address) as db_session:
-                        #criteria = and_(Datum.data_type=='photometry', Datum.timestamp==time)
-                        if action=='update':
-                            #snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.snex_id==id_, Datum_Extra.data_type=='photometry')).first()
-                            ##if snex2_id_query is not None:
-                            #snex2_id = snex2_id_query.reduced_datum_id
-                            
-                            snex2_id_query = db_session.query(Datum).filter(and_(Datum.target_id==targetid, Datum.data_type=='photometry')).all()
-                            for snex2_row in snex2_id_query:
-                                value = snex2_row.value
-                                if type(value) == str: #Some rows are still strings for some reason
-                                    value = json.loads(snex2_row.value)
-                                if int(id_) == value.get('snex_id', ''):
-                                    snex2_id = snex2_row.id
-                                    db_session.query(Datum).filter(Datum.id==snex2_id).update({'target_id': targetid, 'timestamp': time, 'value': phot, 'data_type': 'photometry', 'source_name': '', 'source_location': ''})
-                                    break
-
-                        elif action=='insert':
-                            newphot = Datum(target_id=targetid, timestamp=time, value=phot, data_type='photometry', source_name='', source_location='')
-                            db_session.add(newphot)
-                            db_session.flush()
-    
-                            if phot_groupid is not None:
-                                update_permissions(int(phot_groupid), 77, newphot.id, 19) #View reduceddatum
+                            missing.append(id_)
+                    if missing:
+                        logger.warning('No photometry in SNex2 to update for photlco rows {}'.format(missing))
+                    db_session.bulk_update_mappings(Datum, mappings)
+
+                elif action=='insert':
+                    new_phot = [(id_, phot_row, Datum(target_id=phot_row.targetid, timestamp=time, value=phot, data_type='photometry', source_name='', source_location='')) for id_, (phot_row, time, phot) in to_sync.items()]
+                    db_session.add_all([newphot for _, _, newphot in new_phot])
+                    db_session.flush()
 
-                            #newphot_extra = Datum_Extra(snex_id=int(id_), reduced_datum_id=int(newphot.id), data_type='photometry', key='filetype', value=phot_row.filetype, float_value = float(phot_row.filetype))
-                            #db_session.add(newphot_extra)
+                    for id_, phot_row, newphot in new_phot:
+                        db_session.add(Phot_Snex_Id(snex_id=int(id_), reduced_datum_id=newphot.id))
+                        if phot_row.groupidcode is not None:
+                            update_permissions(int(phot_row.groupidcode), 77, newphot.id, 19, db_session) #View reduceddatum
 
-                        db_session.commit()
-                delete_row(Db_Changes, result.id, db_address=_SNEX1_DB)
+                db_session.commit()
 
-        except:
-            raise #continue
+        delete_rows(Db_Changes, change_ids, db_address=_SNEX1_DB)
 
 
 def read_spec(filename):
@@ -301,191 +409,231 @@ def read_spec(filename):
     return(data)
 
 
-def update_spec(action, db_address=_SNEX2_DB):
+def spec_arrays(reduced_datum_id, spec):
     """
-    Queries the ReducedDatum table in the SNex2 db with any changes made to the Spec table in the SNex1 db
+    Returns the custom_code_spectrumarrays row for a spectrum read by read_spec,
+    stored the same way as custom_code.spectra.encode_array
 
     Parameters
     ----------
-    action: str, one of 'update', 'insert', or 'delete'
-    db_address: str, sqlalchemy address to the SNex2 db
+    reduced_datum_id: int, id of the spectrum's ReducedDatum
+    spec: dict, the spectrum returned by read_spec
     """
-    spec_result = query_db_changes('spec', action, db_address=_SNEX1_DB)
-    for result in spec_result:
-        try:
-            id_ = result.rowid # The ID of the row in the spec table
-
-            if action=='delete':
-                #Look up the dataproductid from the datum_extra table
-                with get_session(db_address=db_address) as db_session:
-                    
-                    #snex2_id_query = db_session.query(Datum).filter(and_(Datum.target_id==targetid, Datum.data_type=='spectroscopy')).all()
-                    #for snex2_row in snex2_id_query:
-                    #    value = json.loads(snex2_row.value)
-                    #    if id_ == value.get('snex_id', ''):
-                    #        db_session.delete(snex2_row)
-                    #        break
-                    #db_session.commit()
-
-                    snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.data_type=='spectroscopy', Datum_Extra.key=='snex_id')).all()
-                    for snex2_row in snex2_id_query:
-                        value = json.loads(snex2_row.value)
-                        if id_ == value.get('snex_id', ''):
-                            snex2_id = value.get('snex2_id', '')
-                            db_session.query(Datum).filter(and_(Datum.data_type=='spectroscopy', Datum.id==snex2_id)).delete()
-                            break
-                    db_session.commit()
-
-            else:
-                spec_row = get_current_row(Spec, id_, db_address=_SNEX1_DB) # The row corresponding to id_ in the spec table
+    arrays = {}
+    for key in ['wavelength', 'flux']:
+        buf = io.BytesIO()
+        np.save(buf, np.array([point[key] for point in spec.values()], dtype=np.float64), allow_pickle=False)
+        arrays[key] = buf.getvalue()
+    return {'reduced_datum_id': reduced_datum_id, 'wavelength': arrays['wavelength'], 'flux': arrays['flux'], 'npoints': len(spec)}
 
-                if not spec_row:
-                    delete_row(Db_Changes, result.id, db_address=_SNEX1_DB)
-                    continue
 
-                targetid = spec_row.targetid
-                time = '{} {}'.format(spec_row.dateobs, spec_row.ut) 
-                spec = read_spec(spec_row.filepath + spec_row.filename.replace('.fits', '.ascii'))
-                spec_groupid = spec_row.groupidcode
-    
-                with get_session(db_address=_SNEX1_DB) as db_session:
-                    standard_list = db_session.query(Targets).filter(Targets.classificationid==1)
-                    standard_ids = [x.id for x in standard_list]
-                if targetid not in standard_ids:
-                    with get_session(db_address=db_address) as db_session:
-                        #criteria = and_(Datum.data_type=='spectroscopy', Datum.timestamp==time)
-                        if action=='update':
-                            #snex2_id_query = db_session.query(Datum).filter(and_(Datum.target_id==targetid, Datum.data_type=='spectroscopy')).all()
-                            #for snex2_row in snex2_id_query:
-                            #    value = json.loads(snex2_row.value)
-                            #    if id_ == value.get('snex_id', ''):
-                            #        snex2_row.update({'target_id': targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
-                            #        break
-                            
-                            snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.target_id==targetid, Datum_Extra.key=='snex_id', Datum_Extra.data_type=='spectroscopy')).all()
-                            for snex2_row in snex2_id_query:
-                                value = json.loads(snex2_row.value)
-                                if id_ == value.get('snex_id', ''):
-                                    snex2_id = value.get('snex2_id', '')
-                                    db_session.query(Datum).filter(Datum.id==snex2_id).update({'target_id': targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
-                                    break
-
-                        elif action=='insert':
-                            newspec = Datum(target_id=targetid, timestamp=time, value=spec, data_type='spectroscopy', source_name='', source_location='')
-                            db_session.add(newspec)
-                            db_session.flush()
-
-                            if spec_groupid is not None:
-                                update_permissions(int(spec_groupid), 77, newspec.id, 19) #View reduceddatum
- 
-                            #newspec_extra = Datum_Extra(snex_id=int(id_), reduced_datum_id=int(newspec.id), data_type='spectroscopy', key='', value='')
-                            #db_session.add(newspec_extra)
-
-                            newspec_extra_value = json.dumps({'snex_id': int(id_), 'snex2_id': int(newspec.id)})
-                            newspec_extra = Datum_Extra(target_id=targetid, data_type='spectroscopy', key='snex_id', value=newspec_extra_value)
-                            db_session.add(newspec_extra)
-
-                            spec_extras = {}
-                            for key in ['telescope', 'instrument', 'exptime', 'slit', 'airmass', 'reducer']:
-                                if getattr(spec_row, key):
-                                    spec_extras[key] = getattr(spec_row, key)
-                            spec_extras['snex_id'] = int(id_)
-                            spec_extras_row = Datum_Extra(data_type='spectroscopy', key='spec_extras', value=json.dumps(spec_extras), target_id=targetid)
-                            db_session.add(spec_extras_row)
-
-                        db_session.commit()
-            delete_row(Db_Changes, result.id, db_address=_SNEX1_DB)
-
-        except:
-            raise #continue
-
-
-def update_target(action, db_address=_SNEX2_DB):
+def update_spec(action, db_address=_SNEX2_DB, batch_size=BATCH_SIZE):
     """
-    Queries the Target table in the SNex2 db with any changes made to the Targets and Targetnames tables in the SNex1 db
+    Queries the ReducedDatum table in the SNex2 db with any changes made to the Spec table in the SNex1 db
 
     Parameters
     ----------
     action: str, one of 'update', 'insert', or 'delete'
     db_address: str, sqlalchemy address to the SNex2 db
+    batch_size: int, number of db_changes rows handled per transaction
     """
-    target_result = query_db_changes('targets', action, db_address=_SNEX1_DB)
-    name_result = query_db_changes('targetnames', action, db_address=_SNEX1_DB)
+    standard_ids = get_standard_ids()
 
-    for tresult in target_result:
-        try:
-            target_id = tresult.rowid # The ID of the row in the targets table
-            target_row = get_current_row(Targets, target_id, db_address=_SNEX1_DB) # The row corresponding to target_id in the targets table
+    for spec_result in iter_db_changes('spec', action, batch_size=batch_size):
+        change_ids = [result.id for result in spec_result]
+        row_ids = list(dict.fromkeys(result.rowid for result in spec_result)) # The IDs of the rows in the spec table
 
-            t_ra = target_row.ra0
-            t_dec = target_row.dec0
-            t_modified = target_row.lastmodified
-            t_created = target_row.datecreated
-            if t_created is None:
-                t_created = t_modified
-            t_groupid = int(target_row.groupidcode)
+        if action=='delete':
+            #Look up the dataproductids from the datum_extra table for the whole batch
+            with get_session(db_address=db_address) as db_session:
 
-            ### Get the name of the target
-            with get_session(db_address=_SNEX1_DB) as db_session:
-                name_query = db_session.query(Target_Names).filter(Target_Names.targetid==target_row.id).first()
-                t_name = name_query.name
+                snex_id_rows = db_session.query(Datum_Extra).filter(and_(Datum_Extra.data_type=='spectroscopy', Datum_Extra.key=='snex_id', Datum_Extra.snex_id.in_(row_ids)))
+                snex2_ids = [x.reduced_datum_id for x in snex_id_rows if x.reduced_datum_id is not None]
+
+                if snex2_ids:
+                    # The snex_id and array rows reference the datums, so they go first
+                    db_session.query(Spectrum_Arrays).filter(Spectrum_Arrays.reduced_datum_id.in_(snex2_ids)).delete(synchronize_session=False)
+                    db_session.query(Datum_Extra).filter(and_(Datum_Extra.data_type=='spectroscopy', Datum_Extra.key=='snex_id', Datum_Extra.reduced_datum_id.in_(snex2_ids))).delete(synchronize_session=False)
+                    db_session.query(Datum).filter(and_(Datum.data_type=='spectroscopy', Datum.id.in_(snex2_ids))).delete(synchronize_session=False)
                 db_session.commit()
 
+            delete_rows(Db_Changes, change_ids, db_address=_SNEX1_DB)
+            continue
+
+        spec_rows = get_current_rows(Spec, row_ids, db_address=_SNEX1_DB) # The rows in the spec table that still exist
+
+        to_sync = {}
+        for id_ in row_ids:
+            spec_row = spec_rows.get(id_)
+            if spec_row is None or spec_row.targetid in standard_ids:
+                continue
+            time = '{} {}'.format(spec_row.dateobs, spec_row.ut)
+            spec = read_spec(spec_row.filepath + spec_row.filename.replace('.fits', '.ascii'))
+            to_sync[id_] = (spec_row, time, spec)
+
+        if to_sync:
             with get_session(db_address=db_address) as db_session:
-                criteria = getattr(Target, 'id') == target_id
                 if action=='update':
-                    db_session.query(Target).filter(criteria).update({'ra': t_ra, 'dec': t_dec, 'modified': t_modified, 'created': t_created, 'type': 'SIDEREAL', 'epoch': 2000, 'scheme': ''})
+                    # Match every row in the batch to its ReducedDatum with one indexed query
+                    snex2_ids = {}
+                    snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.snex_id.in_(list(to_sync.keys())), Datum_Extra.key=='snex_id', Datum_Extra.data_type=='spectroscopy')).order_by(Datum_Extra.id)
+                    for snex2_row in snex2_id_query:
+                        if snex2_row.reduced_datum_id is not None:
+                            snex2_ids.setdefault((snex2_row.target_id, snex2_row.snex_id), snex2_row.reduced_datum_id)
+
+                    mappings = []
+                    array_rows = []
+                    for id_, (spec_row, time, spec) in to_sync.items():
+                        snex2_id = snex2_ids.get((spec_row.targetid, id_))
+                        if snex2_id is not None:
+                            mappings.append({'id': snex2_id, 'target_id': spec_row.targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
+                            array_rows.append(spec_arrays(snex2_id, spec))
+                    db_session.bulk_update_mappings(Datum, mappings)
+
+                    # Replace the binary arrays of the updated spectra
+                    if array_rows:
+                        db_session.query(Spectrum_Arrays).filter(Spectrum_Arrays.reduced_datum_id.in_([row['reduced_datum_id'] for row in array_rows])).delete(synchronize_session=False)
+                        db_session.bulk_insert_mappings(Spectrum_Arrays, array_rows)
 
                 elif action=='insert':
-                    existing_target_query = db_session.query(Target).filter(criteria).first()
-                    if not existing_target_query:
-                        db_session.add(Target(id=target_id, name=t_name, ra=t_ra, dec=t_dec, modified=t_modified, created=t_created, type='SIDEREAL', epoch=2000, scheme=''))
-                        update_permissions(t_groupid, 47, target_id, 12) #Change target
-                        update_permissions(t_groupid, 48, target_id, 12) #Delete target
-                        update_permissions(t_groupid, 49, target_id, 12) #View target
+                    new_spec = [(id_, spec_row, Datum(target_id=spec_row.targetid, timestamp=time, value=spec, data_type='spectroscopy', source_name='', source_location='')) for id_, (spec_row, time, spec) in to_sync.items()]
+                    db_session.add_all([newspec for _, _, newspec in new_spec])
+                    db_session.flush()
+
+                    db_session.bulk_insert_mappings(Spectrum_Arrays, [spec_arrays(newspec.id, to_sync[id_][2]) for id_, _, newspec in new_spec])
 
-                elif action=='delete':
-                    db_session.query(Target).filter(criteria).delete()
+                    new_extras = []
+                    for id_, spec_row, newspec in new_spec:
+                        if spec_row.groupidcode is not None:
+                            update_permissions(int(spec_row.groupidcode), 77, newspec.id, 19, db_session) #View reduceddatum
+
+                        newspec_extra_value = json.dumps({'snex_id': int(id_), 'snex2_id': int(newspec.id)})
+                        new_extras.append(Datum_Extra(target_id=spec_row.targetid, data_type='spectroscopy', key='snex_id', value=newspec_extra_value, reduced_datum_id=newspec.id, snex_id=int(id_)))
+
+                        spec_extras = {}
+                        for key in ['telescope', 'instrument', 'exptime', 'slit', 'airmass', 'reducer']:
+                            if getattr(spec_row, key):
+                                spec_extras[key] = getattr(spec_row, key)
+                        spec_extras['snex_id'] = int(id_)
+                        new_extras.append(Datum_Extra(data_type='spectroscopy', key='spec_extras', value=json.dumps(spec_extras), target_id=spec_row.targetid, snex_id=int(id_)))
+                    db_session.add_all(new_extras)
 
                 db_session.commit()
-            #delete_row(Db_Changes, tresult.id, db_address=_SNEX1_DB)
 
-        except:
-            raise #continue
+        delete_rows(Db_Changes, change_ids, db_address=_SNEX1_DB)
+
+
+def target_healpix(target_id, ra, dec):
+    """
+    Returns the custom_code_targethealpix row for a target, using the
+    same pixelization as custom_code.spatial.radec_to_healpix (NESTED, nside=1024)
+
+    Parameters
+    ----------
+    target_id: int, id of the target
+    ra, dec: float, position of the target in degrees
+    """
+    return {'target_id': target_id, 'healpix': int(hp.ang2pix(1024, float(ra), float(dec), nest=True, lonlat=True))}
+
+
+def update_target(action, db_address=_SNEX2_DB, batch_size=BATCH_SIZE):
+    """
+    Queries the Target table in the SNex2 db with any changes made to the Targets and Targetnames tables in the SNex1 db
+
+    Parameters
+    ----------
+    action: str, one of 'update', 'insert', or 'delete'
+    db_address: str, sqlalchemy address to the SNex2 db
+    batch_size: int, number of db_changes rows handled per transaction
+    """
+    for target_result in iter_db_changes('targets', action, batch_size=batch_size):
+        target_ids = list(dict.fromkeys(tresult.rowid for tresult in target_result)) # The IDs of the rows in the targets table
 
-    for nresult in name_result:
-        try:
-            name_id = nresult.rowid # The ID of the row in the targetnames table
-            name_row = get_current_row(Target_Names, name_id, db_address=_SNEX1_DB) # The row corresponding to name_id in the targetnames table
+        if action=='delete':
+            with get_session(db_address=db_address) as db_session:
+                db_session.query(Target_Healpix).filter(Target_Healpix.target_id.in_(target_ids)).delete(synchronize_session=False)
+                db_session.query(Target).filter(Target.id.in_(target_ids)).delete(synchronize_session=False)
+                db_session.commit()
+            # The db_changes rows for targets are cleared by update_target_extra
+            continue
+
+        target_rows = get_current_rows(Targets, target_ids, db_address=_SNEX1_DB)
+
+        ### Get the names of the targets
+        t_names = {}
+        with get_session(db_address=_SNEX1_DB) as db_session:
+            name_query = db_session.query(Target_Names).filter(Target_Names.targetid.in_(list(target_rows.keys()))).order_by(Target_Names.id)
+            for name_row in name_query:
+                t_names.setdefault(name_row.targetid, name_row.name)
+
+        with get_session(db_address=db_address) as db_session:
+            existing_ids = set(x.id for x in db_session.query(Target.id).filter(Target.id.in_(target_ids)))
+
+            mappings = []
+            healpix_rows = []
+            for target_id in target_ids:
+                target_row = target_rows.get(target_id)
+                if target_row is None:
+                    continue
 
-            if action!='delete':
-                n_id = name_row.targetid
-                t_name = name_row.name
+                t_ra = target_row.ra0
+                t_dec = target_row.dec0
+                t_modified = target_row.lastmodified
+                t_created = target_row.datecreated
+                if t_created is None:
+                    t_created = t_modified
+                t_groupid = int(target_row.groupidcode)
+
+                if action=='update' and target_id in existing_ids:
+                    mappings.append({'id': target_id, 'ra': t_ra, 'dec': t_dec, 'modified': t_modified, 'created': t_created, 'type': 'SIDEREAL', 'epoch': 2000, 'scheme': ''})
+                    if t_ra is not None and t_dec is not None:
+                        healpix_rows.append(target_healpix(target_id, t_ra, t_dec))
+
+                elif action=='insert' and target_id not in existing_ids:
+                    db_session.add(Target(id=target_id, name=t_names[target_id], ra=t_ra, dec=t_dec, modified=t_modified, created=t_created, type='SIDEREAL', epoch=2000, scheme=''))
+                    existing_ids.add(target_id)
+                    update_permissions(t_groupid, 47, target_id, 12, db_session) #Change target
+                    update_permissions(t_groupid, 48, target_id, 12, db_session) #Delete target
+                    update_permissions(t_groupid, 49, target_id, 12, db_session) #View target
+                    if t_ra is not None and t_dec is not None:
+                        healpix_rows.append(target_healpix(target_id, t_ra, t_dec))
+
+            if mappings:
+                db_session.bulk_update_mappings(Target, mappings)
+                # Drop the pixels of updated targets, which are rewritten below if they still have a position
+                db_session.query(Target_Healpix).filter(Target_Healpix.target_id.in_([mapping['id'] for mapping in mappings])).delete(synchronize_session=False)
+            if healpix_rows:
+                db_session.flush()
+                db_session.bulk_insert_mappings(Target_Healpix, healpix_rows)
+            db_session.commit()
+
+    for name_result in iter_db_changes('targetnames', action, batch_size=batch_size):
+        change_ids = [nresult.id for nresult in name_result]
+        
+        if action!='delete': #Deletes currently aren't synced
+            name_ids = list(dict.fromkeys(nresult.rowid for nresult in name_result)) # The IDs of the rows in the targetnames table
+            name_rows = get_current_rows(Target_Names, name_ids, db_address=_SNEX1_DB)
+            names = list(dict.fromkeys((name_row.targetid, name_row.name) for name_row in name_rows.values()))
+            n_ids = set(n_id for n_id, _ in names)
 
             with get_session(db_address=db_address) as db_session:
-                targetname_criteria = and_(Targetname.name==t_name, Targetname.target_id==n_id)
-                #targetname_criteria = Targetname.target_id == n_id # Update the row in the targetname table that has the same targetid as the targetid in the targetnames table
                 if action=='update':
-                    db_session.query(Target).filter(Target.id==n_id).update({'name': t_name})
-                    db_session.query(Targetname).filter(targetname_criteria).update({'name': t_name})
+                    existing_ids = set(x.id for x in db_session.query(Target.id).filter(Target.id.in_(n_ids)))
+                    mappings = [{'id': n_id, 'name': t_name} for n_id, t_name in names if n_id in existing_ids]
+                    if mappings:
+                        db_session.bulk_update_mappings(Target, mappings)
 
                 elif action=='insert':
-                    existing_name = db_session.query(Targetname).filter(Targetname.name==t_name, Targetname.target_id==n_id).first()
-                    if not existing_name:
-                        db_session.add(Targetname(name=t_name, target_id=n_id, created=datetime.datetime.utcnow(), modified=datetime.datetime.utcnow()))
-
-                #elif action=='delete': #Currently doesn't work, need to fix?
-                #    name_delete = db_session.query(Targetname).filter(targetname_criteria).first()
-                #    db_session.delete(name_delete)
+                    existing_names = set((x.target_id, x.name) for x in db_session.query(Targetname).filter(Targetname.target_id.in_(n_ids)))
+                    now = datetime.datetime.utcnow()
+                    db_session.add_all([Targetname(name=t_name, target_id=n_id, created=now, modified=now) for n_id, t_name in names if (n_id, t_name) not in existing_names])
 
                 db_session.commit()
-            delete_row(Db_Changes, nresult.id, db_address=_SNEX1_DB)
-        
-        except:
-            raise #continue
+
+        delete_rows(Db_Changes, change_ids, db_address=_SNEX1_DB)
 
 
-def update_target_extra(action, db_address=_SNEX2_DB):
+def update_target_extra(action, db_address=_SNEX2_DB, batch_size=BATCH_SIZE):
     """
     Queries the Targetextra table in the SNex2 db with any changes made to the Targets table, along with info from the Classifications table, in the SNex1 db
 
@@ -493,56 +641,78 @@ def update_target_extra(action, db_address=_SNEX2_DB):
     ----------
     action: str, one of 'update', 'insert', or 'delete'
     db_address: str, sqlalchemy address to the SNex2 db
+    batch_size: int, number of db_changes rows handled per transaction
     """
-    target_result = query_db_changes('targets', action, db_address=_SNEX1_DB)
-
-    for tresult in target_result:
-        try:
-            target_id = tresult.rowid # The ID of the row in the targets table
-            target_row = get_current_row(Targets, target_id, db_address=_SNEX1_DB) # The row corresponding to target_id in the targets table
+    for target_result in iter_db_changes('targets', action, batch_size=batch_size):
+        change_ids = [tresult.id for tresult in target_result]
+        target_ids = list(dict.fromkeys(tresult.rowid for tresult in target_result)) # The IDs of the rows in the targets table
+        target_rows = get_current_rows(Targets, target_ids, db_address=_SNEX1_DB)
+
+        class_ids = set(target_row.classificationid for target_row in target_rows.values() if target_row.classificationid is not None)
+        class_rows = get_current_rows(Classifications, class_ids, db_address=_SNEX1_DB)
+
+        with get_session(db_address=db_address) as db_session:
+            existing_extras = {}
+            extra_query = db_session.query(Target_Extra).filter(and_(Target_Extra.target_id.in_(target_ids), Target_Extra.key.in_(['redshift', 'classification'])))
+            for extra in extra_query:
+                existing_extras.setdefault((extra.target_id, extra.key), []).append(extra.id)
+
+            z_updates = []
+            class_updates = []
+            new_extras = []
+            delete_ids = []
+            for target_id in target_ids:
+                target_row = target_rows.get(target_id)
+                if target_row is None:
+                    if action=='delete':
+                        delete_ids += existing_extras.get((target_id, 'redshift'), []) + existing_extras.get((target_id, 'classification'), [])
+                    continue
 
-            #t_id = target_row.id
-            value = target_row.redshift
-            if value is not None:
-                with get_session(db_address=db_address) as db_session:
-                    z_criteria = and_(Target_Extra.target_id==target_id, Target_Extra.key=='redshift') # Criteria for updating the redshift info in the targetextra table
+                value = target_row.redshift
+                if value is not None:
+                    z_ids = existing_extras.get((target_id, 'redshift'), []) # The redshift rows for this target in the targetextra table
                     
                     if action=='update':
-                        if db_session.query(Target_Extra).filter(z_criteria).first() is not None:
-                            db_session.query(Target_Extra).filter(z_criteria).update({'value': str(value), 'float_value': float(value)})
+                        if z_ids:
+                            z_updates += [{'id': z_id, 'value': str(value), 'float_value': float(value)} for z_id in z_ids]
                         else:
-                            db_session.add(Target_Extra(target_id=target_id, key='redshift', value=str(value), float_value=float(value)))
+                            new_extras.append(Target_Extra(target_id=target_id, key='redshift', value=str(value), float_value=float(value)))
 
                     #Don't think the below are necessary, but need to double check
                     #elif action=='insert':
                         #db_session.add(Target_Extra(target_id=target_id, key='redshift', value=str(value), float_value=float(value)))
                     
                     elif action=='delete':
-                        db_session.query(Target_Extra).filter(z_criteria).delete()
-                    db_session.commit()
-
-            class_id = target_row.classificationid
-            if class_id is not None:
-                class_name = get_current_row(Classifications, class_id, db_address=_SNEX1_DB).name # Get the classification from the classifications table based on the classification id in the targets table (wtf)
-                with get_session(db_address=db_address) as db_session:
-                    c_criteria = and_(Target_Extra.target_id==target_id, Target_Extra.key=='classification') # Criteria for updating the classification info in the targetextra table
+                        delete_ids += z_ids
+
+                class_id = target_row.classificationid
+                if class_id is not None:
+                    class_name = class_rows[class_id].name # Get the classification from the classifications table based on the classification id in the targets table
+                    c_ids = existing_extras.get((target_id, 'classification'), []) # The classification rows for this target in the targetextra table
+                    
                     if action=='update':
-                        if db_session.query(Target_Extra).filter(c_criteria).first() is not None:
-                            db_session.query(Target_Extra).filter(c_criteria).update({'value': class_name})
+                        if c_ids:
+                            class_updates += [{'id': c_id, 'value': class_name} for c_id in c_ids]
                         else:
-                            db_session.add(Target_Extra(target_id=target_id, key='classification', value=class_name))
+                            new_extras.append(Target_Extra(target_id=target_id, key='classification', value=class_name))
 
                     elif action=='insert':
-                        db_session.add(Target_Extra(target_id=target_id, key='classification', value=class_name))
+                        new_extras.append(Target_Extra(target_id=target_id, key='classification', value=class_name))
 
                     elif action=='delete':
-                        db_session.query(Target_Extra).filter(c_criteria).delete()
+                        delete_ids += c_ids
 
-                    db_session.commit()
-            delete_row(Db_Changes, tresult.id, db_address=_SNEX1_DB)
+            if z_updates:
+                db_session.bulk_update_mappings(Target_Extra, z_updates)
+            if class_updates:
+                db_session.bulk_update_mappings(Target_Extra, class_updates)
+            db_session.add_all(new_extras)
+            if delete_ids:
+                db_session.query(Target_Extra).filter(Target_Extra.id.in_(delete_ids)).delete(synchronize_session=False)
 
-        except:
-            raise #continue
+            db_session.commit()
+
+        delete_rows(Db_Changes, change_ids, db_address=_SNEX1_DB)
 
 
 def migrate_data():
@@ -557,4 +727,6 @@ def migrate_data():
         update_phot(action, db_address=_SNEX2_DB)
         update_spec(action, db_address=_SNEX2_DB)
 
-migrate_data()
+
+if __name__ == '__main__':
+    migrate_data()
@@ -0,0 +1,37 @@
+"""
+Positional searches on Targets.
+The HEALPix pixel of each target is kept in TargetHealpix, so cone
+searches pre-select candidates with indexed pixel ranges and only
+compute exact distances for those.
+"""
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from tom_targets.models import Target
+from custom_code.models import TargetHealpix
+from custom_code.spatial import radec_to_healpix, cone_search_queryset
+
+
+def update_target_healpix(target):
+    """
+    Stores (or removes, for targets without a position) the pixel of target
+    """
+    if target.ra is None or target.dec is None:
+        TargetHealpix.objects.filter(target_id=target.id).delete()
+        return
+    TargetHealpix.objects.update_or_create(
+        target_id=target.id, defaults={'healpix': radec_to_healpix(target.ra, target.dec)}
+    )
+
+
+def target_cone_search(queryset, ra, dec, radius):
+    """
+    Returns the targets in queryset within radius degrees of ra, dec.
+    Targets not indexed yet (e.g. written by sync_databases) are still checked
+    """
+    return cone_search_queryset(queryset, ra, dec, radius, field='healpix_index__healpix', unindexed=True)
+
+
+@receiver(post_save, sender=Target)
+def update_target_healpix_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        update_target_healpix(instance)
@@ -2,6 +2,7 @@ from plotly import offline
 import plotly.graph_objs as go
 from django import template, forms
 from django.conf import settings
+from django.db.models import Prefetch
 from django.db.models.functions import Lower
 from django.shortcuts import reverse
 from guardian.shortcuts import get_objects_for_user, get_groups_with_perms
@@ -32,8 +33,12 @@ from custom_code.forms import CustomDataProductUploadForm, PapersForm, PhotSched
 from urllib.parse import urlencode
 from tom_observations.utils import get_sidereal_visibility
 from custom_code.facilities.lco_facility import SnexPhotometricSequenceForm, SnexSpectroscopicSequenceForm
-from custom_code.thumbnails import make_thumb
-import base64
+from custom_code.thumbnails import default_thumb_request, sign_thumb_request
+from custom_code.visibility import get_facility_sites, get_site_airmasses, get_observing_sites, compute_visibility, get_24hr_time_range
+from custom_code.moon import moon_separation_and_illumination
+from custom_code.lightcurves import get_lightcurve, FILTER_TRANSLATE
+from custom_code.lightcurve_fit import choose_fit_filter, get_lightcurve_fit, fit_isot
+from custom_code.spectra import load_spectrum, spectra_queryset
 import logging
 
 logger = logging.getLogger(__name__)
@@ -143,30 +148,8 @@ def get_24hr_airmass(target, interval, airmass_limit):
 
     plot_data = []
     
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
+    time_range = get_24hr_time_range(interval)
     time_plot = time_range.datetime
-    
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
-
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
-    )
 
     #Colors to match SNEx1
     colors = {
@@ -178,41 +161,21 @@ def get_24hr_airmass(target, interval, airmass_limit):
         'Haleakala': '#990099'
     }
 
-    for observing_facility in facility.get_service_classes():
-
-        if observing_facility != 'LCO':
-            continue
-
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
+    observing_facility = 'LCO'
+    sites = get_facility_sites(observing_facility)
 
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -12*u.deg)  #between astro twilights
-            )
+    ### All sites are computed in one broadcast transform (between astro twilights)
+    site_airmasses = get_site_airmasses(target.ra, target.dec, sites, time_range, airmass_limit, sun_alt_limit=-12.0)
 
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
+    for site, obj_airmass in site_airmasses.items():
 
-            label = '({facility}) {site}'.format(
-                facility = observing_facility, site = site
-            )
+        label = '({facility}) {site}'.format(
+            facility = observing_facility, site = site
+        )
 
-            plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, marker=dict(color=colors[site]))
-            )
+        plot_data.append(
+            go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, marker=dict(color=colors[site]))
+        )
 
     return plot_data
 
@@ -244,36 +207,14 @@ def generic_lightcurve_plot(target, user):
     for the different light curve applications SNEx2 uses
     """
     
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2', 
-        'UVW1': 'UVW1'}
-    photometry_data = {}
+    return lightcurve_scatter(get_lightcurve(target, user))
 
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
-    
-    else:
-        datums = get_objects_for_user(user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(
-                                        target=target,
-                                        data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
-    for rd in datums:
-    #for rd in ReducedDatum.objects.filter(target=target, data_type='photometry'):
-        value = rd.value
-        if not value:  # empty
-            continue
-        if isinstance(value, str):
-            value = json.loads(value)
-
-        filt = filter_translate.get(value.get('filter', ''), '')
-   
-        photometry_data.setdefault(filt, {})
-        photometry_data[filt].setdefault('time', []).append(rd.timestamp)
-        photometry_data[filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[filt].setdefault('error', []).append(value.get('error', None))
 
+def lightcurve_scatter(photometry_data):
+    """
+    Scatter traces for each filter of photometry_data, as returned by get_lightcurve
+    """
+    filter_translate = FILTER_TRANSLATE
     plot_data = [
         go.Scatter(
             x=filter_values['time'],
@@ -360,17 +301,10 @@ def lightcurve_collapse(target, user):
 def moon_vis(target):
 
     day_range = 30
-    times = Time(
-        [str(datetime.datetime.utcnow() + datetime.timedelta(days=delta))
-            for delta in np.arange(0, day_range, 0.2)],
-        format = 'iso', scale = 'utc'
-    )
-    
-    obj_pos = SkyCoord(target.ra, target.dec, unit=u.deg)
-    moon_pos = get_moon(times)
+    times = Time(datetime.datetime.utcnow(), scale='utc') + np.arange(0, day_range, 0.2)*u.day
 
-    separations = moon_pos.separation(obj_pos).deg
-    phases = moon_illumination(times)
+    ### The moon positions come from the shared ephemeris, only the separation is per target
+    separations, phases = moon_separation_and_illumination(target.ra, target.dec, times, days=day_range)
 
     distance_color = 'rgb(0, 0, 255)'
     phase_color = 'rgb(255, 0, 0)'
@@ -407,32 +341,33 @@ def moon_vis(target):
 def bin_spectra(waves, fluxes, b):
     """
     Bins spectra given list of wavelengths, fluxes, and binning factor
+
+    Every full group of b points is averaged and bins with a non-positive
+    mean wavelength are dropped. As in the original loop, a leftover
+    partial group at the end repeats the last full bin.
     """
-    binned_waves = []
-    binned_flux = []
-    newindex = 0
-    for index in range(0, len(fluxes), b):
-        if index + b - 1 <= len(fluxes) - 1:
-            sumx = 0
-            sumy = 0
-            for binindex in range(index, index+b, 1):
-                if binindex < len(fluxes):
-                    sumx += waves[binindex]
-                    sumy += fluxes[binindex]
-
-            sumx = sumx / b
-            sumy = sumy / b
-        if sumx > 0:
-            binned_waves.append(sumx)
-            binned_flux.append(sumy)
-
-    return binned_waves, binned_flux
+    waves = np.asarray(waves, dtype=float)
+    fluxes = np.asarray(fluxes, dtype=float)
+
+    nbins = len(fluxes) // b
+    if nbins == 0:
+        return [], []
+
+    binned_waves = waves[:nbins*b].reshape(nbins, b).sum(axis=1) / b
+    binned_flux = fluxes[:nbins*b].reshape(nbins, b).sum(axis=1) / b
+
+    if len(fluxes) % b:
+        binned_waves = np.append(binned_waves, binned_waves[-1])
+        binned_flux = np.append(binned_flux, binned_flux[-1])
+
+    good = binned_waves > 0
+    return binned_waves[good].tolist(), binned_flux[good].tolist()
 
 
 @register.inclusion_tag('custom_code/spectra.html')
 def spectra_plot(target, dataproduct=None):
     spectra = []
-    spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('timestamp')
+    spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target=target, data_type='spectroscopy')).order_by('timestamp')
     if dataproduct:
         spectral_dataproducts = DataProduct.objects.get(dataproduct=dataproduct)
     
@@ -445,20 +380,8 @@ def spectra_plot(target, dataproduct=None):
     ) for color in colors]
 
     for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = load_spectrum(spectrum)
 
         binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
         spectra.append((binned_wavelength, binned_flux, name))
@@ -506,21 +429,9 @@ def spectra_plot(target, dataproduct=None):
 @register.inclusion_tag('custom_code/spectra_collapse.html')
 def spectra_collapse(target):
     spectra = []
-    spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
+    spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target=target, data_type='spectroscopy')).order_by('-timestamp')
     for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = load_spectrum(spectrum)
         
         binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
         spectra.append((binned_wavelength, binned_flux))
@@ -762,7 +673,7 @@ def dash_spectra(context, target):
 
     ### Send the min and max flux values 
     target_id = target.id
-    spectral_dataproducts = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy')
+    spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy'))
     if not spectral_dataproducts:
         return {'dash_context': {},
                 'request': request
@@ -779,22 +690,10 @@ def dash_spectra(context, target):
     min_flux = 0
     for i in range(len(spectral_dataproducts)):
         spectrum = spectral_dataproducts[i]
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(value['wavelength'])
-                flux.append(float(value['flux']))
-        if max(flux) > max_flux: max_flux = max(flux)
-        if min(flux) < min_flux: min_flux = min(flux)
+        wavelength, flux = load_spectrum(spectrum)
+        if flux.max() > max_flux: max_flux = float(flux.max())
+        if flux.min() < min_flux: min_flux = float(flux.min())
 
     dash_context = {'target_id': {'value': target.id},
                     'target_redshift': {'value': z},
@@ -830,12 +729,13 @@ def custom_observation_plan(target, facility, length=1, interval=30, airmass_lim
     start_time = datetime.datetime.now()
     end_time = start_time + datetime.timedelta(days=length)
 
-    visibility_data = get_sidereal_visibility(target, start_time, end_time, interval, airmass_limit)
-    i = 0
     plot_data = []
-    for site, data in visibility_data.items():
-        plot_data.append(go.Scatter(x=data[0], y=data[1], mode='markers+lines', marker={'symbol': i}, name=site))
-        i += 1
+    if target.type == 'SIDEREAL':
+        ### Every site is computed in one broadcast transform (between astronomical twilights)
+        sites = get_observing_sites()
+        time_range, airmass = compute_visibility([target], sites, start_time, end_time, interval, airmass_limit)
+        for i, site in enumerate(sites.keys()):
+            plot_data.append(go.Scatter(x=time_range.datetime, y=airmass[0, i], mode='markers+lines', marker={'symbol': i}, name=site))
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Date'),
         yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Airmass'),
@@ -872,29 +772,59 @@ def observation_summary(context, target=None, time='previous'):
 
     observations = observations.order_by('parameters__start')
 
-    if time == 'ongoing':
-        cadences = DynamicCadence.objects.filter(active=True, observation_group__in=ObservationGroup.objects.filter(name__in=[o.parameters.get('name', '') for o in observations]))
-    
-    else:
-        if time == 'pending':
-            observations = observations.filter(observation_id='template pending')
-        cadences = DynamicCadence.objects.filter(active=False, observation_group__in=ObservationGroup.objects.filter(name__in=[o.parameters.get('name', '') for o in observations]))
-    
+    if time == 'pending':
+        observations = observations.filter(observation_id='template pending')
+    observation_names = list(observations.values_list('parameters__name', flat=True))
+
+    ### Fetch the cadences with their groups and records in one go
+    cadences = DynamicCadence.objects.filter(
+        active=(time == 'ongoing'),
+        observation_group__name__in=[name or '' for name in observation_names]
+    ).select_related('observation_group').prefetch_related(
+        Prefetch('observation_group__observation_records',
+                 queryset=ObservationRecord.objects.order_by('id'),
+                 to_attr='ordered_records')
+    )
+    cadences = list(cadences)
+
+    ### And all the comments on those groups, with their authors' names
+    content_type_id = ContentType.objects.get_for_model(ObservationGroup).id
+    comments_by_group = {}
+    comments = Comment.objects.filter(
+        content_type_id=content_type_id,
+        object_pk__in=[str(cadence.observation_group_id) for cadence in cadences]
+    ).order_by('id')
+    for comment in comments:
+        comments_by_group.setdefault(comment.object_pk, []).append(comment)
+    first_names = dict(User.objects.filter(
+        username__in={comment.user_name for group_comments in comments_by_group.values() for comment in group_comments}
+    ).values_list('username', 'first_name'))
+
+    instrument_dict = {'2M0-FLOYDS-SCICAM': 'Floyds',
+                       '1M0-SCICAM-SINISTRO': 'Sinistro',
+                       '2M0-SCICAM-MUSCAT': 'Muscat',
+                       '2M0-SPECTRAL-AG': 'Spectra',
+                       '0M4-SCICAM-SBIG': 'SBIG'
+    }
+
     parameters = []
     for cadence in cadences:
-        obsgroup = ObservationGroup.objects.get(id=cadence.observation_group_id)
+        obsgroup = cadence.observation_group
+        records = obsgroup.ordered_records
+        if not records:
+            continue
         #Check if the request is pending, and if so skip it
-        pending_obs = obsgroup.observation_records.all().filter(observation_id='template pending').first()
+        pending_obs = next((r for r in records if r.observation_id == 'template pending'), None)
         if not pending_obs and time == 'pending':
             continue
         
         if time == 'pending':
             observation = pending_obs
         else:
-            observation = obsgroup.observation_records.all().filter(observation_id='template').first()
+            observation = next((r for r in records if r.observation_id == 'template'), None)
         if not observation:
-            observation = obsgroup.observation_records.all().order_by('-id').first()
-            first_observation = obsgroup.observation_records.all().order_by('id').first()
+            observation = records[-1]
+            first_observation = records[0]
             sequence_start = str(first_observation.parameters.get('start')).split('T')[0]
             requested_str = ''
         else:
@@ -915,57 +845,47 @@ def observation_summary(context, target=None, time='previous'):
             else:
                 title_suffix = ''
 
+            observation_type = str(parameter.get('observation_type', ''))
             if parameter.get('cadence_strategy', '') == 'SnexResumeCadenceAfterFailureStrategy' and float(parameter.get('cadence_frequency', 0.0)) > 0.0:
-                parameter_string = str(parameter.get('cadence_frequency', '')) + '-day ' + str(parameter.get('observation_type', '')).lower() + ' cadence of '
+                summary = [str(parameter.get('cadence_frequency', '')), '-day ', observation_type.lower(), ' cadence of ']
             else:
-                parameter_string = 'Single ' + str(parameter.get('observation_type', '')).lower() + ' observation of '
+                summary = ['Single ', observation_type.lower(), ' observation of ']
 
-            if parameter.get('observation_type', '') == 'IMAGING':
+            if observation_type == 'IMAGING':
                 filters = ['U', 'B', 'V', 'R', 'I', 'u', 'gp', 'rp', 'ip', 'zs', 'w']
                 for f in filters:
                     filter_parameters = parameter.get(f, '')
-                    if filter_parameters:
-                        if filter_parameters[0] != 0.0:
-                            filter_string = f + ' (' + str(filter_parameters[0]) + 'x' + str(filter_parameters[1]) + '), '
-                            parameter_string += filter_string 
+                    if filter_parameters and filter_parameters[0] != 0.0:
+                        summary.append('{} ({}x{}), '.format(f, filter_parameters[0], filter_parameters[1]))
             
-            elif parameter.get('observation_type', '') == 'SPECTRA':
-                parameter_string += str(parameter.get('exposure_time', ''))
-                parameter_string += 's '
+            elif observation_type == 'SPECTRA':
+                summary.append('{}s '.format(parameter.get('exposure_time', '')))
 
             if parameter.get('observation_mode') == 'TIME_CRITICAL':
-                parameter_string += '(time critical) '
+                summary.append('(time critical) ')
             elif parameter.get('observation_mode') == 'RAPID_RESPONSE':
-                parameter_string += '(rapid response) '
-
-            instrument_dict = {'2M0-FLOYDS-SCICAM': 'Floyds',
-                               '1M0-SCICAM-SINISTRO': 'Sinistro',
-                               '2M0-SCICAM-MUSCAT': 'Muscat',
-                               '2M0-SPECTRAL-AG': 'Spectra',
-                               '0M4-SCICAM-SBIG': 'SBIG'
-            }
+                summary.append('(rapid response) ')
 
             if parameter.get('instrument_type') in instrument_dict.keys():
-                parameter_string += 'with ' + instrument_dict[parameter.get('instrument_type')]
+                summary.append('with ' + instrument_dict[parameter.get('instrument_type')])
 
-            parameter_string += ', IPP ' + str(parameter.get('ipp_value', ''))
-            parameter_string += ' and airmass < ' + str(parameter.get('max_airmass', ''))
-            parameter_string += ' starting on ' + sequence_start #str(parameter.get('start')).split('T')[0]
+            summary.append(', IPP {}'.format(parameter.get('ipp_value', '')))
+            summary.append(' and airmass < {}'.format(parameter.get('max_airmass', '')))
+            summary.append(' starting on ' + sequence_start)
             endtime = parameter.get('sequence_end', '')
             if not endtime:
                 endtime = parameter.get('end', '')
 
             if time == 'previous' and endtime:
-                parameter_string += ' and ending on ' + str(endtime).split('T')[0]
-            parameter_string += requested_str
+                summary.append(' and ending on ' + str(endtime).split('T')[0])
+            summary.append(requested_str)
 
             ### Get any comments associated with this observation group
-            content_type_id = ContentType.objects.get(model='observationgroup').id
-            comments = Comment.objects.filter(object_pk=obsgroup.id, content_type_id=content_type_id).order_by('id')
-            comment_list = ['{}: {}'.format(User.objects.get(username=comment.user_name).first_name, comment.comment) for comment in comments]
+            comment_list = ['{}: {}'.format(first_names.get(comment.user_name, comment.user_name), comment.comment)
+                            for comment in comments_by_group.get(str(obsgroup.id), [])]
 
             parameters.append({'title': 'LCO Sequence'+title_suffix,
-                               'summary': parameter_string,
+                               'summary': ''.join(summary),
                                'comments': comment_list,
                                'observation': observation.id,
                                'group': obsgroup.id})
@@ -973,11 +893,15 @@ def observation_summary(context, target=None, time='previous'):
         # Now do Gemini observations
         elif parameter.get('facility', '') == 'Gemini':
             
+            scheduled = str(observation.created).split(' ')[0]
             if 'SPECTRA' in parameter.get('observation_type', ''):
-                parameter_string = 'Gemini spectrum of B exposure time ' + str(parameter.get('b_exptime', '')) + 's and R exposure time ' + str(parameter.get('r_exptime', '')) + 's with airmass <' + str(parameter.get('max_airmass', '')) + ', scheduled on ' + str(observation.created).split(' ')[0]
+                parameter_string = 'Gemini spectrum of B exposure time {}s and R exposure time {}s with airmass <{}, scheduled on {}'.format(
+                    parameter.get('b_exptime', ''), parameter.get('r_exptime', ''), parameter.get('max_airmass', ''), scheduled)
 
             else: # Gemini photometry
-                parameter_string = 'Gemini photometry of g (' + str(parameter.get('g_exptime', '')) + 's), r (' + str(parameter.get('r_exptime', '')) + 's), i (' + str(parameter.get('i_exptime', '')) + 's), and z (' + str(parameter.get('z_exptime', '')) + 's), with airmass < ' + str(parameter.get('max_airmass', '')) + ', scheduled on ' + str(observation.created).split(' ')[0]
+                parameter_string = 'Gemini photometry of g ({}s), r ({}s), i ({}s), and z ({}s), with airmass < {}, scheduled on {}'.format(
+                    parameter.get('g_exptime', ''), parameter.get('r_exptime', ''), parameter.get('i_exptime', ''),
+                    parameter.get('z_exptime', ''), parameter.get('max_airmass', ''), scheduled)
 
             parameters.append({'title': 'Gemini Sequence',
                                'summary': parameter_string,
@@ -1281,12 +1205,29 @@ def dash_spectra_page(context, target):
 
     ### Send the min and max flux values
     target_id = target.id
-    spectral_dataproducts = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy').order_by('timestamp')
+    spectral_dataproducts = spectra_queryset(ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy')).order_by('timestamp')
     if not spectral_dataproducts:
         return {'dash_context': {},
                 'request': request
             }
     
+    ### Look up the SNEx1 ids, extra information and comments for all the spectra at once
+    spectrum_ids = [spectrum.id for spectrum in spectral_dataproducts]
+    snex1_ids = dict(ReducedDatumExtra.objects.filter(
+        data_type='spectroscopy', key='snex_id', reduced_datum_id__in=spectrum_ids
+    ).order_by('-id').values_list('reduced_datum_id', 'snex_id'))
+    spec_extras_rows = dict(ReducedDatumExtra.objects.filter(
+        data_type='spectroscopy', key='spec_extras', snex_id__in=set(snex1_ids.values())
+    ).order_by('-id').values_list('snex_id', 'value'))
+
+    content_type_id = ContentType.objects.get_for_model(ReducedDatum).id
+    spectrum_comments = {}
+    for comment in Comment.objects.filter(object_pk__in=[str(spectrum_id) for spectrum_id in spectrum_ids], content_type_id=content_type_id).order_by('id'):
+        spectrum_comments.setdefault(comment.object_pk, []).append(comment)
+    first_names = dict(User.objects.filter(
+        username__in={comment.user_name for comments in spectrum_comments.values() for comment in comments}
+    ).values_list('username', 'first_name'))
+
     plot_list = []
     for i in range(len(spectral_dataproducts)):
     
@@ -1294,29 +1235,16 @@ def dash_spectra_page(context, target):
         min_flux = 0
         
         spectrum = spectral_dataproducts[i]
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(value['wavelength'])
-                flux.append(float(value['flux']))
-        if max(flux) > max_flux: max_flux = max(flux)
-        if min(flux) < min_flux: min_flux = min(flux)
-
-        snex_id_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', target_id=target_id, key='snex_id', value__icontains='"snex2_id": {}'.format(spectrum.id)).first()
-        if snex_id_row:
-            snex1_id = json.loads(snex_id_row.value)['snex_id']
-            spec_extras_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='spec_extras', value__icontains='"snex_id": {}'.format(snex1_id)).first()
+        wavelength, flux = load_spectrum(spectrum)
+        if flux.max() > max_flux: max_flux = float(flux.max())
+        if flux.min() < min_flux: min_flux = float(flux.min())
+
+        snex1_id = snex1_ids.get(spectrum.id)
+        if snex1_id is not None:
+            spec_extras_row = spec_extras_rows.get(snex1_id)
             if spec_extras_row:
-                spec_extras = json.loads(spec_extras_row.value)
+                spec_extras = json.loads(spec_extras_row)
                 if spec_extras.get('instrument', '') == 'en06':
                     spec_extras['site'] = '(OGG 2m)'
                     spec_extras['instrument'] += ' (FLOYDS)'
@@ -1324,9 +1252,8 @@ def dash_spectra_page(context, target):
                     spec_extras['site'] = '(COJ 2m)'
                     spec_extras['instrument'] += ' (FLOYDS)'
 
-                content_type_id = ContentType.objects.get(model='reduceddatum').id
-                comments = Comment.objects.filter(object_pk=spectrum.id, content_type_id=content_type_id).order_by('id')
-                comment_list = ['{}: {}'.format(User.objects.get(username=comment.user_name).first_name, comment.comment) for comment in comments]
+                comments = spectrum_comments.get(str(spectrum.id), [])
+                comment_list = ['{}: {}'.format(first_names.get(comment.user_name, comment.user_name), comment.comment) for comment in comments]
                 spec_extras['comments'] = comment_list
             
             else:
@@ -1611,19 +1538,12 @@ def image_slideshow(context, target):
     choices = {'filenames': thumbdict}
     thumbnailform = ThumbnailForm(initial=initial, choices=choices)
 
-    ### Make the initial thumbnail
-    if psfxs[0] < 9999 and psfys[0] < 9999:
-        f = make_thumb(['data/fits/'+filepaths[0]+filenames[0]+'.fits'], grow=1.0, x=psfxs[0], y=psfys[0], ticks=True)
-    else:
-        f = make_thumb(['data/fits/'+filepaths[0]+filenames[0]+'.fits'], grow=1.0, x=1024, y=1024, ticks=False)
-
-    with open('data/thumbs/'+f[0], 'rb') as imagefile:        
-        b64_image = base64.b64encode(imagefile.read())
-        thumb = b64_image
+    ### The initial thumbnail is fetched (and made if needed) by the browser
+    thumb_url = reverse('thumbnail', kwargs={'token': sign_thumb_request(default_thumb_request(filepaths[0], filenames[0], psfxs[0], psfys[0]))})
 
     return {'target': target,
             'form': thumbnailform,
-            'thumb': b64_image.decode('utf-8'),
+            'thumb': thumb_url,
             'telescope': teles[0],
             'instrument': filenames[0].split('-')[1][:2],
             'filter': filters[0],
@@ -1633,49 +1553,8 @@ def image_slideshow(context, target):
 @register.inclusion_tag('custom_code/lightcurve_collapse.html')
 def lightcurve_fits(target, user, filt=False, days=None):
     
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2', 
-        'UVW1': 'UVW1'}
-    plot_data = generic_lightcurve_plot(target, user)     
-    photometry_data = {}
-
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
-    else:
-        datums = get_objects_for_user(user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(
-                                        target=target,
-                                        data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
-
-    for rd in datums:
-        value = rd.value
-        if not value:  # empty
-            continue
-        if isinstance(value, str):
-            value = json.loads(value)
-
-        current_filt = filter_translate.get(value.get('filter', ''), '')
-   
-        photometry_data.setdefault(current_filt, {})
-        photometry_data[current_filt].setdefault('time', []).append(rd.timestamp)
-        photometry_data[current_filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[current_filt].setdefault('error', []).append(value.get('error', None))        
-
-    plot_data = [
-        go.Scatter(
-            x=filter_values['time'],
-            y=filter_values['magnitude'], mode='markers',
-            marker=dict(color=get_color(filter_name, filter_translate)),
-            name=filter_translate.get(filter_name, ''),
-            error_y=dict(
-                type='data',
-                array=filter_values['error'],
-                visible=True,
-                color=get_color(filter_name, filter_translate)
-            )
-        ) for filter_name, filter_values in photometry_data.items()] 
+    photometry_data = get_lightcurve(target, user)
+    plot_data = lightcurve_scatter(photometry_data)
      
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
@@ -1694,11 +1573,9 @@ def lightcurve_fits(target, user, filt=False, days=None):
             'filt': ''
         }
     
-        ### Fit a parabola to the lightcurve to find the max
-    if filt and filt in photometry_data.keys(): # User has specified a filter to fit
-        photometry_to_fit = photometry_data[filt]
-    
-    elif filt and filt not in photometry_data.keys(): # No photometry for this filter
+    ### Fit a parabola to the lightcurve to find the max, in the requested filter or the best sampled one
+    fit_filt = choose_fit_filter(photometry_data, filt)
+    if not fit_filt: # No photometry for this filter
         return {
             'target': target,
             'plot': offline.plot(go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False),
@@ -1706,64 +1583,32 @@ def lightcurve_fits(target, user, filt=False, days=None):
             'mag': '',
             'filt': ''
         }
-    
-    else:
-        filtlist = list(photometry_data.keys())
-        lens = []
-        for f in filtlist:
-            lens.append(len(photometry_data[f]['magnitude']))
-        filt = filtlist[lens.index(max(lens))]
-        photometry_to_fit = photometry_data[filt]
-
-    start_date = min(photometry_to_fit['time'])
-    start_jd = Time(start_date, scale='utc').jd
-   
-    times = photometry_to_fit['time']
-    mags = []
-    errs = []
-    jds = []
-
-    if not days:
-        days_to_fit = 20
-    else:
-        days_to_fit = days
-
-    for date in times:
-        if Time(date, scale='utc').jd < start_jd + days_to_fit:
-            jds.append(float(Time(date, scale='utc').jd))
-            mags.append(photometry_to_fit['magnitude'][times.index(date)])
-            errs.append(photometry_to_fit['error'][times.index(date)])
-    try:
-        A, B, C = np.polyfit(jds, mags, 2, w=1/(np.asarray(errs)))
-        fit_jds = np.linspace(min(jds), max(jds), 100)
-        quadratic_fit = A*fit_jds**2 + B*fit_jds + C
+    filt = fit_filt
 
+    fit = get_lightcurve_fit(target, photometry_data, filt, days=days or 20)
+    if fit:
+        max_mag = round(fit['peak_mag'], 2)
         plot_data.append(
             go.Scatter(
-                x=Time(fit_jds, format='jd', scale='utc').isot,
-                y=quadratic_fit, mode='lines',
+                x=fit_isot(fit['fit_jd']),
+                y=fit['fit_mag'], mode='lines',
                 marker=dict(color='gray'),
                 name='n=2 fit'
             )
         )
 
-        max_mag = round(min(quadratic_fit), 2)
-        max_jd = fit_jds[np.argmin(quadratic_fit)]
-        max_date = Time(max_jd, format='jd', scale='utc').isot
-
         plot_data.append(
             go.Scatter(
-                x=[max_date],
+                x=[fit_isot(fit['peak_jd'])],
                 y=[max_mag],
                 mode='markers',
                 marker=dict(color='gold', size=15, symbol='star', line=dict(color='black', width=2)),
                 name='Maximum'
             )
         )
-        maximum = round(abs(B/(2*A)), 2)
-    except Exception as e:
-        logger.info(e)
-        logger.info('Quadratic light curve fit failed for target {}'.format(target.id))
+        maximum = round(fit['max_jd'], 2)
+    else:
+        max_mag = ''
         maximum = ''
 
     return {
@@ -1840,9 +1685,6 @@ def lightcurve_with_extras(target, user):
 @register.inclusion_tag('custom_code/thumbnail.html', takes_context=True)
 def test_display_thumbnail(context, target):
     
-    from os import listdir
-    from os.path import isfile, join
-    
     if not settings.DEBUG:
         #NOTE: Production
         try:
@@ -1869,52 +1711,25 @@ def test_display_thumbnail(context, target):
         return {'top_images': [],
                 'bottom_images': []}
 
-    thumbs = [f for f in listdir('data/thumbs/') if isfile(join('data/thumbs/', f))]
     top_images = []
     bottom_images = [] 
     sites = [f[:3].upper() for f in filenames]
     
-    thumbfiles = []
-    thumbdates = []
-    thumbteles = []
-    thumbsites = []
-    thumbfilters = []
-    thumbexptimes = []
-
+    halfway = round(len(filenames)/2)
+    
+    ### The page only links to the thumbnails, which the browser fetches
+    ### (and which are made if needed) after the page has loaded
     for i in range(len(filenames)):
-        currentfile = filenames[i]
-        if any(currentfile in f and 'grow' not in f for f in thumbs):
-            matchingfiles = [f for f in thumbs if f.startswith(currentfile) and 'grow' not in f]
-            if matchingfiles:
-                thumbfiles.append(matchingfiles[0])
+        thumb_url = reverse('thumbnail', kwargs={'token': sign_thumb_request(default_thumb_request(filepaths[i], filenames[i], psfxs[i], psfys[i]))})
+        label = '{} {} {} {} {}'.format(dates[i], sites[i], teles[i], filters[i], exptimes[i])
+        if i < halfway:
+            top_images.append({'url': thumb_url,
+                               'label': label,
+                            })
         else:
-            # Generate the thumbnail and save the image
-            if psfxs[i] < 9999 and psfys[i] < 9999:
-                f = make_thumb(['data/fits/'+filepaths[i]+currentfile+'.fits'], grow=1.0, x=psfxs[i], y=psfys[i], ticks=True)
-            else:
-                f = make_thumb(['data/fits/'+filepaths[i]+currentfile+'.fits'], grow=1.0, x=1024, y=1024, ticks=False)
-            thumbfiles.append(f[0])
-        
-        thumbdates.append(dates[i])
-        thumbteles.append(teles[i])
-        thumbsites.append(sites[i])
-        thumbfilters.append(filters[i])
-        thumbexptimes.append(exptimes[i])
-    
-    halfway = round(len(thumbfiles)/2)
-    
-    for i in range(len(thumbfiles)):
-        with open('data/thumbs/'+thumbfiles[i], 'rb') as imagefile:        
-            b64_image = base64.b64encode(imagefile.read())
-            label = '{} {} {} {} {}'.format(thumbdates[i], thumbsites[i], thumbteles[i], thumbfilters[i], thumbexptimes[i])
-            if i < halfway:
-                top_images.append({'image': b64_image.decode('utf-8'),
-                                   'label': label,
-                                })
-            else:
-                bottom_images.append({'image': b64_image.decode('utf-8'),
-                                      'label': label
-                                      })
+            bottom_images.append({'url': thumb_url,
+                                  'label': label
+                                  })
 
     return {'top_images': top_images,
             'bottom_images': bottom_images}
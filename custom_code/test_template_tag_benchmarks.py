@@ -0,0 +1,212 @@
+"""
+Renders the heavy target page template tags against synthetic data in the
+test database and checks them against a baseline.
+
+Run with
+    python manage.py test custom_code.test_template_tag_benchmarks
+
+Query counts and output size are compared against the committed
+template_tag_baseline.json (or the JSON at SNEX2_TEMPLATE_TAG_BASELINE).
+Set SNEX2_TEMPLATE_TAG_TIMING=1 to compare wall time too, which is only
+meaningful against a baseline recorded on the same machine, and
+SNEX2_UPDATE_TEMPLATE_TAG_BASELINE=1 to write the results to the
+baseline instead.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.template import Template, RequestContext
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_comments.models import Comment
+from guardian.models import GroupObjectPermission
+from tom_targets.models import Target
+from tom_dataproducts.models import ReducedDatum
+from tom_observations.models import ObservationRecord, ObservationGroup, DynamicCadence
+from datetime import timedelta
+from importlib import import_module
+import numpy as np
+import json
+import os
+import time
+
+
+### The inclusion tags to benchmark, each rendered for the first synthetic target
+TAGS = {
+    'lightcurve': '{% lightcurve target %}',
+    'spectra_plot': '{% spectra_plot target %}',
+    'observation_summary': '{% observation_summary target "ongoing" %}',
+    'airmass_collapse': '{% airmass_collapse target %}',
+    'dash_spectra_page': '{% dash_spectra_page target %}',
+}
+
+FILTERS = ['U', 'B', 'V', 'gp', 'rp', 'ip', 'g_ZTF', 'r_ZTF']
+
+SCALE = {
+    'targets': 3,
+    'photometry': 500,
+    'spectra': 10,
+    'spectrum_points': 1000,
+    'cadences': 10,
+    'comments': 3,
+    'groups': 3,
+}
+REPEAT = 3
+TOLERANCE = 0.25
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template_tag_baseline.json')
+
+
+def baseline_path():
+    return os.environ.get('SNEX2_TEMPLATE_TAG_BASELINE') or BASELINE
+
+
+def make_data(scale):
+    """
+    Makes scale['targets'] synthetic targets with photometry, spectra and
+    observation sequences visible to a new user, and returns the first
+    target and the user
+    """
+    rng = np.random.default_rng(42)
+    now = timezone.now()
+
+    groups = [Group.objects.create(name='benchmark group {}'.format(i)) for i in range(scale['groups'])]
+    user = User.objects.create(username='benchmark_user', first_name='Bench')
+    user.groups.add(groups[0])
+    user.user_permissions.add(*Permission.objects.filter(codename__in=['view_observationrecord']))
+
+    ### bulk_create so the target hooks (which sync to SNEx1) never run
+    Target.objects.bulk_create([
+        Target(name='snex2 benchmark {}'.format(i), type='SIDEREAL', ra=float(rng.uniform(0, 360)), dec=float(rng.uniform(-60, 60)), epoch=2000)
+        for i in range(scale['targets'])
+    ])
+    targets = list(Target.objects.filter(name__startswith='snex2 benchmark ').order_by('id'))
+
+    datums = []
+    for target in targets:
+        for i in range(scale['photometry']):
+            datums.append(ReducedDatum(
+                target=target, data_type='photometry', timestamp=now - timedelta(days=float(rng.uniform(0, 365))),
+                value={'magnitude': float(rng.uniform(14, 21)), 'error': float(rng.uniform(0.01, 0.2)),
+                       'filter': FILTERS[i % len(FILTERS)], 'telescope': 'LCO'}
+            ))
+        wavelength = np.linspace(3500, 9500, scale['spectrum_points'])
+        for i in range(scale['spectra']):
+            flux = rng.normal(1e-16, 1e-17, scale['spectrum_points'])
+            datums.append(ReducedDatum(
+                target=target, data_type='spectroscopy', timestamp=now - timedelta(days=i),
+                value={str(j): {'wavelength': float(w), 'flux': float(f)} for j, (w, f) in enumerate(zip(wavelength, flux))}
+            ))
+    ReducedDatum.objects.bulk_create(datums, batch_size=2000)
+
+    ### Every datum is visible to every group
+    content_type = ContentType.objects.get_for_model(ReducedDatum)
+    view_perm = Permission.objects.get(content_type=content_type, codename='view_reduceddatum')
+    datum_ids = ReducedDatum.objects.filter(target__in=targets).values_list('id', flat=True)
+    GroupObjectPermission.objects.bulk_create([
+        GroupObjectPermission(group=group, permission=view_perm, content_type=content_type, object_pk=str(datum_id))
+        for datum_id in datum_ids for group in groups
+    ], batch_size=5000)
+
+    ### Observation sequences, with a template record and a few observations each
+    obsgroup_type = ContentType.objects.get_for_model(ObservationGroup)
+    site = Site.objects.get_current()
+    for target in targets:
+        for i in range(scale['cadences']):
+            parameters = {'name': 'benchmark {} sequence {}'.format(target.id, i), 'facility': 'LCO',
+                          'observation_type': 'IMAGING', 'cadence_strategy': 'SnexResumeCadenceAfterFailureStrategy',
+                          'cadence_frequency': 3.0, 'instrument_type': '1M0-SCICAM-SINISTRO', 'ipp_value': 1.0,
+                          'max_airmass': 2.0, 'start': now.isoformat(), 'start_user': user.username,
+                          'gp': [300.0, 2], 'rp': [300.0, 2], 'ip': [300.0, 2]}
+            obsgroup = ObservationGroup.objects.create(name=parameters['name'])
+            records = [ObservationRecord.objects.create(target=target, user=user, facility='LCO', parameters=parameters,
+                                                        observation_id=observation_id, status='PENDING')
+                       for observation_id in ['template', '{}-{}-a'.format(target.id, i), '{}-{}-b'.format(target.id, i)]]
+            obsgroup.observation_records.add(*records)
+            DynamicCadence.objects.create(observation_group=obsgroup, cadence_strategy=parameters['cadence_strategy'],
+                                          cadence_parameters={'cadence_frequency': 3.0}, active=True)
+            Comment.objects.bulk_create([
+                Comment(content_type=obsgroup_type, object_pk=str(obsgroup.id), site=site, user=user,
+                        user_name=user.username, comment='Benchmark comment {}'.format(j), submit_date=now)
+                for j in range(scale['comments'])
+            ])
+
+    return targets[0], user
+
+
+class TemplateTagBenchmarkTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ### Set outside setUpTestData, which deep copies its attributes for every test
+        cls.results = {}
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.user = make_data(SCALE)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.environ.get('SNEX2_UPDATE_TEMPLATE_TAG_BASELINE') and len(cls.results) == len(TAGS):
+            with open(baseline_path(), 'w') as f:
+                json.dump({'scale': SCALE, 'results': cls.results}, f, indent=2, sort_keys=True)
+        super().tearDownClass()
+
+    def render_tag(self, name):
+        template = Template('{% load custom_code_tags %}' + TAGS[name])
+        request = RequestFactory().get('/targets/{}/'.format(self.target.id))
+        request.user = self.user
+        ### The dash apps store their initial arguments in the session
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+
+        ### Queries and size are taken from the first, uncached render, and the time from the fastest
+        cache.clear()
+        best = None
+        for i in range(REPEAT):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                output = template.render(RequestContext(request, {'target': self.target, 'user': self.user}))
+                seconds = time.perf_counter() - start
+            if best is None:
+                best = {'seconds': seconds, 'queries': len(queries), 'bytes': len(output.encode('utf-8'))}
+            best['seconds'] = min(best['seconds'], seconds)
+        self.results[name] = best
+        return best
+
+    def check_tag(self, name):
+        result = self.render_tag(name)
+        self.assertGreater(result['bytes'], 0)
+
+        if os.environ.get('SNEX2_UPDATE_TEMPLATE_TAG_BASELINE'):
+            return
+        with open(baseline_path()) as f:
+            baseline = json.load(f)
+        self.assertEqual(baseline.get('scale'), SCALE, 'Baseline was recorded at a different scale')
+        expected = baseline['results'].get(name)
+        if not expected:
+            self.skipTest('No baseline for {}'.format(name))
+
+        self.assertLessEqual(result['queries'], expected['queries'])
+        self.assertLessEqual(result['bytes'], expected['bytes'] * (1 + TOLERANCE))
+        if os.environ.get('SNEX2_TEMPLATE_TAG_TIMING'):
+            self.assertLessEqual(result['seconds'], expected['seconds'] * (1 + TOLERANCE))
+
+    def test_lightcurve(self):
+        self.check_tag('lightcurve')
+
+    def test_spectra_plot(self):
+        self.check_tag('spectra_plot')
+
+    def test_observation_summary(self):
+        self.check_tag('observation_summary')
+
+    def test_airmass_collapse(self):
+        self.check_tag('airmass_collapse')
+
+    def test_dash_spectra_page(self):
+        self.check_tag('dash_spectra_page')
@@ -1,3 +1,1610 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
+from django.urls import reverse
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django_comments.models import Comment
+from guardian.models import GroupObjectPermission
+from guardian.shortcuts import assign_perm
+from tom_targets.models import Target
+from tom_dataproducts.models import ReducedDatum, DataProduct
+from tom_observations.models import ObservationRecord, ObservationGroup, DynamicCadence
+from unittest import mock, skipUnless
+from types import SimpleNamespace
+from io import StringIO
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import requests
+import sqlalchemy
+from sqlalchemy.ext.automap import automap_base
+from astropy import units as u
+from astropy.coordinates import SkyCoord, get_sun, get_moon
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn
+from astropy.time import Time
+from astroplan import Observer, FixedTarget, moon_illumination, time_grid_from_range
+import numpy as np
 
-# Create your tests here.
+from custom_code import hooks
+from custom_code import sync_databases
+from custom_code import lightcurves
+from custom_code import thumbnails
+from custom_code import catalog_ingest
+from custom_code import moon
+from custom_code import lightcurve_fit
+from custom_code.brokers import async_http
+from custom_code.dash_apps import lightcurve as dash_lightcurve
+from custom_code.models import GladeCatalog, NEDLVSCatalog, Papers, PhotometrySnexId, ReducedDatumExtra, SpectrumArrays, TargetHealpix
+from custom_code.visibility import airmass_grid, get_site_airmasses, MAX_VISIBILITY_TARGETS
+from custom_code.spatial import radec_to_healpix, angular_separation, cone_pixel_ranges
+from custom_code.target_search import target_cone_search
+from custom_code.permissions import bulk_assign_perms
+from custom_code.catalog_ingest import null_to_nan, nan_to_none, masked_to_none, write_chunk
+from custom_code.management.commands import ingest_glade_catalog, ingest_ned_catalog
+from custom_code.spectra import spectrum_from_value, load_spectrum, spectra_queryset
+from custom_code.templatetags.custom_code_tags import bin_spectra, observation_summary
+from custom_code.thumbnails import getdata
+
+
+SITES = {
+    'coj': {'latitude': -31.272, 'longitude': 149.07, 'elevation': 1116},
+    'lsc': {'latitude': -30.1673833333, 'longitude': -70.8047888889, 'elevation': 2198},
+    'ogg': {'latitude': 20.7069444444, 'longitude': -156.258055556, 'elevation': 3065},
+}
+
+
+def astroplan_airmass(ra, dec, sites, time_range, airmass_limit, sun_alt_limit):
+    """
+    The per-site astroplan loop get_24hr_airmass used before the shared kernel
+    """
+    fixed_target = FixedTarget(name='target', coord=SkyCoord(ra, dec, unit='deg'))
+    sun_coords = get_sun(time_range[int(len(time_range)/2)])
+    fixed_sun = FixedTarget(name='sun', coord=SkyCoord(sun_coords.ra, sun_coords.dec, unit='deg'))
+
+    airmasses = {}
+    for site, site_details in sites.items():
+        observer = Observer(
+            longitude=site_details.get('longitude')*u.deg,
+            latitude=site_details.get('latitude')*u.deg,
+            elevation=site_details.get('elevation')*u.m
+        )
+        sun_alt = observer.altaz(time_range, fixed_sun).alt
+        obj_airmass = observer.altaz(time_range, fixed_target).secz
+        bad_indices = np.argwhere(
+            (obj_airmass >= airmass_limit) |
+            (obj_airmass <= 1) |
+            (sun_alt > sun_alt_limit*u.deg)
+        )
+        airmasses[site] = np.array([np.nan if i in bad_indices else float(x) for i, x in enumerate(obj_airmass)])
+    return airmasses
+
+
+class AirmassKernelTest(SimpleTestCase):
+
+    def setUp(self):
+        self.time_range = time_grid_from_range(
+            time_range=[Time('2023-03-01 00:00:00'), Time('2023-03-02 00:00:00')],
+            time_resolution=15*u.minute)
+
+    def test_matches_astroplan(self):
+        for ra, dec in [(150.0, -30.0), (10.0, 5.0), (280.0, -60.0)]:
+            expected = astroplan_airmass(ra, dec, SITES, self.time_range, 3.0, -12.0)
+            airmasses = get_site_airmasses(ra, dec, SITES, self.time_range, 3.0, sun_alt_limit=-12.0)
+            self.assertEqual(list(airmasses.keys()), list(SITES.keys()))
+            for site in SITES:
+                np.testing.assert_array_equal(np.isnan(airmasses[site]), np.isnan(expected[site]))
+                np.testing.assert_allclose(airmasses[site], expected[site], rtol=1e-6, equal_nan=True)
+
+    def test_grid_shape_and_masking(self):
+        airmass = airmass_grid([150.0, 10.0], [-30.0, 5.0], SITES, self.time_range, 2.0)
+        self.assertEqual(airmass.shape, (2, len(SITES), len(self.time_range)))
+        finite = airmass[np.isfinite(airmass)]
+        self.assertTrue(finite.size)
+        self.assertTrue(np.all((finite > 1) & (finite < 2.0)))
+
+    def test_no_sites(self):
+        self.assertEqual(get_site_airmasses(150.0, -30.0, {}, self.time_range, 3.0), {})
+        self.assertEqual(airmass_grid([150.0], [-30.0], {}, self.time_range, 3.0).shape, (1, 0, len(self.time_range)))
+
+
+class SharedEngineTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.urls = []
+        for name in ['snex1', 'other']:
+            url = 'sqlite:///' + os.path.join(self.tmpdir.name, name + '.db')
+            engine = sqlalchemy.create_engine(url)
+            with engine.begin() as conn:
+                conn.execute(sqlalchemy.text('CREATE TABLE photlco (id INTEGER PRIMARY KEY, mag FLOAT)'))
+            engine.dispose()
+            self.urls.append(url)
+
+        for registry in [hooks._engines, hooks._automap_bases]:
+            patcher = mock.patch.dict(registry, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: [engine.dispose() for engine in hooks._engines.values()])
+
+    def slow_reflect(self, engine):
+        ### Long enough for every thread to get here before the first reflection is done
+        time.sleep(0.05)
+        return self.reflect(engine)
+
+    def test_one_engine_and_reflection_per_database(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.reflect = hooks._reflect_metadata
+
+        def use(i):
+            url = self.urls[i % 2]
+            table = hooks._load_table('photlco', url)
+            session = hooks._return_session(db_address=url)
+            try:
+                session.query(table).count()
+                return table, session.get_bind()
+            finally:
+                session.close()
+
+        prepare = mock.Mock()
+        def counted_automap_base(**kwargs):
+            Base = automap_base(**kwargs)
+            prepare.side_effect = Base.prepare
+            Base.prepare = prepare
+            return Base
+
+        with mock.patch('custom_code.hooks._reflect_metadata', side_effect=self.slow_reflect), \
+                mock.patch('custom_code.hooks.automap_base', side_effect=counted_automap_base), \
+                mock.patch('custom_code.hooks.create_engine', wraps=sqlalchemy.create_engine) as create:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(use, range(16)))
+            results += [use(i) for i in range(4)]
+
+        self.assertEqual(prepare.call_count, 2)
+        self.assertEqual(create.call_count, 2)
+        for i in range(2):
+            tables = {table for j, (table, engine) in enumerate(results) if j % 2 == i}
+            engines = {engine for j, (table, engine) in enumerate(results) if j % 2 == i}
+            self.assertEqual(len(tables), 1)
+            self.assertEqual(engines, {hooks._engines[self.urls[i]]})
+
+
+### Cone centers including the RA wrap-around and both poles
+CONE_CENTERS = [(0.0, 0.0), (359.99, 10.0), (0.01, -45.0), (180.0, 89.95), (45.0, -89.95), (123.4, 56.7)]
+
+
+def random_points_around(ra, dec, radius, n, rng):
+    """
+    Random points within 2*radius of ra, dec, offset in random directions
+    """
+    theta = np.radians(2*radius)*np.sqrt(rng.uniform(0, 1, n))
+    phi = rng.uniform(0, 2*np.pi, n)
+    coords = SkyCoord(ra, dec, unit='deg').directional_offset_by(phi*u.rad, theta*u.rad)
+    return coords.ra.deg, coords.dec.deg
+
+
+class ConePixelRangesTest(SimpleTestCase):
+
+    def test_ranges_cover_the_cone(self):
+        rng = np.random.default_rng(42)
+        for ra, dec in CONE_CENTERS:
+            for radius in [0.01, 0.5, 5.0]:
+                ranges = cone_pixel_ranges(ra, dec, radius)
+                ras, decs = random_points_around(ra, dec, radius, 2000, rng)
+                inside = angular_separation(ra, dec, ras, decs) <= radius
+                ipix = np.asarray(radec_to_healpix(ras[inside], decs[inside]))
+                covered = np.zeros(len(ipix), dtype=bool)
+                for start, end in ranges:
+                    covered |= (ipix >= start) & (ipix <= end)
+                self.assertTrue(covered.all(), 'Cone at {} {} with radius {} is not covered'.format(ra, dec, radius))
+
+    def test_ranges_are_bounded(self):
+        for ra, dec in CONE_CENTERS:
+            self.assertLessEqual(len(cone_pixel_ranges(ra, dec, 20.0)), 64)
+
+    def test_angular_separation_wraps(self):
+        self.assertAlmostEqual(float(angular_separation(359.99, 0.0, 0.01, 0.0)), 0.02, places=8)
+        self.assertAlmostEqual(float(angular_separation(0.0, 89.99, 180.0, 89.99)), 0.02, places=8)
+
+
+class CatalogConeSearchTest(TestCase):
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        radius = 0.5
+        points = []
+        for ra, dec in CONE_CENTERS:
+            ras, decs = random_points_around(ra, dec, radius, 50, rng)
+            points.extend(zip(ras.tolist(), decs.tolist()))
+        for ra, dec in points:
+            GladeCatalog.objects.create(ra=ra, dec=dec)
+
+        self.assertFalse(GladeCatalog.objects.filter(healpix__isnull=True).exists())
+        all_ras = np.array([p[0] for p in points])
+        all_decs = np.array([p[1] for p in points])
+        for ra, dec in CONE_CENTERS:
+            expected = np.count_nonzero(angular_separation(ra, dec, all_ras, all_decs) <= radius)
+            found = GladeCatalog.objects.cone_search(ra, dec, radius)
+            self.assertEqual(found.count(), expected)
+            for galaxy in found:
+                self.assertLessEqual(float(angular_separation(ra, dec, galaxy.ra, galaxy.dec)), radius)
+
+
+def loop_bin_spectra(waves, fluxes, b):
+    """
+    The loop bin_spectra used before it was vectorized
+    """
+    binned_waves = []
+    binned_flux = []
+    for index in range(0, len(fluxes), b):
+        if index + b - 1 <= len(fluxes) - 1:
+            sumx = 0
+            sumy = 0
+            for binindex in range(index, index+b, 1):
+                if binindex < len(fluxes):
+                    sumx += waves[binindex]
+                    sumy += fluxes[binindex]
+
+            sumx = sumx / b
+            sumy = sumy / b
+        if sumx > 0:
+            binned_waves.append(sumx)
+            binned_flux.append(sumy)
+
+    return binned_waves, binned_flux
+
+
+class BinSpectraTest(SimpleTestCase):
+
+    def test_matches_loop(self):
+        rng = np.random.default_rng(0)
+        for n in [5, 10, 11, 99, 1000, 1003]:
+            waves = list(np.sort(rng.uniform(-100, 10000, n)))
+            fluxes = list(rng.normal(1e-15, 1e-16, n))
+            for b in [1, 2, 3, 5]:
+                if n < b:
+                    continue
+                expected_waves, expected_flux = loop_bin_spectra(waves, fluxes, b)
+                binned_waves, binned_flux = bin_spectra(waves, fluxes, b)
+                np.testing.assert_allclose(binned_waves, expected_waves, rtol=1e-12)
+                np.testing.assert_allclose(binned_flux, expected_flux, rtol=1e-12)
+
+    def test_shorter_than_one_bin(self):
+        self.assertEqual(bin_spectra([4000.0, 4001.0], [1.0, 2.0], 5), ([], []))
+
+
+def snex1_stand_in():
+    """
+    An in-memory SQLite database with the SNEx1 tables sync_databases reads
+    """
+    engine = sqlalchemy.create_engine('sqlite://', poolclass=sqlalchemy.pool.StaticPool, connect_args={'check_same_thread': False})
+    metadata = sqlalchemy.MetaData()
+    columns = {
+        'db_changes': [('tablename', sqlalchemy.String), ('rowid', sqlalchemy.Integer), ('action', sqlalchemy.String)],
+        'photlco': [('targetid', sqlalchemy.Integer), ('mag', sqlalchemy.Float), ('dmag', sqlalchemy.Float), ('filter', sqlalchemy.String),
+                    ('filetype', sqlalchemy.Integer), ('difftype', sqlalchemy.Integer), ('filename', sqlalchemy.String),
+                    ('telescope', sqlalchemy.String), ('instrument', sqlalchemy.String), ('dateobs', sqlalchemy.String),
+                    ('ut', sqlalchemy.String), ('groupidcode', sqlalchemy.Integer)],
+        'spec': [('targetid', sqlalchemy.Integer), ('dateobs', sqlalchemy.String), ('ut', sqlalchemy.String), ('filepath', sqlalchemy.String),
+                 ('filename', sqlalchemy.String), ('telescope', sqlalchemy.String), ('instrument', sqlalchemy.String),
+                 ('exptime', sqlalchemy.Float), ('slit', sqlalchemy.String), ('airmass', sqlalchemy.Float),
+                 ('reducer', sqlalchemy.String), ('groupidcode', sqlalchemy.Integer)],
+        'targets': [('ra0', sqlalchemy.Float), ('dec0', sqlalchemy.Float), ('lastmodified', sqlalchemy.DateTime),
+                    ('datecreated', sqlalchemy.DateTime), ('groupidcode', sqlalchemy.Integer), ('redshift', sqlalchemy.Float),
+                    ('classificationid', sqlalchemy.Integer)],
+        'targetnames': [('targetid', sqlalchemy.Integer), ('name', sqlalchemy.String)],
+        'classifications': [('name', sqlalchemy.String)],
+        'groups': [('name', sqlalchemy.String), ('idcode', sqlalchemy.Integer)],
+    }
+    tables = {}
+    for name, table_columns in columns.items():
+        tables[name] = sqlalchemy.Table(name, metadata, sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                        *[sqlalchemy.Column(column, column_type) for column, column_type in table_columns])
+    metadata.create_all(engine)
+    return engine, tables
+
+
+def snex2_stand_in():
+    """
+    An engine for the Django test database, which has the SNEx2 tables
+    """
+    settings_dict = connection.settings_dict
+    url = sqlalchemy.engine.URL.create(
+        'postgresql', username=settings_dict['USER'] or None, password=settings_dict['PASSWORD'] or None,
+        host=settings_dict['HOST'] or None, port=settings_dict['PORT'] or None, database=settings_dict['NAME'])
+    return sqlalchemy.create_engine(url, poolclass=sqlalchemy.pool.NullPool)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'sync_databases queries the SNEx2 JSONB values')
+class SyncDatabasesTest(TransactionTestCase):
+
+    def setUp(self):
+        self.snex1, self.tables = snex1_stand_in()
+        sync_databases.load_databases(self.snex1, snex2_stand_in(), reload=True)
+        self.addCleanup(self.unload)
+        Target.objects.bulk_create([Target(name='SN 2023sync', type='SIDEREAL', ra=10.0, dec=20.0)])
+        self.target = Target.objects.get(name='SN 2023sync')
+
+    def unload(self):
+        sync_databases.engine2.dispose()
+        sync_databases.engine1 = sync_databases.engine2 = None
+
+    def insert(self, table, rows):
+        with self.snex1.begin() as conn:
+            conn.execute(self.tables[table].insert(), rows)
+
+    def add_changes(self, table, action, rowids):
+        self.insert('db_changes', [{'tablename': table, 'rowid': rowid, 'action': action} for rowid in rowids])
+
+    def pending_changes(self):
+        with self.snex1.connect() as conn:
+            return conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(self.tables['db_changes'])).scalar()
+
+    def add_photometry(self, ids, mag=18.0):
+        self.insert('photlco', [{'id': id_, 'targetid': self.target.id, 'mag': mag, 'dmag': 0.1, 'filter': 'rp', 'filetype': 1,
+                                 'filename': 'image.fits', 'telescope': '1m0', 'instrument': 'fa01', 'dateobs': '2023-01-01',
+                                 'ut': '01:00:00', 'groupidcode': None} for id_ in ids])
+
+    def synced_magnitudes(self):
+        return {datum.value['snex_id']: datum.value['magnitude'] for datum in ReducedDatum.objects.filter(target=self.target, data_type='photometry')}
+
+    def test_photometry_insert_update_delete(self):
+        self.add_photometry([1, 2, 3])
+        self.add_changes('photlco', 'insert', [1, 2, 3])
+        sync_databases.update_phot('insert')
+        self.assertEqual(self.synced_magnitudes(), {1: 18.0, 2: 18.0, 3: 18.0})
+        self.assertEqual(set(PhotometrySnexId.objects.values_list('snex_id', flat=True)), {1, 2, 3})
+        self.assertEqual(self.pending_changes(), 0)
+
+        with self.snex1.begin() as conn:
+            conn.execute(self.tables['photlco'].update().where(self.tables['photlco'].c.id.in_([2, 3])).values(mag=17.0))
+        self.add_changes('photlco', 'update', [2, 3, 3])
+        sync_databases.update_phot('update')
+        self.assertEqual(self.synced_magnitudes(), {1: 18.0, 2: 17.0, 3: 17.0})
+        self.assertEqual(self.pending_changes(), 0)
+
+        self.add_changes('photlco', 'update', [1])
+        self.add_changes('photlco', 'delete', [1, 3])
+        sync_databases.update_phot('delete')
+        self.assertEqual(self.synced_magnitudes(), {2: 17.0})
+        self.assertEqual(set(PhotometrySnexId.objects.values_list('snex_id', flat=True)), {2})
+        ### The pending update of a deleted row is cleared along with the delete
+        self.assertEqual(self.pending_changes(), 0)
+
+    def test_batches_page_past_batch_size(self):
+        n = 2*sync_databases.BATCH_SIZE + 1
+        self.add_photometry(range(1, n + 1))
+        self.add_changes('photlco', 'insert', range(1, n + 1))
+
+        batches = [len(batch) for batch in sync_databases.iter_db_changes('photlco', 'insert')]
+        self.assertEqual(batches, [sync_databases.BATCH_SIZE, sync_databases.BATCH_SIZE, 1])
+
+        start = time.perf_counter()
+        sync_databases.update_phot('insert')
+        rows_per_second = n / (time.perf_counter() - start)
+        self.assertEqual(len(self.synced_magnitudes()), n)
+        self.assertEqual(self.pending_changes(), 0)
+        ### One transaction per batch, not per row
+        self.assertGreater(rows_per_second, 200)
+
+    def test_unindexed_lookup_reads_string_values(self):
+        ReducedDatum.objects.bulk_create([
+            ReducedDatum(target=self.target, data_type='photometry', timestamp=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc),
+                         value={'magnitude': 18.0, 'filter': 'rp', 'snex_id': 5}),
+            ### Older rows hold the JSON as a string
+            ReducedDatum(target=self.target, data_type='photometry', timestamp=datetime.datetime(2023, 1, 2, tzinfo=datetime.timezone.utc),
+                         value=json.dumps({'magnitude': 18.5, 'filter': 'rp', 'snex_id': 6})),
+        ])
+        with sync_databases.get_session(db_address=sync_databases._SNEX2_DB) as db_session:
+            snex2_ids = sync_databases.get_phot_datum_ids([5, 6, 7], db_session)
+        self.assertEqual(set(snex2_ids.keys()), {5, 6})
+        self.assertEqual(dict(PhotometrySnexId.objects.values_list('snex_id', 'reduced_datum_id')), snex2_ids)
+
+        self.add_photometry([6], mag=16.0)
+        self.add_changes('photlco', 'update', [6])
+        sync_databases.update_phot('update')
+        self.assertEqual(ReducedDatum.objects.get(pk=snex2_ids[6]).value['magnitude'], 16.0)
+
+        self.add_changes('photlco', 'delete', [5, 6])
+        sync_databases.update_phot('delete')
+        self.assertFalse(ReducedDatum.objects.filter(target=self.target).exists())
+
+    def test_delete_from_large_table(self):
+        n, deleted = 500000, 1000
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO tom_dataproducts_reduceddatum (target_id, data_type, source_name, source_location, timestamp, value) "
+                "SELECT %s, 'photometry', '', '', now(), jsonb_build_object('magnitude', 18.0, 'snex_id', i) FROM generate_series(1, %s) AS i",
+                [self.target.id, n])
+            cursor.execute(
+                "INSERT INTO custom_code_photometrysnexid (snex_id, reduced_datum_id) "
+                "SELECT (value->>'snex_id')::int, id FROM tom_dataproducts_reduceddatum WHERE target_id = %s",
+                [self.target.id])
+            cursor.execute('ANALYZE')
+        self.add_changes('photlco', 'delete', range(1, n + 1, n // deleted))
+
+        start = time.perf_counter()
+        sync_databases.update_phot('delete')
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(ReducedDatum.objects.filter(target=self.target).count(), n - deleted)
+        self.assertEqual(self.pending_changes(), 0)
+
+    def test_targets_and_extras(self):
+        now = datetime.datetime(2023, 1, 1)
+        target_id = self.target.id + 1000
+        self.insert('classifications', [{'id': 3, 'name': 'SN Ia'}])
+        self.insert('targets', [{'id': target_id, 'ra0': 150.0, 'dec0': -30.0, 'lastmodified': now, 'datecreated': now,
+                                 'groupidcode': 0, 'redshift': 0.01, 'classificationid': 3}])
+        self.insert('targetnames', [{'targetid': target_id, 'name': 'SN 2023new'}])
+        self.add_changes('targets', 'insert', [target_id])
+        self.add_changes('targetnames', 'insert', [target_id])
+
+        sync_databases.update_target('insert')
+        sync_databases.update_target_extra('insert')
+        target = Target.objects.get(pk=target_id)
+        self.assertEqual((target.name, target.ra, target.dec), ('SN 2023new', 150.0, -30.0))
+        self.assertEqual(TargetHealpix.objects.get(target=target).healpix, radec_to_healpix(150.0, -30.0))
+        self.assertEqual(target.targetextra_set.get(key='classification').value, 'SN Ia')
+        self.assertEqual(self.pending_changes(), 0)
+
+        with self.snex1.begin() as conn:
+            conn.execute(self.tables['targets'].update().values(ra0=151.0, redshift=0.02))
+        self.add_changes('targets', 'update', [target_id])
+        sync_databases.update_target('update')
+        sync_databases.update_target_extra('update')
+        target.refresh_from_db()
+        self.assertEqual(target.ra, 151.0)
+        self.assertEqual(target.targetextra_set.get(key='redshift').float_value, 0.02)
+        self.assertEqual(TargetHealpix.objects.get(target=target).healpix, radec_to_healpix(151.0, -30.0))
+
+    def test_spectra_insert_and_delete(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        with open(os.path.join(tmpdir.name, 'spectrum.ascii'), 'w') as f:
+            f.write('4000.0 1e-16\n5000.0 2e-16\n6000.0 nan\n')
+        self.insert('spec', [{'id': 9, 'targetid': self.target.id, 'dateobs': '2023-01-01', 'ut': '02:00:00',
+                              'filepath': tmpdir.name + '/', 'filename': 'spectrum.fits', 'telescope': '2m0', 'groupidcode': None}])
+        self.add_changes('spec', 'insert', [9])
+        sync_databases.update_spec('insert')
+
+        spectrum = ReducedDatum.objects.get(target=self.target, data_type='spectroscopy')
+        wavelength, flux = load_spectrum(spectrum)
+        np.testing.assert_array_equal(wavelength, [4000.0, 5000.0])
+        np.testing.assert_array_equal(flux, [1e-16, 2e-16])
+        self.assertEqual(ReducedDatumExtra.objects.get(key='snex_id', snex_id=9).reduced_datum_id, spectrum.id)
+
+        self.add_changes('spec', 'delete', [9])
+        sync_databases.update_spec('delete')
+        self.assertFalse(ReducedDatum.objects.filter(target=self.target).exists())
+        self.assertFalse(ReducedDatumExtra.objects.filter(key='snex_id', snex_id=9).exists())
+        self.assertEqual(self.pending_changes(), 0)
+
+
+class LightcurveCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.target = Target.objects.create(name='SN 2023abc', type='SIDEREAL', ra=10.0, dec=20.0)
+        self.group = Group.objects.create(name='lightcurve-group')
+        self.user = User.objects.create(username='lightcurve-user')
+        self.user.groups.add(self.group)
+        self.datums = [
+            ReducedDatum.objects.create(
+                target=self.target, data_type='photometry',
+                timestamp=datetime.datetime(2023, 1, 1 + i, tzinfo=datetime.timezone.utc),
+                value={'magnitude': 18.0 + i, 'error': 0.1, 'filter': 'r'}
+            ) for i in range(2)
+        ]
+        self.content_type = ContentType.objects.get_for_model(ReducedDatum)
+        self.permission = Permission.objects.get(content_type=self.content_type, codename='view_reduceddatum')
+        self.grant(self.datums[0])
+
+    def grant(self, datum):
+        ### bulk_create, like sync_databases, sends no signals
+        GroupObjectPermission.objects.bulk_create([GroupObjectPermission(
+            group=self.group, permission=self.permission, content_type=self.content_type, object_pk=str(datum.pk)
+        )])
+
+    def magnitudes(self):
+        return lightcurves.get_lightcurve(self.target, self.user).get('r', {}).get('magnitude', np.array([])).tolist()
+
+    def test_unchanged_photometry_is_cached(self):
+        with mock.patch('custom_code.lightcurves.build_lightcurve', wraps=lightcurves.build_lightcurve) as build:
+            self.assertEqual(self.magnitudes(), [18.0])
+            self.assertEqual(self.magnitudes(), [18.0])
+        self.assertEqual(build.call_count, 1)
+
+    def test_rebuilt_after_value_edit_without_signals(self):
+        self.assertEqual(self.magnitudes(), [18.0])
+        ReducedDatum.objects.filter(pk=self.datums[0].pk).update(value={'magnitude': 17.5, 'error': 0.1, 'filter': 'r'})
+        self.assertEqual(self.magnitudes(), [17.5])
+
+    def test_rebuilt_after_permission_change_without_signals(self):
+        self.assertEqual(self.magnitudes(), [18.0])
+        self.grant(self.datums[1])
+        self.assertEqual(self.magnitudes(), [18.0, 19.0])
+
+
+class ThumbnailTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        thumb_dir = os.path.join(self.tmpdir.name, 'thumbs') + '/'
+        os.makedirs(thumb_dir)
+        patcher = mock.patch('custom_code.thumbnails.THUMB_DIR', thumb_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_token_expires(self):
+        token = thumbnails.sign_thumb_request({'filename': 'data/fits/image.fits', 'grow': 1.0})
+        self.assertEqual(thumbnails.load_thumb_request(token)['filename'], 'data/fits/image.fits')
+        later = datetime.datetime.now().timestamp() + thumbnails.THUMB_TOKEN_MAX_AGE + 60
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            with self.assertRaises(signing.SignatureExpired):
+                thumbnails.load_thumb_request(token)
+
+    def test_locks_do_not_pile_up(self):
+        filename = os.path.join(self.tmpdir.name, 'image.fits')
+        fits.PrimaryHDU(np.random.default_rng(5).normal(100, 10, (200, 200)).astype(np.float32)).writeto(filename)
+
+        names = [thumbnails.get_thumb({'filename': filename, 'x': x, 'y': 100, 'width': 40, 'height': 40})
+                 for x in range(60, 140, 10)]
+        self.assertEqual(len(set(names)), len(names))
+        self.assertEqual(sorted(f for f in os.listdir(thumbnails.THUMB_DIR) if f != 'locks'), sorted(names))
+        self.assertLessEqual(len(os.listdir(os.path.join(thumbnails.THUMB_DIR, 'locks'))), thumbnails.THUMB_LOCKS)
+
+    def write_image(self, name='image.fits', seed=5):
+        filename = os.path.join(self.tmpdir.name, name)
+        fits.PrimaryHDU(np.random.default_rng(seed).normal(100, 10, (200, 200)).astype(np.float32)).writeto(filename, overwrite=True)
+        return filename
+
+    def thumbs_on_disk(self):
+        return sorted(f for f in os.listdir(thumbnails.THUMB_DIR) if f != 'locks')
+
+    def test_name_changes_with_source_and_parameters(self):
+        filename = self.write_image()
+        params = thumbnails._thumb_params(x=100, y=100)
+        name = thumbnails.thumb_name(filename, **params)
+        self.assertEqual(thumbnails.thumb_name(filename, **params), name)
+
+        for key, value in [('grow', 2.0), ('sky', 90.0), ('sig', 5.0), ('x', 101), ('y', 99), ('width', 100),
+                           ('height', 100), ('ticks', True), ('spansig', 3), ('skip', 1)]:
+            with self.subTest(key=key):
+                self.assertNotEqual(thumbnails.thumb_name(filename, **dict(params, **{key: value})), name)
+
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        touched = thumbnails.thumb_name(filename, **params)
+        self.assertNotEqual(touched, name)
+
+        ### Same mtime, different size
+        with open(filename, 'ab') as f:
+            f.write(b'\0' * 2880)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(thumbnails.thumb_name(filename, **params), touched)
+
+    def test_batch_renders_identical_requests_once(self):
+        first, second = self.write_image('first.fits', 1), self.write_image('second.fits', 2)
+        batch = [{'filename': first, 'x': 100, 'y': 100},
+                 {'filename': second, 'x': 100, 'y': 100},
+                 {'filename': first, 'x': 100, 'y': 100, 'grow': 1.0},
+                 {'filename': os.path.join(self.tmpdir.name, 'missing.fits')},
+                 {'filename': first, 'x': 100, 'y': 100}]
+
+        with mock.patch('custom_code.thumbnails._render_thumb', wraps=thumbnails._render_thumb) as render:
+            names = thumbnails.make_thumbs(batch, max_workers=1)
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(names[0], names[2])
+        self.assertEqual(names[0], names[4])
+        self.assertIsNone(names[3])
+        self.assertEqual(self.thumbs_on_disk(), sorted({names[0], names[1]}))
+
+        ### In parallel, each distinct thumbnail is still written once
+        for name in self.thumbs_on_disk():
+            os.remove(thumbnails.THUMB_DIR + name)
+        self.assertEqual(thumbnails.make_thumbs(batch, max_workers=4), names)
+        self.assertEqual(self.thumbs_on_disk(), sorted({names[0], names[1]}))
+
+    def test_failed_write_leaves_no_file(self):
+        filename = self.write_image()
+
+        def save(image, fp, *args, **kwargs):
+            fp.write(b'RIFF partial')
+            raise OSError('disk full')
+
+        with mock.patch('PIL.Image.Image.save', save):
+            with self.assertRaises(OSError):
+                thumbnails.make_thumb([filename], x=100, y=100)
+        self.assertEqual(self.thumbs_on_disk(), [])
+
+        ### And the next request renders it
+        name, = thumbnails.make_thumb([filename], x=100, y=100)
+        self.assertEqual(self.thumbs_on_disk(), [name])
+
+
+class GetdataTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(3)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, hdus):
+        filename = os.path.join(self.tmpdir.name, name)
+        fits.HDUList(hdus).writeto(filename)
+        return filename
+
+    def assert_matches_astropy(self, filename, ext=0, region=None, skip=0):
+        expected = fits.getdata(filename, ext=ext).astype(float)
+        if region:
+            x1, x2, y1, y2 = region
+            expected = expected[y1:y2+1, x1:x2+1]
+        expected = expected[::skip+1, ::skip+1]
+        np.testing.assert_allclose(getdata(filename, region=region, skip=skip, ext=ext), expected, rtol=1e-6)
+
+    def test_bitpix(self):
+        data = self.rng.uniform(0, 1000, (40, 60))
+        for dtype in [np.uint8, np.int16, np.int32, np.float32, np.float64, np.uint16]:
+            filename = self.write('image_{}.fits'.format(np.dtype(dtype).name), [fits.PrimaryHDU(data.astype(dtype))])
+            self.assert_matches_astropy(filename)
+            self.assert_matches_astropy(filename, region=[5, 30, 10, 35], skip=2)
+
+    def test_bscale_bzero(self):
+        hdu = fits.PrimaryHDU(self.rng.uniform(-50, 50, (30, 30)))
+        hdu.scale('int16', bscale=0.01, bzero=3.0)
+        filename = self.write('scaled.fits', [hdu])
+        self.assert_matches_astropy(filename, region=[0, 29, 0, 29], skip=1)
+
+    def test_extension(self):
+        filename = self.write('extensions.fits', [
+            fits.PrimaryHDU(self.rng.uniform(0, 10, (15, 17)).astype(np.float32)),
+            fits.ImageHDU(self.rng.uniform(0, 10, (25, 21)).astype(np.float32)),
+        ])
+        self.assert_matches_astropy(filename, ext=1, region=[2, 18, 3, 20])
+
+    def test_fpacked(self):
+        filename = self.write('packed.fits.fz', [
+            fits.PrimaryHDU(),
+            fits.CompImageHDU(self.rng.integers(0, 1000, (50, 50)).astype(np.int32)),
+        ])
+        self.assert_matches_astropy(filename, ext=1, region=[10, 40, 5, 45], skip=1)
+
+
+class AsyncHttpTest(SimpleTestCase):
+
+    def setUp(self):
+        async_http._response_cache.clear()
+
+    def tearDown(self):
+        async_http._response_cache.clear()
+
+    def test_gather_limited_caps_concurrency(self):
+        running = []
+        peak = []
+
+        async def work(i):
+            running.append(i)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(i)
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        results = async_http.run(async_http.gather_limited([work(i) for i in range(20)], limit=4))
+        self.assertLessEqual(max(peak), 4)
+        self.assertEqual([r for r in results if not isinstance(r, Exception)], [i for i in range(20) if i != 3])
+        self.assertIsInstance(results[3], ValueError)
+
+    def test_response_cache_is_bounded(self):
+        with mock.patch.object(async_http, 'RESPONSE_CACHE_SIZE', 3):
+            for i in range(5):
+                async_http._cache_set(('service', i), i, 60)
+            self.assertEqual(list(async_http._response_cache.keys()), [('service', i) for i in range(2, 5)])
+
+            ### Reading an entry keeps it over less recently used ones
+            self.assertEqual(async_http._cache_get(('service', 2)), 2)
+            async_http._cache_set(('service', 5), 5, 60)
+            self.assertEqual(async_http._cache_get(('service', 3)), None)
+            self.assertEqual(async_http._cache_get(('service', 2)), 2)
+
+    def test_expired_responses_are_dropped(self):
+        async_http._cache_set(('service', 'old'), 'old', -1)
+        self.assertEqual(async_http._cache_get(('service', 'old')), None)
+        self.assertNotIn(('service', 'old'), async_http._response_cache)
+
+        async_http._response_cache[('service', 'stale')] = (0, 'stale')
+        async_http._cache_set(('service', 'new'), 'new', 60)
+        self.assertEqual(list(async_http._response_cache.keys()), [('service', 'new')])
+
+
+class StandInSession:
+    """
+    Stands in for a requests.Session, answering every request with
+    handler(method, url, kwargs) after delay seconds
+    """
+
+    def __init__(self, handler, delay=0):
+        self.handler = handler
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight = 0
+        self.peak = 0
+
+    def request(self, method, url, timeout=None, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, kwargs))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return self.handler(method, url, kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def stand_in_response(status_code=200, text='', headers=None):
+    return SimpleNamespace(status_code=status_code, text=text, headers=headers or {})
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+        await REAL_SLEEP(0)
+
+
+REAL_SLEEP = asyncio.sleep
+FAST_SERVICES = {name: dict(limits, rate=1000.0, burst=100) for name, limits in async_http.SERVICES.items()}
+
+
+class ServiceClientTest(SimpleTestCase):
+
+    def setUp(self):
+        async_http._response_cache.clear()
+        self.addCleanup(async_http._response_cache.clear)
+        self.clock = FakeClock()
+        for target, new in [('custom_code.brokers.async_http.time', self.clock), ('asyncio.sleep', self.clock.sleep)]:
+            patcher = mock.patch(target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, session, service='alerce', retries=3, url='https://broker.example/object'):
+        async def get():
+            client = async_http.ServiceClient(service, retries=retries)
+            client.session = session
+            return await client.get(url)
+        return async_http.run(get())
+
+    def test_bucket_holds_the_rate(self):
+        async def acquire(n):
+            bucket = async_http.TokenBucket(2.0, burst=3)
+            times = []
+            for i in range(n):
+                await bucket.acquire()
+                times.append(self.clock.now)
+            return times
+
+        times = async_http.run(acquire(9))
+        self.assertEqual(times[:3], [0.0, 0.0, 0.0])
+        np.testing.assert_allclose(np.diff(times[2:]), 0.5)
+
+    def test_failures_are_retried_then_raised(self):
+        responses = iter([stand_in_response(503), stand_in_response(502), stand_in_response(200, '{"ok": true}')])
+        session = StandInSession(lambda *args: next(responses))
+        self.assertEqual(self.get(session).json(), {'ok': True})
+        self.assertEqual(len(session.calls), 3)
+        ### Jittered exponential backoff between the attempts
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(1.0 <= self.clock.sleeps[0] <= 3.0)
+        self.assertTrue(2.0 <= self.clock.sleeps[1] <= 6.0)
+
+        session = StandInSession(lambda *args: stand_in_response(500))
+        with self.assertRaises(async_http.RetryableError):
+            self.get(session, retries=2, url='https://broker.example/other')
+        self.assertEqual(len(session.calls), 3)
+
+        def refuse(*args):
+            raise requests.ConnectionError('refused')
+        session = StandInSession(refuse)
+        with self.assertRaises(requests.ConnectionError):
+            self.get(session, retries=1, url='https://broker.example/down')
+        self.assertEqual(len(session.calls), 2)
+
+    def test_retry_after_is_honoured(self):
+        responses = iter([stand_in_response(429, headers={'Retry-After': '7'}), stand_in_response(200, 'done')])
+        session = StandInSession(lambda *args: next(responses))
+        self.assertEqual(self.get(session).text, 'done')
+        self.assertEqual(self.clock.sleeps, [7.0])
+
+    def test_successful_responses_are_cached(self):
+        session = StandInSession(lambda *args: stand_in_response(200, 'cached'))
+        self.assertEqual(self.get(session).text, 'cached')
+        self.assertEqual(self.get(session).text, 'cached')
+        self.assertEqual(len(session.calls), 1)
+
+
+@mock.patch.dict(async_http.SERVICES, FAST_SERVICES)
+class BrokerFanOutTest(SimpleTestCase):
+
+    def setUp(self):
+        async_http._response_cache.clear()
+        self.addCleanup(async_http._response_cache.clear)
+
+    def serve(self, handler, delay=0.02):
+        session = StandInSession(handler, delay=delay)
+        patcher = mock.patch('custom_code.brokers.async_http.requests.Session', return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_alerce_lightcurves(self):
+        from custom_code.brokers.queries.alerce_queries import AlerceQuery
+
+        def lightcurve(method, url, kwargs):
+            name = url.split('/')[-2]
+            if name == 'ZTF23bad':
+                return stand_in_response(404, '{"detail": "not found"}')
+            mjd = float(name[-2:])
+            return stand_in_response(200, json.dumps({
+                'detections': [{'fid': 1, 'mjd': mjd, 'magpsf': 18.0, 'sigmapsf': 0.1},
+                               {'fid': 2, 'mjd': mjd + 1, 'magpsf': 18.5, 'sigmapsf': 0.2}],
+                'non_detections': [{'fid': 2, 'mjd': mjd - 1, 'diffmaglim': 20.0}]}))
+        session = self.serve(lightcurve)
+
+        query = AlerceQuery.__new__(AlerceQuery)
+        query.candidates = ['ZTF23aa{:02d}'.format(i) for i in range(40)] + ['ZTF23bad']
+        det, nondet = query.get_photometry()
+
+        self.assertEqual(len(session.calls), 41)
+        self.assertLessEqual(session.peak, async_http.SERVICES['alerce']['concurrency'])
+        self.assertGreater(session.peak, 1)
+        self.assertNotIn('ZTF23bad', det)
+        for i in range(40):
+            name = 'ZTF23aa{:02d}'.format(i)
+            self.assertEqual(det[name], {'g': {str(float(i)): [18.0, 0.1]}, 'r': {str(float(i + 1)): [18.5, 0.2]}})
+            self.assertEqual(nondet[name], {'g': {}, 'r': {str(float(i - 1)): 20.0}})
+
+    @mock.patch.dict(os.environ, {'TNS_APIKEY': 'key', 'TNS_APIID': '1'})
+    def test_lookup_candidates(self):
+        ### The command reads the deployment's queries.json when imported
+        with mock.patch('builtins.open', mock.mock_open(read_data='{}')):
+            from custom_code.management.commands.ingest_alert_stream_targets import lookup_candidates
+
+        def services(method, url, kwargs):
+            if 'ned.ipac' in url:
+                ra = float(url.split('lon=')[1].split('d')[0])
+                if ra >= 20:
+                    return stand_in_response(200, 'header\nname|ra|dec|type|v|x|z\nG1|1|2|G|0|0|\n')
+                return stand_in_response(200, 'header\nname|ra|dec|type|v|x|z\nG1|1|2|G|0|0|{}\n'.format(ra/1000))
+            data = json.loads(kwargs['data']['data'])
+            if url.endswith('/search'):
+                reply = [{'objname': '2023' + data['internal_name'][-3:]}] if data['internal_name'] != 'ZTF23new' else []
+                return stand_in_response(200, json.dumps({'data': {'reply': reply}}))
+            return stand_in_response(200, json.dumps({'data': {'reply': {'object_type': {'name': 'SN II'}}}}))
+        session = self.serve(services)
+
+        names = ['ZTF23k{:02d}'.format(i) for i in range(30)] + ['ZTF23new', 'ZTF23old']
+        coords = {name: [float(i), -10.0] for i, name in enumerate(names)}
+        q = SimpleNamespace(coords=coords, redshifts={'ZTF23old': {'z': 0.05, 'source': 'host'}},
+                            classes={'ZTF23old': 'SN Ia'})
+        infos = async_http.run(lookup_candidates(q, names))
+
+        for i, (name, info) in enumerate(zip(names[:30], infos)):
+            self.assertEqual(info['z'], i/1000 if 0 < i < 20 else False)
+            self.assertEqual(info['z_source'], 'NED' if 0 < i < 20 else '')
+            self.assertEqual((info['tns_name'], info['sn_class']), ('2023' + name[-3:], 'SN II'))
+        self.assertEqual((infos[30]['tns_name'], infos[30]['sn_class']), (False, ''))
+        self.assertEqual(infos[31], {'z': 0.05, 'z_source': 'host', 'tns_name': False, 'sn_class': 'SN Ia'})
+
+        ### One NED search per candidate without a redshift, and a TNS search (plus object) per unclassified one
+        self.assertEqual(sum('ned.ipac' in url for _, url, _ in session.calls), 31)
+        self.assertEqual(sum(url.endswith('/search') for _, url, _ in session.calls), 31)
+        self.assertEqual(sum(url.endswith('/object') for _, url, _ in session.calls), 30)
+        self.assertGreater(session.peak, 1)
+
+
+class ObservationSummaryTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='summary-user', first_name='Summary')
+        self.user.user_permissions.add(Permission.objects.get(codename='view_observationrecord'))
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def make_sequences(self, name, n):
+        target = Target.objects.create(name=name, type='SIDEREAL', ra=10.0, dec=20.0)
+        obsgroup_type = ContentType.objects.get_for_model(ObservationGroup)
+        for i in range(n):
+            parameters = {'name': '{} sequence {}'.format(name, i), 'facility': 'LCO', 'observation_type': 'IMAGING',
+                          'cadence_strategy': 'SnexResumeCadenceAfterFailureStrategy', 'cadence_frequency': 3.0,
+                          'start': '2023-01-01T00:00:00', 'start_user': self.user.username, 'gp': [300.0, 2]}
+            obsgroup = ObservationGroup.objects.create(name=parameters['name'])
+            obsgroup.observation_records.add(*[
+                ObservationRecord.objects.create(target=target, user=self.user, facility='LCO', parameters=parameters,
+                                                 observation_id=observation_id, status='PENDING')
+                for observation_id in ['template', '{}-{}'.format(name, i)]
+            ])
+            DynamicCadence.objects.create(observation_group=obsgroup, cadence_strategy=parameters['cadence_strategy'],
+                                          cadence_parameters={'cadence_frequency': 3.0}, active=True)
+            Comment.objects.create(content_type=obsgroup_type, object_pk=str(obsgroup.id), site=Site.objects.get_current(),
+                                   user=self.user, user_name=self.user.username, comment='Comment {}'.format(i))
+        return target
+
+    def summarize(self, target):
+        return observation_summary({'request': self.request}, target, 'ongoing')['parameters']
+
+    def test_queries_do_not_grow_with_cadences(self):
+        one = self.make_sequences('SN 2023one', 1)
+        hundred = self.make_sequences('SN 2023hundred', 100)
+        ### The first call also fills the user's permission cache
+        self.summarize(one)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.summarize(one)), 1)
+        with self.assertNumQueries(len(queries)):
+            parameters = self.summarize(hundred)
+
+        self.assertEqual(len(parameters), 100)
+        self.assertEqual(parameters[0]['comments'], ['Summary: Comment 0'])
+
+
+class ReducedDatumExtraIdsTest(TestCase):
+
+    def setUp(self):
+        self.target = Target.objects.create(name='SN 2023extra', type='SIDEREAL', ra=10.0, dec=20.0)
+        self.datum = ReducedDatum.objects.create(target=self.target, data_type='spectroscopy', value={})
+
+    def make_extra(self, value):
+        return ReducedDatumExtra.objects.create(target=self.target, data_type='spectroscopy', key='spec_extras', value=json.dumps(value))
+
+    def test_copies_existing_datum(self):
+        extra = self.make_extra({'snex2_id': self.datum.id, 'snex_id': 12})
+        self.assertEqual(extra.reduced_datum_id, self.datum.id)
+        self.assertEqual(extra.snex_id, 12)
+
+    def test_skips_missing_datum(self):
+        extra = self.make_extra({'snex2_id': self.datum.id + 1000, 'snex_id': 12})
+        self.assertIsNone(extra.reduced_datum_id)
+        self.assertEqual(extra.snex_id, 12)
+
+
+    def test_ids_are_indexed(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, ReducedDatumExtra._meta.db_table)
+        indexed = [c['columns'] for c in constraints.values() if c['index'] or c['foreign_key']]
+        self.assertIn(['snex_id'], indexed)
+        self.assertIn(['reduced_datum_id'], indexed)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Reads the Postgres query plan')
+    def test_lookups_use_the_indexes(self):
+        ReducedDatumExtra.objects.bulk_create([
+            ReducedDatumExtra(target=self.target, data_type='photometry', key='upload_extras', value='{}', snex_id=i)
+            for i in range(20000)
+        ], batch_size=5000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE {}'.format(ReducedDatumExtra._meta.db_table))
+
+        self.assertIn('Index', ReducedDatumExtra.objects.filter(snex_id=12345).explain())
+        self.assertIn('Index', ReducedDatumExtra.objects.filter(reduced_datum_id=self.datum.id).explain())
+
+
+class SpectraTest(TestCase):
+
+    def setUp(self):
+        self.target = Target.objects.create(name='SN 2023spec', type='SIDEREAL', ra=10.0, dec=20.0)
+        self.wavelength = np.linspace(4000, 9000, 50)
+        self.flux = np.linspace(1e-16, 2e-16, 50)
+
+    def points(self):
+        return {str(i): {'wavelength': w, 'flux': f} for i, (w, f) in enumerate(zip(self.wavelength, self.flux))}
+
+    def test_spectrum_from_value_forms(self):
+        for value in [
+            self.points(),
+            json.dumps(self.points()),
+            {'wavelength': self.wavelength.tolist(), 'flux': self.flux.tolist()},
+            {'wavelength': self.wavelength.tolist(), 'photon_flux': self.flux.tolist(), 'flux': []},
+        ]:
+            wavelength, flux = spectrum_from_value(value)
+            np.testing.assert_array_equal(wavelength, self.wavelength)
+            np.testing.assert_array_equal(flux, self.flux)
+
+    def test_unconvertible_spectrum_is_saved_without_arrays(self):
+        datum = ReducedDatum.objects.create(target=self.target, data_type='spectroscopy', value=self.points())
+        self.assertTrue(SpectrumArrays.objects.filter(reduced_datum=datum).exists())
+
+        datum.value = {'0': {'wavelength': 4000.0}}
+        with self.assertLogs('custom_code.spectra', 'WARNING'):
+            datum.save()
+        self.assertFalse(SpectrumArrays.objects.filter(reduced_datum=datum).exists())
+
+    def test_queryset_loads_values_only_without_arrays(self):
+        with_arrays = ReducedDatum.objects.create(target=self.target, data_type='spectroscopy', value=self.points())
+        without_arrays = ReducedDatum.objects.create(target=self.target, data_type='spectroscopy', value=self.points())
+        SpectrumArrays.objects.filter(reduced_datum=without_arrays).delete()
+
+        with self.assertNumQueries(1):
+            spectra = {spectrum.id: spectrum for spectrum in spectra_queryset(ReducedDatum.objects.filter(target=self.target))}
+            for spectrum in spectra.values():
+                wavelength, flux = load_spectrum(spectrum)
+                np.testing.assert_array_equal(wavelength, self.wavelength)
+                np.testing.assert_array_equal(flux, self.flux)
+        self.assertIsNone(spectra[with_arrays.id].spectrum_value)
+
+
+class ThumbnailViewTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        thumb_dir = os.path.join(self.tmpdir.name, 'thumbs') + '/'
+        os.makedirs(thumb_dir)
+        for target in ['custom_code.thumbnails.THUMB_DIR', 'custom_code.views.THUMB_DIR']:
+            patcher = mock.patch(target, thumb_dir)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.filename = os.path.join(self.tmpdir.name, 'image.fits')
+        fits.PrimaryHDU(np.random.default_rng(6).normal(100, 10, (200, 200)).astype(np.float32)).writeto(self.filename)
+        self.url = reverse('thumbnail', kwargs={'token': thumbnails.sign_thumb_request(
+            {'filename': self.filename, 'grow': 1.0, 'spansig': 4, 'x': 100, 'y': 100, 'width': 40, 'height': 40, 'ticks': True})})
+        self.user = User.objects.create(username='thumbnail-user')
+
+    def test_requires_login(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(os.listdir(thumbnails.THUMB_DIR), [])
+
+    def test_rendered_on_miss_then_not_modified(self):
+        self.client.force_login(self.user)
+        with mock.patch('custom_code.thumbnails._render_thumb', wraps=thumbnails._render_thumb) as render:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertEqual(b''.join(response.streaming_content)[8:12], b'WEBP')
+            etag = response['ETag']
+
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(b''.join(response.streaming_content)[8:12], b'WEBP')
+        self.assertEqual(render.call_count, 1)
+
+    def test_bad_token(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url.rstrip('/') + 'x/').status_code, 404)
+        token = thumbnails.sign_thumb_request({'filename': os.path.join(self.tmpdir.name, 'missing.fits')})
+        self.assertEqual(self.client.get(reverse('thumbnail', kwargs={'token': token})).status_code, 404)
+
+    def test_concurrent_requests_render_once(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from custom_code.views import thumbnail_view
+
+        token = self.url.rstrip('/').rsplit('/', 1)[1]
+        def fetch(i):
+            request = RequestFactory().get(self.url)
+            request.user = self.user
+            response = thumbnail_view(request, token)
+            return response.status_code, b''.join(response.streaming_content)
+
+        with mock.patch('custom_code.thumbnails._render_thumb', wraps=thumbnails._render_thumb) as render:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(fetch, range(16)))
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual({status for status, content in results}, {200})
+        self.assertEqual(len({content for status, content in results}), 1)
+
+
+class TargetConeSearchTest(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.radius = 0.5
+        for n, (ra, dec) in enumerate(CONE_CENTERS):
+            ras, decs = random_points_around(ra, dec, self.radius, 20, rng)
+            for i, (target_ra, target_dec) in enumerate(zip(ras.tolist(), decs.tolist())):
+                Target.objects.create(name='cone {} {}'.format(n, i), type='SIDEREAL', ra=target_ra, dec=target_dec)
+            ### bulk_create sends no signals, like sync_databases, so these are not indexed
+            Target.objects.bulk_create([
+                Target(name='unindexed {} {}'.format(n, i), type='SIDEREAL', ra=target_ra, dec=target_dec)
+                for i, (target_ra, target_dec) in enumerate(zip(*random_points_around(ra, dec, self.radius, 5, rng)))
+            ])
+
+    def brute_force(self, queryset, ra, dec):
+        return {target.id for target in queryset if float(angular_separation(ra, dec, target.ra, target.dec)) <= self.radius}
+
+    def test_matches_brute_force(self):
+        self.assertTrue(Target.objects.filter(healpix_index__isnull=True).exists())
+        for ra, dec in CONE_CENTERS:
+            found = set(target_cone_search(Target.objects.all(), ra, dec, self.radius).values_list('id', flat=True))
+            self.assertEqual(found, self.brute_force(Target.objects.all(), ra, dec))
+
+    def test_filters_the_queryset(self):
+        queryset = Target.objects.filter(name__startswith='unindexed')
+        for ra, dec in CONE_CENTERS:
+            found = set(target_cone_search(queryset, ra, dec, self.radius).values_list('id', flat=True))
+            self.assertEqual(found, self.brute_force(queryset, ra, dec))
+
+    def test_index_follows_moved_targets(self):
+        target = Target.objects.filter(name__startswith='cone').first()
+        target.ra, target.dec = (target.ra + 180) % 360, -target.dec
+        target.save()
+        self.assertEqual(TargetHealpix.objects.get(target=target).healpix, radec_to_healpix(target.ra, target.dec))
+        self.assertIn(target, target_cone_search(Target.objects.all(), target.ra, target.dec, 0.01))
+
+
+def glade_line(i, ra='10.5', dec='-20.25'):
+    """
+    A line of a GLADE+ text file for galaxy i
+    """
+    names = [str(1000 + i), 'NGC{}'.format(i), 'null', 'null', 'null', 'null', 'G']
+    mags = ['15.5', '0.1', '1'] + ['null'] * (len(ingest_glade_catalog.MAG_COLUMNS) - 3)
+    two = ['0.01', 'null', '1'] + ['null'] * (len(ingest_glade_catalog.COLUMNS_TWO) - 3)
+    return ' '.join([str(i)] + names + [ra, dec] + mags + two) + '\n'
+
+
+class CatalogIngestTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'glade.txt')
+        with open(self.filename, 'w') as f:
+            for i in range(10):
+                f.write(glade_line(i, ra=str(10.0 + i)))
+            f.write('malformed line\n')
+            f.write(glade_line(10, ra='null', dec='null'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def ingest(self, **options):
+        call_command('ingest_glade_catalog', filename=self.filename, chunk_size=3, stdout=StringIO(), **options)
+
+    def test_null_conversions(self):
+        column = null_to_nan(np.array(['1.5', 'null', '-2']))
+        self.assertTrue(np.isnan(column[1]))
+        self.assertEqual(nan_to_none(column), [1.5, None, -2.0])
+        self.assertEqual(nan_to_none(np.ma.masked_array([1.0, 2.0], mask=[True, False]), cast=int), [None, 2])
+
+    def test_ingests_every_good_line(self):
+        self.ingest()
+        galaxies = GladeCatalog.objects.order_by('ra')
+        self.assertEqual(galaxies.count(), 10)
+        galaxy = galaxies.first()
+        self.assertEqual((galaxy.pgc_no, galaxy.gwgc_name, galaxy.hyperleda_name), (1000, 'NGC0', ''))
+        self.assertEqual(galaxy.mag, {'B': 15.5, 'B_err': 0.1, 'B_flag': 1})
+        self.assertEqual((galaxy.ra, galaxy.dec, galaxy.z_helio, galaxy.z_cmb), (10.0, -20.25, 0.01, None))
+        self.assertEqual(galaxy.healpix, int(radec_to_healpix(10.0, -20.25)))
+        self.assertFalse(os.path.exists(self.filename + '.checkpoint'))
+
+    def test_resumes_from_checkpoint(self):
+        write_chunk = catalog_ingest.write_chunk
+        calls = []
+
+        def fail_second_chunk(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError('interrupted')
+            return write_chunk(*args, **kwargs)
+
+        with mock.patch('custom_code.catalog_ingest.write_chunk', side_effect=fail_second_chunk):
+            with self.assertRaises(RuntimeError):
+                self.ingest()
+        ### Only the first chunk was committed
+        self.assertEqual(GladeCatalog.objects.count(), 3)
+        self.assertEqual(catalog_ingest.IngestCheckpoint(self.filename + '.checkpoint').load(self.filename), 3)
+
+        self.ingest()
+        self.assertEqual(GladeCatalog.objects.count(), 10)
+        self.assertEqual(GladeCatalog.objects.values('pgc_no').distinct().count(), 10)
+        self.assertFalse(os.path.exists(self.filename + '.checkpoint'))
+
+    def test_dry_run_writes_nothing(self):
+        self.ingest(dry_run=True)
+        self.assertFalse(GladeCatalog.objects.exists())
+
+
+def ned_table(n, z=0.01):
+    """
+    A masked NED-LVS table of n galaxies, with neutral names for the plain columns
+    """
+    table = Table(masked=True)
+    for i, name in enumerate(ingest_ned_catalog.TABLE_COLUMN_NAMES):
+        field = NEDLVSCatalog._meta.get_field(name)
+        if name == 'name':
+            values = ['galaxy {}'.format(j) for j in range(n)]
+        elif name == 'ra':
+            values = [10.0 + j for j in range(n)]
+        elif name == 'dec':
+            values = [-20.0] * (n - 1) + [np.nan]
+        elif name == 'z':
+            values = [z] * n
+        elif isinstance(field, models.BooleanField):
+            values = [1.0] * n
+        elif isinstance(field, models.FloatField):
+            values = [2.5] * n
+        else:
+            values = ['x'] * n
+        table['c{}'.format(i)] = MaskedColumn(values, mask=[j == 0 and name not in ('name', 'ra', 'dec', 'z') for j in range(n)])
+    table['A_B'] = [0.1] * n
+    table['m_J'] = [14.0] * n
+    table['Lum_W1'] = [9.0] * n
+    table['SFR_W4'] = [0.5] * n
+    return table
+
+
+class NEDCatalogIngestTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'ned.fits')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def ingest(self, table, **options):
+        table.write(self.filename, overwrite=True)
+        call_command('ingest_ned_catalog', filename=self.filename, chunk_size=2, stdout=StringIO(), **options)
+
+    def test_masked_to_none(self):
+        column = np.ma.masked_array([b' NGC 1 ', b'x', b'y'], mask=[False, False, True])
+        self.assertEqual(masked_to_none(column), ['NGC 1', 'x', None])
+        self.assertEqual(masked_to_none(np.array([' a', 'b '])), ['a', 'b'])
+
+    def test_ingests_table(self):
+        self.ingest(ned_table(5))
+        ### The last galaxy has no position
+        self.assertEqual(NEDLVSCatalog.objects.count(), 4)
+        first, second = NEDLVSCatalog.objects.order_by('ra')[:2]
+        self.assertEqual((first.name, first.z, first.z_qual, first.z_err), ('galaxy 0', 0.01, None, None))
+        self.assertEqual((second.z_qual, second.z_err, second.z_tech), (True, 2.5, 'x'))
+        self.assertEqual((second.extinction, second.mag, second.lum, second.sfr),
+                         ({'A_B': 0.1}, {'m_J': 14.0}, {'Lum_W1': 9.0}, {'SFR_W4': 0.5}))
+        self.assertEqual(second.healpix, int(radec_to_healpix(11.0, -20.0)))
+
+    def test_upsert_updates_in_place(self):
+        self.ingest(ned_table(5))
+        ids = dict(NEDLVSCatalog.objects.values_list('name', 'id'))
+        self.ingest(ned_table(5, z=0.02), upsert=True)
+        self.assertEqual(dict(NEDLVSCatalog.objects.values_list('name', 'id')), ids)
+        self.assertEqual(set(NEDLVSCatalog.objects.values_list('z', flat=True)), {0.02})
+
+        self.ingest(ned_table(5))
+        self.assertEqual(NEDLVSCatalog.objects.count(), 8)
+
+    def test_write_chunk_keeps_last_duplicate(self):
+        write_chunk(NEDLVSCatalog, [NEDLVSCatalog(name='a', ra=1.0, dec=1.0, z=0.1), NEDLVSCatalog(name='a', ra=1.0, dec=1.0, z=0.2),
+                                    NEDLVSCatalog(name=None, ra=2.0, dec=2.0), NEDLVSCatalog(name=None, ra=3.0, dec=3.0)], key='name')
+        self.assertEqual(list(NEDLVSCatalog.objects.filter(name='a').values_list('z', flat=True)), [0.2])
+        self.assertEqual(NEDLVSCatalog.objects.filter(name__isnull=True).count(), 2)
+
+
+class BulkAssignPermsTest(TestCase):
+
+    def setUp(self):
+        self.groups = [Group.objects.create(name='perm group {}'.format(i)) for i in range(3)]
+        self.targets = [Target.objects.create(name='perm target {}'.format(i), type='SIDEREAL', ra=1.0, dec=1.0) for i in range(4)]
+
+    def rows(self):
+        return sorted(GroupObjectPermission.objects.filter(group__in=self.groups).values_list(
+            'group_id', 'permission_id', 'content_type_id', 'object_pk'))
+
+    def test_matches_assign_perm(self):
+        for group in self.groups:
+            for target in self.targets:
+                assign_perm('tom_targets.view_target', group, target)
+        expected = self.rows()
+        GroupObjectPermission.objects.filter(group__in=self.groups).delete()
+
+        bulk_assign_perms('tom_targets.view_target', self.groups, self.targets)
+        self.assertEqual(self.rows(), expected)
+
+    def test_reassigning_adds_nothing(self):
+        bulk_assign_perms('view_target', self.groups[:2], self.targets[:2])
+        bulk_assign_perms('view_target', self.groups, self.targets)
+        bulk_assign_perms('view_target', self.groups, self.targets)
+        self.assertEqual(len(self.rows()), len(self.groups) * len(self.targets))
+
+    def test_querysets_match_lists(self):
+        bulk_assign_perms('tom_targets.change_target', Group.objects.filter(name__startswith='perm group'),
+                          Target.objects.filter(name__startswith='perm target'))
+        from_querysets = self.rows()
+        GroupObjectPermission.objects.filter(group__in=self.groups).delete()
+
+        bulk_assign_perms('tom_targets.change_target', self.groups, self.targets)
+        self.assertEqual(self.rows(), from_querysets)
+
+        bulk_assign_perms('tom_targets.delete_target', self.groups[0], self.targets[0])
+        self.assertEqual(len(self.rows()), len(from_querysets) + 1)
+
+    def test_rejects_permission_of_another_model(self):
+        with self.assertRaises(ValueError):
+            bulk_assign_perms('tom_dataproducts.view_reduceddatum', self.groups, self.targets)
+
+
+class MoonEphemerisTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        moon._moon_ephemerides.clear()
+        self.times = Time(datetime.datetime.utcnow(), scale='utc') + np.arange(0, 30, 0.2)*u.day
+
+    def test_matches_get_moon(self):
+        moon_pos = get_moon(self.times)
+        illumination = moon_illumination(self.times)
+        for ra, dec in [(0.0, 0.0), (120.0, 25.0), (275.0, -60.0), (359.9, 85.0)]:
+            separations, phases = moon.moon_separation_and_illumination(ra, dec, self.times, days=30)
+            expected = moon_pos.separation(SkyCoord(ra, dec, unit=u.deg)).deg
+            self.assertLess(np.max(np.abs(separations - expected)), 0.1)
+            self.assertLess(np.max(np.abs(phases - illumination)), 0.01)
+
+    def test_ephemeris_is_built_once(self):
+        with mock.patch('custom_code.moon._build_moon_ephemeris', wraps=moon._build_moon_ephemeris) as build:
+            moon.moon_separation_and_illumination(10.0, 10.0, self.times)
+            moon.moon_separation_and_illumination(200.0, -10.0, self.times)
+            ### A new process still finds it in the cache
+            moon._moon_ephemerides.clear()
+            moon.moon_separation_and_illumination(10.0, 10.0, self.times)
+        self.assertEqual(build.call_count, 1)
+
+
+class TargetVisibilityViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.default_rng(6)
+        Target.objects.bulk_create([
+            Target(name='visibility {}'.format(i), type='SIDEREAL', ra=float(rng.uniform(0, 360)), dec=float(rng.uniform(-80, 80)))
+            for i in range(MAX_VISIBILITY_TARGETS + 1)
+        ])
+        cls.target_ids = list(Target.objects.filter(name__startswith='visibility').order_by('id').values_list('id', flat=True))
+        cls.user = User.objects.create(username='visibility-user', is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def get(self, target_ids, **params):
+        return self.client.get(reverse('target-visibility'), {'target_id': ','.join(str(i) for i in target_ids), 'facility': 'LCO', **params})
+
+    def test_most_targets(self):
+        start = time.perf_counter()
+        response = self.get(self.target_ids[:MAX_VISIBILITY_TARGETS])
+        seconds = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200)
+        content = response.json()
+        self.assertEqual(len(content['targets']), MAX_VISIBILITY_TARGETS)
+        self.assertEqual(len(content['targets'][0]['airmass']), len(content['sites']))
+        self.assertEqual(len(content['targets'][0]['airmass'][0]), len(content['times']))
+        ### A day at 30 minute resolution for 500 targets is one vectorized grid, not seconds per target
+        self.assertLess(seconds, 10)
+
+    def test_too_many_targets(self):
+        response = self.get(self.target_ids)
+        self.assertEqual(response.status_code, 400)
+
+    def test_too_many_samples(self):
+        with mock.patch('custom_code.views.MAX_VISIBILITY_SAMPLES', 1000):
+            response = self.get(self.target_ids[:100])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get(self.target_ids[:100], length=0.1).status_code, 200)
+
+
+def loop_fit_peak(times, mags, errs, days):
+    """
+    The quadratic fit lightcurve_fits did on raw JDs before the MJD arrays
+    """
+    start_jd = Time(min(times), scale='utc').jd
+    jds, fit_mags, fit_errs = [], [], []
+    for date in times:
+        if Time(date, scale='utc').jd < start_jd + days:
+            jds.append(float(Time(date, scale='utc').jd))
+            fit_mags.append(mags[times.index(date)])
+            fit_errs.append(errs[times.index(date)])
+    A, B, C = np.polyfit(jds, fit_mags, 2, w=1/(np.asarray(fit_errs)))
+    fit_jds = np.linspace(min(jds), max(jds), 100)
+    quadratic_fit = A*fit_jds**2 + B*fit_jds + C
+    return {'max_jd': abs(B/(2*A)), 'peak_jd': fit_jds[np.argmin(quadratic_fit)], 'peak_mag': min(quadratic_fit)}
+
+
+class LightcurveFitTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        rng = np.random.default_rng(4)
+        start = datetime.datetime(2023, 5, 1, tzinfo=datetime.timezone.utc)
+        offsets = np.sort(rng.uniform(0, 40, 80))
+        self.times = [start + datetime.timedelta(days=float(offset)) for offset in offsets]
+        self.mjd = Time(self.times, scale='utc').mjd
+        self.magnitude = 16.0 + 0.01*(offsets - 8.0)**2 + rng.normal(0, 0.02, len(offsets))
+        self.error = rng.uniform(0.01, 0.05, len(offsets))
+
+    def test_matches_loop(self):
+        for days in [10, 20, 35]:
+            expected = loop_fit_peak(self.times, self.magnitude.tolist(), self.error.tolist(), days)
+            fit = lightcurve_fit.fit_peak(self.mjd, self.magnitude, self.error, days=days)
+            self.assertAlmostEqual(fit['max_jd'], expected['max_jd'], delta=1e-3)
+            self.assertAlmostEqual(fit['peak_jd'], expected['peak_jd'], delta=1e-3)
+            self.assertAlmostEqual(fit['peak_mag'], expected['peak_mag'], places=4)
+            self.assertEqual(len(fit['fit_jd']), lightcurve_fit.FIT_POINTS)
+
+    def test_choose_fit_filter(self):
+        photometry_data = {'g': {'magnitude': np.ones(3)}, 'r': {'magnitude': np.ones(5)}}
+        self.assertEqual(lightcurve_fit.choose_fit_filter(photometry_data), 'r')
+        self.assertEqual(lightcurve_fit.choose_fit_filter(photometry_data, 'g'), 'g')
+        self.assertIsNone(lightcurve_fit.choose_fit_filter(photometry_data, 'V'))
+        self.assertIsNone(lightcurve_fit.choose_fit_filter({}))
+
+    def test_cached_per_points(self):
+        target = Target(id=1, name='SN 2023fit')
+        photometry_data = {'r': {'mjd': self.mjd, 'magnitude': self.magnitude, 'error': self.error}}
+        with mock.patch('custom_code.lightcurve_fit.fit_peak', wraps=lightcurve_fit.fit_peak) as fit_peak:
+            first = lightcurve_fit.get_lightcurve_fit(target, photometry_data, 'r')
+            second = lightcurve_fit.get_lightcurve_fit(target, photometry_data, 'r')
+            self.assertEqual(fit_peak.call_count, 1)
+            self.assertEqual(first['max_jd'], second['max_jd'])
+
+            photometry_data['r']['magnitude'] = self.magnitude + 0.1
+            moved = lightcurve_fit.get_lightcurve_fit(target, photometry_data, 'r')
+            self.assertEqual(fit_peak.call_count, 2)
+            self.assertAlmostEqual(moved['peak_mag'], first['peak_mag'] + 0.1, places=6)
+
+    def test_failed_fit(self):
+        target = Target(id=1, name='SN 2023fit')
+        photometry_data = {'r': {'mjd': np.array([]), 'magnitude': np.array([]), 'error': np.array([])}}
+        self.assertIsNone(lightcurve_fit.get_lightcurve_fit(target, photometry_data, 'r'))
+
+
+def loop_select_photometry(target_id, selected_telescope, subtracted_value, selected_algorithm, selected_template,
+                           selected_photometry_type, reduction_type, final_reduction, selected_paper, selected_groups):
+    """
+    The dash lightcurve's old per-toggle selection, querying the datums for
+    each data product, as (magnitude, error) pairs per filter
+    """
+    papers_for_target = [p.id for p in Papers.objects.filter(target_id=target_id)]
+    if len(selected_photometry_type) > 1:
+        selected_photometry_type = selected_photometry_type + ['Mixed', 'Unsure']
+
+    datums = []
+    if not selected_telescope:
+        datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', value__has_key='filter'))
+    else:
+        for de in ReducedDatumExtra.objects.filter(target_id=target_id, key='upload_extras', data_type='photometry'):
+            de_value = json.loads(de.value)
+            if all([de_value.get('instrument', '') in selected_telescope,
+                    de_value.get('photometry_type', '') in selected_photometry_type,
+                    (not final_reduction or de_value.get('final_reduction', '')==final_reduction),
+                    de_value.get('reducer_group', '') in selected_groups,
+                    (not selected_paper or de_value.get('used_in', '')==selected_paper or de_value.get('used_in', '') in papers_for_target)]):
+                datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id=de_value.get('data_product_id', ''), value__has_key='filter'))
+        if 'LCO' in selected_telescope and not final_reduction:
+            datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id__isnull=True, value__has_key='filter'))
+
+    photometry, subtracted = {}, {}
+    for data in datums:
+        for rd in data:
+            value = json.loads(rd.value) if isinstance(rd.value, str) else rd.value
+            if not value or not value.get('magnitude', ''):
+                continue
+            filt = dash_lightcurve.FILTER_TRANSLATE.get(value.get('filter', ''), '')
+            if value.get('background_subtracted', '') == True:
+                if value.get('subtraction_algorithm', '') in selected_algorithm and value.get('template_source', '') in selected_template and reduction_type == 'manual':
+                    subtracted.setdefault(filt, []).append((value['magnitude'], value.get('error')))
+            elif value.get('reduction_type', '') == reduction_type or reduction_type == 'all':
+                photometry.setdefault(filt, []).append((value['magnitude'], value.get('error')))
+
+    selected = subtracted if subtracted_value == 'Subtracted' else photometry
+    return {filt: sorted(points) for filt, points in selected.items()}
+
+
+class DashLightcurveTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.target = Target.objects.create(name='SN 2023dash', type='SIDEREAL', ra=10.0, dec=20.0)
+        day = datetime.timedelta(days=1)
+        start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        values = [
+            ### Automatic LCO photometry from SNEx1, without a data product
+            {'magnitude': 18.0, 'error': 0.1, 'filter': 'gp'},
+            {'magnitude': 18.2, 'error': 0.1, 'filter': 'rp'},
+            {'magnitude': 18.4, 'error': 0.1, 'filter': 'rp', 'reduction_type': 'manual'},
+            {'magnitude': 17.9, 'error': 0.2, 'filter': 'rp', 'background_subtracted': True,
+             'subtraction_algorithm': 'Hotpants', 'template_source': 'LCO', 'reduction_type': 'manual'},
+            {'magnitude': 17.7, 'error': 0.2, 'filter': 'ip', 'background_subtracted': True,
+             'subtraction_algorithm': 'PyZOGY', 'template_source': 'SDSS', 'reduction_type': 'manual'},
+            {'magnitude': '', 'error': 0.1, 'filter': 'gp'},
+            json.dumps({'magnitude': 18.6, 'error': 0.1, 'filter': 'V'}),
+        ]
+        ReducedDatum.objects.bulk_create([
+            ReducedDatum(target=cls.target, data_type='photometry', timestamp=start + i*day, value=value)
+            for i, value in enumerate(values)
+        ])
+
+        ### Uploaded photometry, described by its upload extras
+        uploads = [
+            ('Swift', 'PSF', True, 'UVOT', [{'magnitude': 16.0, 'error': 0.05, 'filter': 'UVW1'},
+                                            {'magnitude': 16.3, 'error': 0.05, 'filter': 'B'}]),
+            ('LCO', 'Aperture', False, '', [{'magnitude': 18.1, 'error': 0.1, 'filter': 'gp', 'reduction_type': 'manual'}]),
+        ]
+        for instrument, photometry_type, final, group, upload_values in uploads:
+            data_product = DataProduct.objects.create(target=cls.target, product_id='{}-upload'.format(instrument),
+                                                      data_product_type='photometry')
+            ReducedDatum.objects.bulk_create([
+                ReducedDatum(target=cls.target, data_product=data_product, data_type='photometry',
+                             timestamp=start + (10 + i)*day, value=value)
+                for i, value in enumerate(upload_values)
+            ])
+            ReducedDatumExtra.objects.create(
+                target=cls.target, data_type='photometry', key='upload_extras',
+                value=json.dumps({'instrument': instrument, 'photometry_type': photometry_type, 'final_reduction': final,
+                                  'reducer_group': group, 'used_in': '', 'data_product_id': data_product.id}))
+        ReducedDatum.objects.create(target=cls.target, data_type='spectroscopy', timestamp=start + 3*day,
+                                    value={'0': {'wavelength': 4000.0, 'flux': 1e-16}})
+
+    def graph(self, photometry, telescopes, subtracted, reduction_type, final='', groups=('',)):
+        return dash_lightcurve.update_graph(
+            telescopes, subtracted, ['Hotpants', 'PyZOGY'], ['LCO', 'SDSS', 'PS1'], ['PSF', 'Aperture'],
+            reduction_type, final, None, list(groups), photometry, 600, 300)
+
+    def test_toggles_match_the_per_toggle_queries_without_querying(self):
+        toggles = [
+            (['LCO'], 'Unsubtracted', ''),
+            (['LCO'], 'Unsubtracted', 'manual'),
+            (['LCO'], 'Unsubtracted', 'all'),
+            (['LCO'], 'Subtracted', 'manual'),
+            (['LCO', 'Swift'], 'Unsubtracted', 'all'),
+            ([], 'Unsubtracted', 'all'),
+            ([], 'Subtracted', 'manual'),
+        ]
+        photometry = dash_lightcurve.update_photometry_store(self.target.id)
+        ### The store goes to the browser and back as JSON
+        photometry = json.loads(json.dumps(photometry))
+
+        for telescopes, subtracted, reduction_type in toggles:
+            with self.subTest(telescopes=telescopes, subtracted=subtracted, reduction_type=reduction_type):
+                with CaptureQueriesContext(connection) as queries:
+                    figure = self.graph(photometry, telescopes, subtracted, reduction_type, groups=['', 'UVOT'])
+                self.assertEqual(len(queries), 0)
+
+                traces = {trace.name: sorted(zip(trace.y.tolist(), trace.error_y.array.tolist()))
+                          for trace in figure['data'] if trace.name is not None}
+                expected = loop_select_photometry(self.target.id, telescopes, subtracted, ['Hotpants', 'PyZOGY'],
+                                                  ['LCO', 'SDSS', 'PS1'], ['PSF', 'Aperture'], reduction_type, False, None, ['', 'UVOT'])
+                self.assertEqual(traces, expected)
+                self.assertTrue(traces)
+
+    def test_final_reduction_leaves_out_automatic_photometry(self):
+        photometry = dash_lightcurve.load_photometry(self.target.id)
+        figure = self.graph(photometry, ['LCO', 'Swift'], 'Unsubtracted', 'all', final=['Final'], groups=['', 'UVOT'])
+        self.assertEqual({trace.name: trace.y.tolist() for trace in figure['data']}, {'UVW1': [16.0], 'B': [16.3]})
+
+        figure = self.graph(photometry, ['Swift'], 'Unsubtracted', 'all', groups=[''])
+        self.assertEqual(figure, 'No photometry yet')
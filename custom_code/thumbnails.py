@@ -6,10 +6,20 @@ Modified from SNEx
 """
 import sys
 import os
+import json
+import hashlib
+import tempfile
+import fcntl
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
 import numpy as np
 from astropy.io import fits
 from PIL import Image, ImageDraw
-from struct import pack, unpack
+from django.core import signing
+import mmap
+
+logger = logging.getLogger(__name__)
 
 
 # ************************************************************
@@ -58,11 +68,12 @@ class ImageThumb:
         self.fixscale = fixscale
 
         # open the image
-        hlist = fits.open(imagepath)
+        hlist = fits.open(imagepath, memmap=True)
 
-        hdu = hlist[0]
+        ext = _image_extension(hlist)
+        hdu = hlist[ext]
         if self.region:
-            data = getdata(imagepath, region=self.region, skip=self.skip, ext=0)
+            data = getdata(imagepath, region=self.region, skip=self.skip, ext=ext)
 
         else:
             data = hdu.data
@@ -221,22 +232,8 @@ def make_depth_256(data, sky=None, sig=None, depth=256, zerosig=-1, spansig=6):
 
 
 # ************************************************************
-DATATYPES = {}
-class intdata:
-    type = 'i'
-    nbytes = 2
-    format = 'h'
-DATATYPES[16] = intdata
-class floatdata:
-    type = 'f'
-    nbytes = 4
-    format = 'f'
-DATATYPES[32] = floatdata
-class floatdata64:
-    type = 'f'
-    nbytes = 4
-    format = 'f'
-DATATYPES[64] = floatdata64
+# big-endian numpy dtypes for each FITS BITPIX
+DATATYPES = {8: '>u1', 16: '>i2', 32: '>i4', -32: '>f4', -64: '>f8'}
 
 BLOCKSIZE = 2880 # FITS standard
 
@@ -253,12 +250,10 @@ def gethead(filename, fp=None, ext=0):
     else:
         f=open(filename, 'rb')
 
-    nx = 0
-    ny = 0
     datasize = 0
     for ex in range(ext + 1):
         # jump to the next header
-        f.seek(nx * ny * datasize, 1)
+        f.seek(datasize, 1)
         pos = f.tell()
         if pos % BLOCKSIZE != 0:
             shift = BLOCKSIZE - (pos % BLOCKSIZE)
@@ -275,17 +270,13 @@ def gethead(filename, fp=None, ext=0):
             # read the next line
             line=f.read(80).decode('UTF-8')
 
-
-        if 'NAXIS1' in header.keys():
-            nx = int(header['NAXIS1'])
-        else:
-            nx = 0
-        if 'NAXIS2' in header.keys():
-            ny = int(header['NAXIS2'])
-        else:
-            ny = 0
-        if 'BITPIX' in header.keys():
-            datasize = abs(int(header['BITPIX']))/8
+        # size of the data section, including any heap
+        naxis = int(header.get('NAXIS', 0))
+        if naxis:
+            datasize = abs(int(header.get('BITPIX', 0))) // 8
+            for i in range(1, naxis + 1):
+                datasize *= int(header.get('NAXIS%d' % i, 0))
+            datasize += int(header.get('PCOUNT', 0))
         else:
             datasize = 0
 
@@ -303,6 +294,39 @@ def gethead(filename, fp=None, ext=0):
 
 
 # ***************************************************************************
+def _clip_region(region, nx, ny):
+    if region == None:
+        region = [0, nx-1, 0, ny-1]
+    x1, x2, y1, y2 = region
+    if x1 < 0: x1 = 0
+    if y1 < 0: y1 = 0
+    if x2 >= nx: x2 = nx-1
+    if y2 >= ny: y2 = ny-1
+    return x1, x2, y1, y2
+
+
+def _scale(section, bitpix, bscale, bzero):
+    """
+    Apply BSCALE/BZERO the same way astropy.io.fits does,
+    including the unsigned and signed integer conventions
+    """
+    if bscale in (None, 1.0) and bzero in (None, 0.0):
+        return section
+    if bscale in (None, 1.0):
+        if bitpix == 16 and bzero == 32768:
+            return (section.astype(np.int32) + 32768).astype(np.uint16)
+        if bitpix == 32 and bzero == 2147483648:
+            return (section.astype(np.int64) + 2147483648).astype(np.uint32)
+        if bitpix == 8 and bzero == -128:
+            return (section.astype(np.int16) - 128).astype(np.int8)
+
+    dtype = np.float64 if bitpix in (32, -64) else np.float32
+    section = section.astype(dtype)
+    if bscale not in (None, 1.0): section *= dtype(bscale)
+    if bzero not in (None, 0.0): section += dtype(bzero)
+    return section
+
+
 def getdata(filename, region=None, skip=0, ext=0):
     """
     Read out a sub section of data from a FITS file
@@ -310,125 +334,279 @@ def getdata(filename, region=None, skip=0, ext=0):
     filename  full path to the FITS file.
     region    subsection to extract [x1, x2, y1, y2]
     skip      integer of rows, columns to skip between reads
-    """
 
-    # get the file pointer
-    f=open(filename, 'rb')#,errors='ignore')
+    Uncompressed images are memory-mapped, so only the requested
+    section is ever read. Tile-compressed (e.g. fpacked) images are
+    decompressed by astropy
+    """
 
     # read in the header
-    startpos, header = gethead(filename, fp=f, ext=ext)
+    startpos, header = gethead(filename, ext=ext)
+
+    if header.get('ZIMAGE', 'F') == 'T':
+        with fits.open(filename, memmap=True) as hlist:
+            hdu = hlist[ext]
+            nx = int(hdu.header['NAXIS1'])
+            ny = int(hdu.header['NAXIS2'])
+            x1, x2, y1, y2 = _clip_region(region, nx, ny)
+            section = hdu.section if hasattr(hdu, 'section') else hdu.data
+            return np.array(section[y1:y2+1, x1:x2+1][::skip+1, ::skip+1])
 
     # grab the keywords necessary to parse the data
     nx = int(header['NAXIS1'])
     ny = int(header['NAXIS2'])
-    bitpix = abs(int(header['BITPIX']))
-    if 'BZERO' in header.keys():
-        bzero = float(header['BZERO'])
-    else:
-        bzero = None
-    if 'BSCALE' in header.keys():
-        bscale = float(header['BSCALE'])
-    else:
-        bscale = None
+    bitpix = int(header['BITPIX'])
+    bzero = float(header['BZERO']) if 'BZERO' in header.keys() else None
+    bscale = float(header['BSCALE']) if 'BSCALE' in header.keys() else None
 
-    # set the data type to read
-    datatype = DATATYPES[bitpix]
+    x1, x2, y1, y2 = _clip_region(region, nx, ny)
 
-    # set the region to the full frame if not specified
-    if region == None:
-        region = [0, nx-1, 0, ny-1]
+    # map the whole image and pull out the section in one go
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            image = np.frombuffer(mm, dtype=DATATYPES[bitpix], count=nx*ny, offset=startpos).reshape(ny, nx)
+            section = image[y1:y2+1:skip+1, x1:x2+1:skip+1]
+            # byteswap to native order, copying only the section out of the map
+            section = section.astype(section.dtype.newbyteorder('='))
+            del image
 
-    # initalize the subarray
-    x1, x2, y1, y2 = region
-    if x1 < 0: x1 = 0
-    if y1 < 0: y1 = 0
-    if x2 >= nx: x2 = nx-1
-    if y2 >= ny: y2 = ny-1
-    nx2 = int(round((x2 - x1) / (skip + 1) + 1))
-    ny2 = int(round((y2 - y1) / (skip + 1) + 1))
-    section = np.zeros((ny2, nx2), dtype=datatype.type)   #### fix! ####
-
-    # read in a continuous line and then throw away any skipped columns
-    fmt = "%s%dx" % (datatype.format, skip * datatype.nbytes)
-    fmt = '>' + (fmt * nx2)
-    buffsize = nx2 * (1 + skip) * datatype.nbytes
-    jumpsize = nx * (1 + skip) * datatype.nbytes
-    
-    # read in the sub array
-    f.seek(startpos)
-
-    # jump to the first section column
-    f.seek((nx * y1 + x1) * datatype.nbytes, 1)
-    for j in range(ny2):
-        pos = f.tell()
+    return _scale(section, bitpix, bscale, bzero)
 
-        # read in the data
-        section[j, :] = unpack(fmt, f.read(buffsize))
 
-        # jump to the next row
-        f.seek(pos + jumpsize, 0)
+def _image_extension(hlist):
+    """
+    Index of the first HDU holding an image, which for
+    tile-compressed files is the first extension
+    """
+    for i, hdu in enumerate(hlist):
+        if int(hdu.header.get('NAXIS', 0)) >= 2:
+            return i
+    return 0
 
-    # we're done reading the file
-    f.close()
 
-    # scale the data as necessary
-    if bscale: section *= bscale
-    if bzero: section += bzero
+# ***************************************************************************
+THUMB_DIR = 'data/thumbs/'
+THUMB_WORKERS = 4  # upper bound on the number of processes used by make_thumbs
+THUMB_LOCKS = 64  # number of lock files shared by all thumbnails
+THUMB_TOKEN_MAX_AGE = 60*60*24*7  # seconds a signed thumbnail URL stays valid
 
-    return section
+
+def _source_path(filename):
+    """
+    Returns the file actually on disk for filename, which may only exist fpacked
+    """
+    if not os.path.exists(filename) and os.path.exists(filename+'.fz'):
+        return filename+'.fz'
+    return filename
+
+
+def thumb_name(filename, **params):
+    """
+    Content-addressed name of the thumbnail for filename rendered with params.
+
+    The key covers the source path, its modification time and size and
+    every render parameter, so thumbnails never go stale and different
+    renderings of the same image never share a file
+    """
+    source = _source_path(filename)
+    stat = os.stat(source)
+    key = json.dumps({'path': os.path.abspath(source),
+                      'mtime': stat.st_mtime_ns,
+                      'size': stat.st_size,
+                      'params': params}, sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+    basename = os.path.basename(filename).replace('.fits', '')
+    return '{}_{}.webp'.format(basename, digest)
+
+
+def _render_thumb(filename, outfile, grow=1.0, sky=None, sig=None, x=900, y=900, width=250, height=250, ticks=False, spansig=4, skip=0):
+    """
+    Render one thumbnail, writing it atomically to outfile
+    """
+    region = [round(x-(width/grow)), round(x+(width/grow)), round(y-(height/grow)), round(y+(height/grow))]
+
+    # load in the image data, reading fpacked files directly
+    thumb = ImageThumb(_source_path(filename), skip=skip, grow=grow, verbose=False, region=region)
+
+    data = thumb.datacube[0][1].copy()
+    data = make_depth_256(data, sky=sky, sig=sig, zerosig=0, spansig=spansig)
+
+    im = thumb.prepare_image(data).convert('RGB')
+
+    ### Do rotations and reflections here
+
+    ### Add crosshair
+    if ticks:
+        x1, x2, y1, y2 = region
+        xoff = -0.5
+        yoff = 1.0
+
+        x_new = int(round((x + xoff - max([0, x1])) * grow))
+        y_new = int(round((min([y2, 4096]) - y + yoff) * grow))
+
+        draw = ImageDraw.Draw(im)
+        draw.line((x_new,y_new+7,x_new,y_new+25), fill='white')
+        draw.line((x_new-7,y_new,x_new-25,y_new), fill='white')
+
+    # write to a temporary file then rename, so readers never see a partial thumbnail
+    fd, tmpfile = tempfile.mkstemp(suffix='.webp.tmp', dir=os.path.dirname(outfile))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, 'WEBP')
+        os.replace(tmpfile, outfile)
+    except:
+        os.remove(tmpfile)
+        raise
+
+
+@contextmanager
+def _thumb_lock(outfile):
+    """
+    Holds an exclusive lock on outfile, shared by every thread and process.
+
+    Thumbnails hash onto a fixed set of lock files, so the locks never
+    pile up next to the thumbnails themselves
+    """
+    lockdir = os.path.join(THUMB_DIR, 'locks')
+    os.makedirs(lockdir, exist_ok=True)
+    index = int(hashlib.sha1(os.path.basename(outfile).encode('utf-8')).hexdigest(), 16) % THUMB_LOCKS
+    with open(os.path.join(lockdir, '{}.lock'.format(index)), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _thumb_params(grow=1.0, sky=None, sig=None, x=900, y=900, width=250, height=250, ticks=False, spansig=4, skip=0, fixscale=None):
+    return {'grow': grow, 'sky': sky, 'sig': sig, 'x': x, 'y': y, 'width': width,
+            'height': height, 'ticks': ticks, 'spansig': spansig, 'skip': skip}
+
+
+def _make_one_thumb(filename, params):
+    """
+    Returns the thumbnail name for filename, rendering it only if it is not cached yet.
+
+    Concurrent requests for the same missing thumbnail wait on a per-file
+    lock, so it is only rendered once
+    """
+    newfile = thumb_name(filename, **params)
+    outfile = THUMB_DIR + newfile
+    if not os.path.exists(outfile):
+        with _thumb_lock(outfile):
+            if not os.path.exists(outfile):
+                _render_thumb(filename, outfile, **params)
+    return newfile
 
 
-# ***************************************************************************
 def make_thumb(files, grow=1.0, sky=None, sig=None, x=900, y=900, width=250, height=250, ticks=False, spansig=4, skip=0, fixscale=None):
     """
     Make thumbnails from a FITS image
     """
-    region = [round(x-(width/grow)), round(x+(width/grow)), round(y-(height/grow)), round(y+(height/grow))]
-    # make the thumbnails
-    outfiles = []
-    for filename in files:
-        # See if fits file needs to be funpacked
-        unpacked = False
-        if not os.path.exists(filename):
-            r = os.system('funpack -D '+filename+'.fz')
-            unpacked = True
-
-        # load in the image data
-        thumb = ImageThumb(filename, skip=skip, grow=grow, verbose=True, region=region)
-        data = thumb.datacube[0][1].copy()
-        data = make_depth_256(data, sky=thumb.sky, sig=thumb.sig, zerosig=0, spansig=spansig)
-
-        im = thumb.prepare_image(data).convert('RGB')
-
-        ### Do rotations and reflections here
-
-        ### Add crosshair
-        if ticks:
-            x1, x2, y1, y2 = region
-            xoff = -0.5
-            yoff = 1.0
-
-            x_new = int(round((x + xoff - max([0, x1])) * grow))
-            y_new = int(round((min([y2, 4096]) - y + yoff) * grow))
-            
-            draw = ImageDraw.Draw(im)
-            draw.line((x_new,y_new+7,x_new,y_new+25), fill='white')
-            draw.line((x_new-7,y_new,x_new-25,y_new), fill='white')
-
-        # make the thumbs
-        if grow == 1.0 and not sig:
-            newfile = filename.split('/')[-1].replace('.fits', '.webp')
-            outfile = 'data/thumbs/'+newfile
-        else:
-            newfile = filename.split('/')[-1].replace('.fits', 'grow{}sig{}.webp'.format(grow, sig))
-            outfile = 'data/thumbs/'+newfile
-        f = open(outfile, 'wb')
-        im.save(f, 'WEBP')
-        f.close()
+    params = _thumb_params(grow=grow, sky=sky, sig=sig, x=x, y=y, width=width, height=height,
+                           ticks=ticks, spansig=spansig, skip=skip)
+    return [_make_one_thumb(filename, params) for filename in files]
+
+
+def default_thumb_request(filepath, filename, psfx, psfy):
+    """
+    The make_thumbs request for the default (unzoomed) thumbnail of a SNEx1 image,
+    centered on the target if its position is known
+    """
+    request = {'filename': 'data/fits/'+filepath+filename+'.fits', 'grow': 1.0}
+    if psfx < 9999 and psfy < 9999:
+        request.update({'x': psfx, 'y': psfy, 'ticks': True})
+    else:
+        request.update({'x': 1024, 'y': 1024, 'ticks': False})
+    return request
+
+
+def get_thumb(item):
+    """
+    Returns the thumbnail name for one make_thumbs request, rendering it if needed
+    """
+    item = dict(item)
+    filename = item.pop('filename')
+    return _make_one_thumb(filename, _thumb_params(**item))
+
+
+def get_thumb_name(item):
+    """
+    Returns the thumbnail name for one make_thumbs request, without rendering it
+    """
+    item = dict(item)
+    filename = item.pop('filename')
+    return thumb_name(filename, **_thumb_params(**item))
 
-        if unpacked:
-            r = os.system('fpack -D -Y '+filename)
 
-        outfiles.append(newfile)
+def sign_thumb_request(item):
+    """
+    Token for a make_thumbs request, used in the URL of the thumbnail view
+    so it can only render thumbnails the site asked for
+    """
+    return signing.dumps(item, salt='custom_code.thumbnails', compress=True)
+
+
+def load_thumb_request(token):
+    """
+    Returns the make_thumbs request for a token from sign_thumb_request,
+    raising signing.BadSignature if it was tampered with or is older than
+    THUMB_TOKEN_MAX_AGE
+    """
+    return signing.loads(token, salt='custom_code.thumbnails', max_age=THUMB_TOKEN_MAX_AGE)
+
+
+def make_thumbs(batch, max_workers=THUMB_WORKERS):
+    """
+    Make many thumbnails in parallel.
+
+    batch is a list of dicts each with a 'filename' and any of the
+    keyword arguments to make_thumb. Returns the thumbnail names in the
+    same order, with None for any that failed to render
+    """
+    jobs = []
+    for item in batch:
+        item = dict(item)
+        filename = item.pop('filename')
+        jobs.append((filename, _thumb_params(**item)))
+
+    outfiles = [None] * len(jobs)
+    todo = {}
+    for i, (filename, params) in enumerate(jobs):
+        try:
+            newfile = thumb_name(filename, **params)
+        except OSError:
+            continue
+        if os.path.exists(THUMB_DIR + newfile):
+            outfiles[i] = newfile
+        else:
+            # the same rendering requested twice is only done once
+            todo.setdefault(newfile, []).append(i)
+
+    if not todo:
+        return outfiles
+
+    if len(todo) == 1 or max_workers <= 1:
+        # not worth starting worker processes
+        for indices in todo.values():
+            try:
+                newfile = _make_one_thumb(*jobs[indices[0]])
+            except Exception as e:
+                logger.warning('Failed to make thumbnail for {}: {}'.format(jobs[indices[0]][0], e))
+                continue
+            for i in indices:
+                outfiles[i] = newfile
+        return outfiles
+
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as executor:
+        futures = {executor.submit(_make_one_thumb, *jobs[indices[0]]): indices for indices in todo.values()}
+        for future in as_completed(futures):
+            try:
+                newfile = future.result()
+            except Exception as e:
+                logger.warning('Failed to make thumbnail for {}: {}'.format(jobs[futures[future][0]][0], e))
+                continue
+            for i in futures[future]:
+                outfiles[i] = newfile
 
     return outfiles
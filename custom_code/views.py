@@ -3,7 +3,7 @@ from django.shortcuts import redirect, render
 from django.db import transaction, IntegrityError
 from django.db.models import Q, DateTimeField, FloatField, F, ExpressionWrapper
 from django.db.models.functions import Cast
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, FileResponse, Http404
 from django.views.generic import View
 from django.views.generic.base import TemplateView
 from django.views.generic.list import ListView
@@ -35,6 +35,7 @@ from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.time import Time
 from datetime import datetime, date, timedelta
+import numpy as np
 import json
 from statistics import median
 from collections import OrderedDict
@@ -42,14 +43,20 @@ from collections import OrderedDict
 from sqlalchemy import create_engine, pool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.automap import automap_base
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
 from plotly import offline
 import plotly.graph_objs as go
 from tom_dataproducts.models import ReducedDatum, DataProduct
 from django.utils.safestring import mark_safe
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.core import signing
 from custom_code.templatetags.custom_code_tags import get_24hr_airmass, airmass_collapse, lightcurve_collapse, spectra_collapse, lightcurve_fits, lightcurve_with_extras, get_best_name, dash_spectra_page, scheduling_list_with_form, smart_name_list
 from custom_code.hooks import _get_tns_params, _return_session, get_unreduced_spectra
-from custom_code.thumbnails import make_thumb
+from custom_code.target_search import target_cone_search
+from custom_code.visibility import get_observing_sites, compute_visibility, MAX_VISIBILITY_TARGETS, MAX_VISIBILITY_SAMPLES
+from custom_code.permissions import bulk_assign_perms
+from custom_code.thumbnails import make_thumb, get_thumb, get_thumb_name, sign_thumb_request, load_thumb_request, THUMB_DIR
 
 from .forms import CustomTargetCreateForm, CustomDataProductUploadForm, PapersForm, PhotSchedulingForm, ReferenceStatusForm
 from tom_targets.views import TargetCreateView
@@ -199,7 +206,7 @@ def target_redirect_view(request):
             ra = float(ra)
             dec = float(dec)
 
-        target_match_list = Target.objects.filter(ra__gte=ra-radius, ra__lte=ra+radius, dec__gte=dec-radius, dec__lte=dec+radius)
+        target_match_list = target_cone_search(Target.objects.all(), ra, dec, radius)
 
         if len(target_match_list) == 1:
             target_id = target_match_list[0].id
@@ -308,9 +315,9 @@ class CustomTargetCreateView(TargetCreateView):
                 self.object = form.save(form)
 
                 # Sync with SNEx1
-                db_session = _return_session()
-                run_hook('target_post_save', target=self.object, created=True, group_names=groups, wrapped_session=db_session)
-                db_session.commit()
+                with closing(_return_session()) as db_session:
+                    run_hook('target_post_save', target=self.object, created=True, group_names=groups, wrapped_session=db_session)
+                    db_session.commit()
             else:
                 logger.info('Submitting target failed with errors {}'.format(form.errors))
                 return super().form_invalid(form)
@@ -393,10 +400,10 @@ class CustomDataProductUploadView(DataProductUploadView):
                 ### -------------------------------------------------------------------
                 
                 if not settings.TARGET_PERMISSIONS_ONLY:
-                    for group in form.cleaned_data['groups']:
-                        assign_perm('tom_dataproducts.view_dataproduct', group, dp)
-                        assign_perm('tom_dataproducts.delete_dataproduct', group, dp)
-                        assign_perm('tom_dataproducts.view_reduceddatum', group, reduced_data)
+                    groups = form.cleaned_data['groups']
+                    bulk_assign_perms('tom_dataproducts.view_dataproduct', groups, dp)
+                    bulk_assign_perms('tom_dataproducts.delete_dataproduct', groups, dp)
+                    bulk_assign_perms('tom_dataproducts.view_reduceddatum', groups, reduced_data)
                 successful_uploads.append(str(dp))
             except InvalidFileFormatException as iffe:
                 ReducedDatum.objects.filter(data_product=dp).delete()
@@ -445,11 +452,10 @@ def save_dataproduct_groups_view(request):
     dp = DataProduct.objects.get(id=dataproduct_id)
     data = ReducedDatum.objects.filter(data_product=dp)
     successful_groups = ''
+    groups = [Group.objects.get(name=i) for i in group_names]
+    bulk_assign_perms('tom_dataproducts.view_dataproduct', groups, dp)
+    bulk_assign_perms('tom_dataproducts.view_reduceddatum', groups, data)
     for i in group_names:
-        group = Group.objects.get(name=i)
-        assign_perm('tom_dataproducts.view_dataproduct', group, dp)
-        for datum in data:
-            assign_perm('tom_dataproducts.view_reduceddatum', group, datum)
         successful_groups += i
     response_data = {'success': successful_groups}
     return HttpResponse(json.dumps(response_data), content_type='application/json')
@@ -529,9 +535,9 @@ def save_comments_view(request):
             ### Save comment in SNEx1 as well
             spec = ReducedDatum.objects.get(id=object_id)
             target_id = int(spec.target_id)
-            snex_id_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', target_id=target_id, value__icontains='"snex2_id": {}'.format(object_id)).first()
+            snex_id_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', reduced_datum_id=object_id).first()
             if snex_id_row:
-                snex1_id = json.loads(snex_id_row.value)['snex_id']
+                snex1_id = snex_id_row.snex_id
                 run_hook('sync_comment_with_snex1', comment, 'spec', user_id, target_id, snex1_id)
         
         return HttpResponse(json.dumps({'success': 'Saved'}))
@@ -782,10 +788,9 @@ def scheduling_view(request):
                 if not settings.TARGET_PERMISSIONS_ONLY:
                     group_id_list = list(GroupObjectPermission.objects.filter(object_pk=obs_id).values_list('group_id', flat=True).distinct())
                     groups = Group.objects.filter(id__in=group_id_list)
-                    for record in new_observations:
-                        assign_perm('tom_observations.view_observationrecord', groups, record)
-                        assign_perm('tom_observations.change_observationrecord', groups, record)
-                        assign_perm('tom_observations.delete_observationrecord', groups, record)
+                    bulk_assign_perms('tom_observations.view_observationrecord', groups, new_observations)
+                    bulk_assign_perms('tom_observations.change_observationrecord', groups, new_observations)
+                    bulk_assign_perms('tom_observations.delete_observationrecord', groups, new_observations)
         
                 ### Sync with SNEx1
                 ## Run hook to cancel old sequence in SNEx1
@@ -981,9 +986,9 @@ def change_target_known_to_view(request):
 
     if action == 'add':
         # Add permissions for this group
-        assign_perm('tom_targets.view_target', group, target)
-        assign_perm('tom_targets.change_target', group, target)
-        assign_perm('tom_targets.delete_target', group, target)
+        bulk_assign_perms('tom_targets.view_target', group, target)
+        bulk_assign_perms('tom_targets.change_target', group, target)
+        bulk_assign_perms('tom_targets.delete_target', group, target)
         response_data = {'success': 'Added'}
         return HttpResponse(json.dumps(response_data), content_type='application/json')
 
@@ -1340,10 +1345,9 @@ class CustomObservationCreateView(ObservationCreateView):
 
         if not settings.TARGET_PERMISSIONS_ONLY:
             groups = form.cleaned_data['groups']
-            for record in records:
-                assign_perm('tom_observations.view_observationrecord', groups, record)
-                assign_perm('tom_observations.change_observationrecord', groups, record)
-                assign_perm('tom_observations.delete_observationrecord', groups, record)
+            bulk_assign_perms('tom_observations.view_observationrecord', groups, records)
+            bulk_assign_perms('tom_observations.change_observationrecord', groups, records)
+            bulk_assign_perms('tom_observations.delete_observationrecord', groups, records)
         
         ### Sync with SNEx1
         
@@ -1420,6 +1424,45 @@ def load_lightcurve_view(request):
     return HttpResponse(json.dumps(context), content_type='application/json')
 
 
+def target_visibility_view(request):
+    """
+    Returns the airmass of many targets at every site at once, for the target list pages.
+
+    Takes target_id (repeated, or comma-separated), and optionally facility,
+    length (days), interval (minutes) and airmass_limit
+    """
+    target_ids = [target_id for value in request.GET.getlist('target_id') for target_id in value.split(',') if target_id]
+    try:
+        target_ids = [int(target_id) for target_id in target_ids]
+        length = float(request.GET.get('length', 1))
+        interval = float(request.GET.get('interval', 30))
+        airmass_limit = float(request.GET.get('airmass_limit', 3.0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400)
+    if interval <= 0 or length <= 0 or length/interval*24*60 > 10000:
+        return JsonResponse({'error': 'Too many time samples requested'}, status=400)
+    if len(set(target_ids)) > MAX_VISIBILITY_TARGETS:
+        return JsonResponse({'error': 'Too many targets requested (at most {})'.format(MAX_VISIBILITY_TARGETS)}, status=400)
+
+    targets = list(get_objects_for_user(request.user, 'tom_targets.view_target').filter(
+        id__in=target_ids, type='SIDEREAL', ra__isnull=False, dec__isnull=False
+    ).order_by('id'))
+    sites = get_observing_sites(request.GET.get('facility') or None)
+    if len(targets) * len(sites) * (length/interval*24*60 + 1) > MAX_VISIBILITY_SAMPLES:
+        return JsonResponse({'error': 'Too many airmass samples requested'}, status=400)
+
+    start = datetime.utcnow()
+    time_range, airmass = compute_visibility(targets, sites, start, start + timedelta(days=length), interval, airmass_limit)
+
+    ### NaN isn't valid JSON, so the masked samples are sent as nulls
+    airmass = np.where(np.isnan(airmass), None, np.round(airmass, 3)).tolist()
+    return JsonResponse({
+        'times': [t.isoformat() for t in time_range.datetime],
+        'sites': list(sites.keys()),
+        'targets': [{'id': target.id, 'name': target.name, 'airmass': airmass[i]} for i, target in enumerate(targets)]
+    })
+
+
 def fit_lightcurve_view(request):
 
     target_id = request.GET.get('target_id', None)
@@ -1644,17 +1687,15 @@ def make_thumbnail_view(request):
     zoom = float(request.GET['zoom'])
     sigma = float(request.GET['sigma'])
 
+    thumb_request = {'filename': 'data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits', 'grow': zoom, 'spansig': sigma}
     if filename_dict['psfx'] < 9999 and filename_dict['psfy'] < 9999:
-        f = make_thumb(['data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits'], grow=zoom, spansig=sigma, x=filename_dict['psfx'], y=filename_dict['psfy'], ticks=True)
+        thumb_request.update({'x': filename_dict['psfx'], 'y': filename_dict['psfy'], 'ticks': True})
     else:
-        f = make_thumb(['data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits'], grow=zoom, spansig=sigma, x=1024, y=1024, ticks=False)
-
-    with open('data/thumbs/'+f[0], 'rb') as imagefile:
-        b64_image = base64.b64encode(imagefile.read())
-        thumb = b64_image.decode('utf-8')
+        thumb_request.update({'x': 1024, 'y': 1024, 'ticks': False})
 
+    ### The browser fetches (and if needed renders) the thumbnail itself
     content_response = {'success': 'Yes',
-                        'thumb': 'data:image/png;base64,{}'.format(thumb),
+                        'thumb': reverse('thumbnail', kwargs={'token': sign_thumb_request(thumb_request)}),
                         'telescope': filename_dict['tele'],
                         'instrument': filename_dict['filename'].split('-')[1][:2],
                         'filter': filename_dict['filter'],
@@ -1664,6 +1705,47 @@ def make_thumbnail_view(request):
     return HttpResponse(json.dumps(content_response), content_type='application/json')
 
 
+def thumbnail_view(request, token):
+    """
+    Serves the WebP thumbnail for a signed make_thumbs request,
+    rendering it first if it isn't cached yet.
+
+    Like every other page, this is only reachable when logged in
+    (AUTH_STRATEGY is LOCKED); the signed token only limits which
+    thumbnails can be asked for
+    """
+    try:
+        thumb_request = load_thumb_request(token)
+        filename = thumb_request['filename']
+        newfile = get_thumb_name(thumb_request)
+    except (signing.BadSignature, KeyError, TypeError):
+        raise Http404('Invalid thumbnail request')
+    except OSError:
+        raise Http404('Image not found')
+
+    ### Thumbnail names change with the image and parameters, so the name is a strong ETag
+    etag = '"{}"'.format(newfile.rsplit('.', 1)[0])
+    outfile = THUMB_DIR + newfile
+    if os.path.exists(outfile):
+        last_modified = int(os.path.getmtime(outfile))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+    else:
+        try:
+            newfile = get_thumb(thumb_request)
+        except Exception as e:
+            logger.warning('Failed to make thumbnail for {}: {}'.format(filename, e))
+            raise Http404('Thumbnail could not be made')
+        last_modified = int(os.path.getmtime(outfile))
+
+    response = FileResponse(open(outfile, 'rb'), content_type='image/webp')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=60*60*24)
+    return response
+
+
 class InterestingTargetsView(ListView):
 
     template_name = 'custom_code/interesting_targets.html'
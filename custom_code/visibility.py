@@ -0,0 +1,136 @@
+"""
+Vectorized visibility calculations for the airmass plots.
+Everything for every target, site and time sample is computed
+in a single broadcast AltAz transform instead of one
+astroplan Observer.altaz call per site and target.
+"""
+import datetime
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord, EarthLocation, AltAz, get_sun
+from astropy.time import Time
+from astroplan import time_grid_from_range
+from tom_observations import facility
+
+MAX_VISIBILITY_TARGETS = 500  # targets per request to target_visibility_view
+MAX_VISIBILITY_SAMPLES = 2000000  # targets x sites x times per request to target_visibility_view
+
+
+def get_facility_sites(facility_name='LCO'):
+    """
+    Returns the observing sites for a facility as a dict
+    of site name -> site details (latitude, longitude, elevation)
+    """
+    for observing_facility in facility.get_service_classes():
+        if observing_facility != facility_name:
+            continue
+        observing_facility_class = facility.get_service_class(observing_facility)
+        return observing_facility_class().get_observing_sites()
+    return {}
+
+
+def get_observing_sites(facility_name=None):
+    """
+    Returns the observing sites of one facility, or of all of them,
+    keyed by '(facility) site' as in the TOM Toolkit visibility plots
+    """
+    sites = {}
+    for observing_facility in facility.get_service_classes():
+        if facility_name is not None and observing_facility != facility_name:
+            continue
+        observing_facility_class = facility.get_service_class(observing_facility)
+        for site, site_details in observing_facility_class().get_observing_sites().items():
+            sites['({}) {}'.format(observing_facility, site)] = site_details
+    return sites
+
+
+def get_24hr_time_range(interval):
+    """
+    Time grid covering the next 24 hours every interval minutes
+    """
+    start = Time(datetime.datetime.utcnow())
+    end = Time(start.datetime + datetime.timedelta(days=1))
+    return time_grid_from_range(time_range=[start, end], time_resolution=interval*u.minute)
+
+
+def get_site_locations(sites):
+    """
+    Builds a single array-valued EarthLocation for all the sites
+    """
+    return EarthLocation.from_geodetic(
+        lon=[site_details.get('longitude') for site_details in sites.values()]*u.deg,
+        lat=[site_details.get('latitude') for site_details in sites.values()]*u.deg,
+        height=[site_details.get('elevation') for site_details in sites.values()]*u.m
+    )
+
+
+def airmass_grid(ra, dec, sites, time_range, airmass_limit, sun_alt_limit=-18.0, fixed_sun=False):
+    """
+    Computes the airmass of fixed targets at ra, dec (arrays, in degrees)
+    at each site over time_range.
+
+    Returns an (n_targets x n_sites x n_times) array with NaNs wherever
+    a target is above airmass_limit, below the horizon or the sun is
+    above sun_alt_limit (in degrees). The sun and the observer frames
+    are only computed once, however many targets there are. With
+    fixed_sun the sun is held at its position at the middle of
+    time_range, which is plenty for ranges of a day or so
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    if not sites or not len(ra):
+        return np.full((len(ra), len(sites), len(time_range)), np.nan)
+
+    locations = get_site_locations(sites)
+
+    # (n_sites x n_times) frame, broadcast from the sites and the time grid
+    frame = AltAz(obstime=time_range[np.newaxis, :], location=locations[:, np.newaxis])
+
+    if fixed_sun:
+        sun_coords = get_sun(time_range[int(len(time_range)/2)])
+        sun = SkyCoord(sun_coords.ra, sun_coords.dec, unit='deg')
+    else:
+        sun = get_sun(time_range)[np.newaxis, :]
+    sun_alt = sun.transform_to(frame).alt.to_value(u.deg)
+
+    # (n_targets x 1 x 1) targets broadcast against the frame
+    targets = SkyCoord(ra[:, np.newaxis, np.newaxis], dec[:, np.newaxis, np.newaxis], unit='deg')
+    obj_airmass = np.asarray(targets.transform_to(frame).secz.value, dtype=float)
+
+    bad = (obj_airmass >= airmass_limit) | (obj_airmass <= 1) | (sun_alt > sun_alt_limit)[np.newaxis, :, :]
+    return np.where(bad, np.nan, obj_airmass)
+
+
+def get_site_airmasses(ra, dec, sites, time_range, airmass_limit, sun_alt_limit=-12.0):
+    """
+    Computes the airmass of a fixed target at each site over time_range.
+
+    Returns a dict of site name -> airmass array with the same length
+    as time_range, with NaNs wherever the target is above airmass_limit,
+    below the horizon or the sun is above sun_alt_limit (in degrees)
+    """
+    if not sites:
+        return {}
+
+    # Same speed hack as before: hold the sun fixed at its midpoint position
+    obj_airmass = airmass_grid(ra, dec, sites, time_range, airmass_limit, sun_alt_limit=sun_alt_limit, fixed_sun=True)[0]
+
+    return {site: obj_airmass[i] for i, site in enumerate(sites.keys())}
+
+
+def compute_visibility(targets, sites, start, end, resolution, airmass_limit=3.0, sun_alt_limit=-18.0):
+    """
+    Computes the visibility of many sidereal targets at once.
+
+    targets is a list of Targets (or anything with ra and dec, in degrees),
+    sites a dict of site name -> site details as from get_observing_sites,
+    start and end datetimes and resolution the time step in minutes.
+    Returns the time grid and an (n_targets x n_sites x n_times) airmass
+    array, masked with NaNs as in airmass_grid
+    """
+    if end < start:
+        raise ValueError('Start must be before end')
+    time_range = time_grid_from_range(time_range=[Time(start), Time(end)], time_resolution=resolution*u.minute)
+    ra = [target.ra for target in targets]
+    dec = [target.dec for target in targets]
+    return time_range, airmass_grid(ra, dec, sites, time_range, airmass_limit, sun_alt_limit=sun_alt_limit)
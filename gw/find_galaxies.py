@@ -12,12 +12,142 @@ from ligo.skymap import distance
 
 from gw.models import GWFollowupGalaxy
 import os
+import json
+import fcntl
+import tempfile
+import threading
 from django.conf import settings
 import logging
 
 logger = logging.getLogger(__name__)
 BASE_DIR = settings.BASE_DIR
 
+### Process-level cache of the galaxy catalog, stored as one .npy file
+### per column next to the catalog and memory-mapped on first use
+CATALOG_COLUMNS = ['objname', 'ra', 'dec', 'DistMpc', 'Mstar']
+PRECOMPUTED_NSIDES = [64, 128, 256, 512, 1024, 2048]
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+
+class GalaxyCatalog:
+    """
+    Memory-mapped columns of the galaxy catalog, already cut to galaxies
+    with a stellar mass and a positive distance, plus RING HEALPix
+    indices of every galaxy for the nsides of the sky maps we receive
+    """
+
+    def __init__(self, catalog_path, cache_dir=None):
+        self.catalog_path = catalog_path
+        self.cache_dir = cache_dir or catalog_path + '.cache'
+        stat = os.stat(catalog_path)
+        self.fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        if not self._cache_is_current():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            ### Only one process builds the cache, the others wait and then use it
+            with open(os.path.join(self.cache_dir, 'build.lock'), 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    if not self._cache_is_current():
+                        self._build_cache()
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+        self.columns = {col: np.load(self._column_path(col), mmap_mode='r') for col in CATALOG_COLUMNS}
+        self._ipix = {}
+
+    def __len__(self):
+        return len(self.columns['ra'])
+
+    def __getitem__(self, col):
+        return self.columns[col]
+
+    def _column_path(self, col):
+        return os.path.join(self.cache_dir, '{}.npy'.format(col))
+
+    def _ipix_path(self, nside):
+        return os.path.join(self.cache_dir, 'ipix_ring_{}.npy'.format(nside))
+
+    def _cache_is_current(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'manifest.json')) as f:
+                return json.load(f) == self.fingerprint
+        except (OSError, ValueError):
+            return False
+
+    def _save(self, path, array):
+        ### Write to a temporary file unique to this writer, then publish it atomically
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp.npy', delete=False) as f:
+            tmp = f.name
+            try:
+                np.save(f, array)
+            except:
+                os.remove(tmp)
+                raise
+        os.replace(tmp, path)
+
+    def _build_cache(self):
+        logger.info('Building galaxy catalog cache in {}'.format(self.cache_dir))
+        with fits.open(self.catalog_path, memmap=True) as hdu:
+            data = hdu[1].data
+            ### If using luminosity, remove galaxies with no Lum_X
+            ### If using mass, make cuts on DistMpc and Mstar
+            mstar = np.asarray(data['Mstar'], dtype=float)
+            dist = np.asarray(data['DistMpc'], dtype=float)
+            keep = ~np.isnan(mstar) & (dist > 0)
+            for col in CATALOG_COLUMNS:
+                values = np.asarray(data[col])[keep]
+                if values.dtype.kind == 'S':
+                    values = np.char.decode(values, 'utf-8')
+                elif values.dtype.kind != 'U':
+                    values = values.astype(float)
+                self._save(self._column_path(col), values)
+
+        ra = np.load(self._column_path('ra'), mmap_mode='r')
+        dec = np.load(self._column_path('dec'), mmap_mode='r')
+        for nside in PRECOMPUTED_NSIDES:
+            self._save(self._ipix_path(nside), hp.ang2pix(nside, ra, dec, lonlat=True))
+
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, suffix='.tmp.json', delete=False) as f:
+            json.dump(self.fingerprint, f)
+        os.replace(f.name, os.path.join(self.cache_dir, 'manifest.json'))
+
+    def ipix(self, nside):
+        """
+        RING pixel index of every galaxy at nside
+        """
+        if nside not in self._ipix:
+            path = self._ipix_path(nside)
+            if not os.path.exists(path):
+                self._save(path, hp.ang2pix(nside, self['ra'], self['dec'], lonlat=True))
+            self._ipix[nside] = np.load(path, mmap_mode='r')
+        return self._ipix[nside]
+
+
+def get_galaxy_catalog(catalog_path, cache_dir=None):
+    """
+    Returns the cached GalaxyCatalog for catalog_path, loading it once per process
+    """
+    with _catalog_lock:
+        catalog = _catalogs.get(catalog_path)
+        if catalog is None or catalog.fingerprint['mtime'] != os.stat(catalog_path).st_mtime_ns:
+            catalog = GalaxyCatalog(catalog_path, cache_dir=cache_dir)
+            _catalogs[catalog_path] = catalog
+        return catalog
+
+
+def credible_cutoff(prob, credzone, start=0):
+    """
+    Smallest pixel value that has to be included, going from the most
+    probable pixel down, for the summed values to reach credzone.
+
+    Returns the cutoff and the number of pixels included
+    """
+    sortedprob = np.sort(prob, kind='mergesort')[::-1]
+    cumprob = np.cumsum(sortedprob, dtype=np.float64)
+    nincluded = max(start, int(np.searchsorted(cumprob, credzone, side='left')) + 1)
+    nincluded = min(nincluded, len(sortedprob))
+    return sortedprob[nincluded-1], nincluded
+
 
 def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
     """
@@ -72,21 +202,12 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
 
     # Load the galaxy catalog.
     logger.info('Loading Galaxy Catalog')
-    hdu = fits.open(catalog_path)
-    galaxies = Table(hdu[1].data)
-    hdu.close()
-    ### If using luminosity, remove galaxies with no Lum_X, like so:q
-    #galaxies = galaxies[~np.isnan(galaxies['Lum_W1'])]
-    ### If using mass, make cuts on DistMpc and Mstar
-    galaxies = galaxies[~np.isnan(galaxies['Mstar'])]
-    galaxies = galaxies[np.where(galaxies['DistMpc']>0)] # Remove galaxies with distance < 0
-
-    theta = 0.5 * np.pi - np.pi*(galaxies['dec'])/180
-    phi = np.deg2rad(galaxies['ra'])
-    d = np.array(galaxies['DistMpc'])
+    galaxies = get_galaxy_catalog(catalog_path, cache_dir=config.get('GALAXIES', 'CATALOG_CACHE_DIR', fallback=None))
+
+    d = np.asarray(galaxies['DistMpc'])
     # Convert galaxy coordinates to map pixels:
     logger.info('Converting Galaxy Coordinates to Map Pixels')
-    ipix = hp.ang2pix(nside, theta, phi)
+    ipix = np.asarray(galaxies.ipix(nside))
 
     maxprobcoord_tup = hp.pix2ang(nside, np.argmax(prob))
     maxprobcoord = [0, 0]
@@ -95,14 +216,7 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
     
     #Find the zone with probability <= credzone:
     logger.info('Finding zone with credible probability')
-    probcutoff = 1
-    probsum = 0
-
-    sortedprob = np.sort(prob,kind="mergesort")
-    while probsum < credzone:
-        probsum = probsum + sortedprob[-1]
-        probcutoff = sortedprob[-1]
-        sortedprob = sortedprob[:-1]
+    probcutoff, nincluded = credible_cutoff(prob, credzone)
 
     # Calculate the probability for galaxies according to the localization map:
     logger.info('Calculating galaxy probabilities')
@@ -110,34 +224,29 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
     distp = (norm(distmu[ipix], distsigma[ipix]).pdf(d) * distnorm[ipix])
 
     # Cuttoffs: credzone of probability by angles and nsigmas by distance:
-    inddistance = np.where(np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix])
-    indcredzone = np.where(p>=probcutoff)
+    inzone = (np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix]) & (p>=probcutoff)
 
     doMassCuttoff = True
 
     # Increase credzone to 99.995% if no galaxies found:
     # If no galaxies found in the credzone and within the right distance range
-    if len(galaxies[np.intersect1d(indcredzone,inddistance)]) == 0:
-        while probsum < 0.99995:
-            if sortedprob.size == 0:
-                break
-            probsum = probsum + sortedprob[-1]
-            probcutoff = sortedprob[-1]
-            sortedprob = sortedprob[:-1]
-        inddistance = np.where(np.abs(d - distmu[ipix]) < 5 * distsigma[ipix])
-        indcredzone = np.where(p >= probcutoff)
+    if not inzone.any():
+        probcutoff, nincluded = credible_cutoff(prob, 0.99995, start=nincluded)
+        inzone = (np.abs(d - distmu[ipix]) < 5 * distsigma[ipix]) & (p >= probcutoff)
         doMassCuttoff = False
 
-    ipix = ipix[np.intersect1d(indcredzone, inddistance)]
-    p = p[np.intersect1d(indcredzone, inddistance)]
-    p = (p * (distp[np.intersect1d(indcredzone, inddistance)]))  ##d**2?
+    selected = np.flatnonzero(inzone)
+    ipix = ipix[selected]
+    p = p[selected]
+    p = (p * (distp[selected]))  ##d**2?
 
-    galaxies = galaxies[np.intersect1d(indcredzone, inddistance)]
-    if len(galaxies) == 0:
+    if len(selected) == 0:
         logger.warning("No galaxies found")
         logger.warning("Peak is at [RA,DEC](deg) = {}".format(maxprobcoord))
         return
 
+    galaxies = {col: np.asarray(galaxies[col][selected]) for col in CATALOG_COLUMNS}
+
     ### Normalize by mass:
     ### NOTE: Can also do this in using luminosity (commented out)
 
@@ -182,7 +291,7 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
 
     #absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
     absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity)) # Check this?
-    distanceFactor = np.zeros(len(galaxies))
+    distanceFactor = np.zeros(len(selected))
 
     distanceFactor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
     distanceFactor[mindistFactor>(maxL - absolute_sensitivity_lum) / (maxL - minL)] = mindistFactor
@@ -193,17 +302,13 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
     ii = np.argsort(p*massNorm*distanceFactor,kind="mergesort")[::-1]
 
     ####counting galaxies that constitute 50% of the probability(~0.5*0.98)
-    summ = 0
-    galaxies50per = 0
-    sum_seen = 0
-    enough = True
-    while summ<0.5:
-        if galaxies50per>= len(ii):
-            enough = False
-            break
-        summ = summ + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]])/float(normalization)
-        sum_seen = sum_seen + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]]*distanceFactor[ii[galaxies50per]])/float(normalization)
-        galaxies50per = galaxies50per+1
+    contribution = p[ii]*massNorm[ii]/float(normalization)
+    cumcontribution = np.cumsum(contribution)
+    galaxies50per = int(np.searchsorted(cumcontribution, 0.5, side='left')) + 1
+    enough = galaxies50per <= len(ii)
+    galaxies50per = min(galaxies50per, len(ii))
+    sum_seen = np.sum(contribution[:galaxies50per]*distanceFactor[ii[:galaxies50per]])
+    logger.info('{} galaxies make up 50% of the probability ({:.3f} of it detectable)'.format(galaxies50per, sum_seen))
 
     if len(ii) > ngalaxtoshow:
         n = ngalaxtoshow
@@ -211,16 +316,16 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None):
         n = len(ii)
 
     ### Save the galaxies in the database
-    for i in range(ii.shape[0])[:n]:
-        ind = ii[i]
-        newgalaxyrow = GWFollowupGalaxy(catalog='NEDLVSCatalog', 
-                                        catalog_objname=galaxies[ind]['objname'],
-                                        ra=galaxies[ind]['ra'], 
-                                        dec=galaxies[ind]['dec'],
-                                        dist=galaxies[ind]['DistMpc'], 
-                                        score=(p * massNorm / normalization)[ind],
-                                        eventlocalization=eventlocalization
-                        )
-        newgalaxyrow.save()
+    scores = p * massNorm / normalization
+    GWFollowupGalaxy.objects.bulk_create([
+        GWFollowupGalaxy(catalog='NEDLVSCatalog', 
+                         catalog_objname=str(galaxies['objname'][ind]),
+                         ra=float(galaxies['ra'][ind]), 
+                         dec=float(galaxies['dec'][ind]),
+                         dist=float(galaxies['DistMpc'][ind]), 
+                         score=float(scores[ind]),
+                         eventlocalization=eventlocalization
+        ) for ind in ii[:n]
+    ])
    
     logger.info('Finished creating ranked galaxy list for EventLocalization {}'.format(eventlocalization))
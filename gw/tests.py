@@ -1,3 +1,92 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from astropy.io import fits
+from astropy.table import Table
+import healpy as hp
+import numpy as np
+import os
+import tempfile
 
-# Create your tests here.
+from gw.find_galaxies import GalaxyCatalog, CATALOG_COLUMNS, credible_cutoff
+
+
+def loop_credible_cutoff(prob, credzone):
+    """
+    The loop generate_galaxy_list used to find the credible zone
+    """
+    probcutoff = 1
+    probsum = 0
+    nincluded = 0
+    sortedprob = np.sort(prob, kind="mergesort")
+    while probsum < credzone:
+        probsum = probsum + sortedprob[-1]
+        probcutoff = sortedprob[-1]
+        sortedprob = sortedprob[:-1]
+        nincluded += 1
+    return probcutoff, nincluded
+
+
+class CredibleCutoffTest(SimpleTestCase):
+
+    def test_matches_loop(self):
+        rng = np.random.default_rng(5)
+        for npix in [12, 768, 12*64**2]:
+            prob = rng.exponential(1.0, npix)**4
+            prob /= prob.sum()
+            for credzone in [0.5, 0.9, 0.99]:
+                self.assertEqual(credible_cutoff(prob, credzone), loop_credible_cutoff(prob, credzone))
+
+    def test_start_and_whole_map(self):
+        prob = np.array([0.4, 0.3, 0.2, 0.1])
+        self.assertEqual(credible_cutoff(prob, 0.5), (0.3, 2))
+        self.assertEqual(credible_cutoff(prob, 0.5, start=3), (0.2, 3))
+        self.assertEqual(credible_cutoff(prob, 2.0), (0.1, 4))
+
+
+class GalaxyCatalogTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(7)
+        n = 500
+        mstar = rng.uniform(9, 11, n)
+        mstar[::10] = np.nan
+        dist = rng.uniform(-10, 200, n)
+        self.table = Table({
+            'objname': np.array(['galaxy{}'.format(i) for i in range(n)]),
+            'ra': rng.uniform(0, 360, n),
+            'dec': np.degrees(np.arcsin(rng.uniform(-1, 1, n))),
+            'DistMpc': dist,
+            'Mstar': mstar,
+        })
+        self.catalog_path = os.path.join(self.tmpdir.name, 'galaxies.fits')
+        fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(self.table)]).writeto(self.catalog_path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cut_columns_and_pixels(self):
+        catalog = GalaxyCatalog(self.catalog_path)
+        keep = ~np.isnan(self.table['Mstar']) & (self.table['DistMpc'] > 0)
+        self.assertEqual(len(catalog), np.count_nonzero(keep))
+        for col in CATALOG_COLUMNS:
+            if col == 'objname':
+                self.assertEqual(list(catalog[col]), list(self.table[col][keep]))
+            else:
+                np.testing.assert_array_equal(catalog[col], np.asarray(self.table[col][keep], dtype=float))
+        for nside in [64, 32]:
+            np.testing.assert_array_equal(catalog.ipix(nside), hp.ang2pix(nside, catalog['ra'], catalog['dec'], lonlat=True))
+
+        ### Nothing half-written is left behind
+        self.assertFalse([name for name in os.listdir(catalog.cache_dir) if '.tmp' in name])
+
+    def test_cache_reused_and_rebuilt(self):
+        catalog = GalaxyCatalog(self.catalog_path)
+        manifest = os.path.join(catalog.cache_dir, 'manifest.json')
+        built = os.stat(manifest).st_mtime_ns
+        GalaxyCatalog(self.catalog_path)
+        self.assertEqual(os.stat(manifest).st_mtime_ns, built)
+
+        table = self.table[:100]
+        fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(table)]).writeto(self.catalog_path, overwrite=True)
+        catalog = GalaxyCatalog(self.catalog_path)
+        self.assertEqual(len(catalog), np.count_nonzero(~np.isnan(table['Mstar']) & (table['DistMpc'] > 0)))
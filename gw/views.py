@@ -7,6 +7,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import Group
 from django.views.generic import ListView
 from guardian.shortcuts import assign_perm
+from custom_code.permissions import bulk_assign_perms
 import json
 from datetime import datetime, timedelta
 from tom_nonlocalizedevents.models import NonLocalizedEvent, EventSequence, EventLocalization
@@ -166,10 +167,9 @@ def submit_galaxy_observations_view(request):
                         )
 
                     groups = Group.objects.filter(name='GWO4')
-                    for record in new_observations:
-                        assign_perm('tom_observations.view_observationrecord', groups, record)
-                        assign_perm('tom_observations.change_observationrecord', groups, record)
-                        assign_perm('tom_observations.delete_observationrecord', groups, record)
+                    bulk_assign_perms('tom_observations.view_observationrecord', groups, new_observations)
+                    bulk_assign_perms('tom_observations.change_observationrecord', groups, new_observations)
+                    bulk_assign_perms('tom_observations.delete_observationrecord', groups, new_observations)
 
                     ## Add the sequence to SNEx1
                     #snex_id = run_hook(
@@ -485,6 +485,13 @@ WEBPACK_LOADER = {
 TOM_API_URL = os.getenv('TOM_API_URL', 'http://127.0.0.1:8000')
 HERMES_API_URL = os.getenv('HERMES_API_URL', 'http://hermes.lco.gtn')
 
+# Optional directory for the pickled SNEx1 schema reflection used by the hooks
+SNEX1_SCHEMA_CACHE_DIR = os.getenv('SNEX1_SCHEMA_CACHE_DIR', None)
+
+# Connections kept (and allowed on top of those) by each process's SNEx1 engine
+SNEX1_DB_POOL_SIZE = int(os.getenv('SNEX1_DB_POOL_SIZE', 5))
+SNEX1_DB_MAX_OVERFLOW = int(os.getenv('SNEX1_DB_MAX_OVERFLOW', 5))
+
 ALERT_STREAMS = [
     {
         'ACTIVE': True,
@@ -53,7 +53,9 @@ urlpatterns = [
     path('submit/<str:facility>/', CustomObservationCreateView.as_view(), name='submit-lco-obs'),
     path('query-swift-observations/', query_swift_observations_view, name='query-swift-observations'),
     path('load-lc/', load_lightcurve_view, name='load-lc'),
+    path('target-visibility/', target_visibility_view, name='target-visibility'),
     path('make-thumbnail/', make_thumbnail_view, name='make-thumbnail'),
+    path('thumbnail/<str:token>/', thumbnail_view, name='thumbnail'),
     path('interesting-targets/', InterestingTargetsView.as_view(), name='interesting-targets'),
     path('load-spectra-page/', async_spectra_page_view, name='load-spectra-page'),
     path('load-upcoming-reminders/', async_scheduling_page_view, name='load-upcoming-reminders'),